@@ -2,19 +2,45 @@ import streamlit as st #for ui
 from PyPDF2 import PdfReader  #to convert pdf's text to machine readable text using the text drawing commands in the pdf
 st.write("TEST")
 import gensim.models as g
+import os
+import glob
+import hashlib
+import numpy as np
+from vector_index import VectorIndex # file-backed vector index, embeddings as one float32 matrix on disk searched with numpy
+# where the embeddings are kept between runs, in place of the vector database (see the end of this file for why there's none)
+INDEX_DIR=os.getenv('EMBEDDINGS_INDEX_DIR',os.path.join(os.path.dirname(os.path.abspath(__file__)),"vector_index"))
+
+@st.cache_resource # opened once per server, not on every rerun
+def get_index():
+    return VectorIndex(INDEX_DIR,700) # 700 is the vector_size of the Word2Vec below
+
+# the word vectors of the Word2Vec model of every document, saved once it's trained so that it's trained once per document (not on every rerun)
+MODEL_DIR=os.getenv('EMBEDDINGS_MODEL_DIR',os.path.join(INDEX_DIR,"models"))
+
+def model_path(document):
+    return os.path.join(MODEL_DIR,f"{document}.kv")
+
+@st.cache_resource(max_entries=8) # loaded on the first question about a document, memory mapped so only the vectors used are read
+def load_word_vectors(document):
+    return g.KeyedVectors.load(model_path(document),mmap='r')
+
 #this takes in the document for which we need to make embeddings and check them with the embeddings in the vector database
 uploaded_file=st.file_uploader("Choose what to upload ", type="pdf") #https://docs.streamlit.io/develop/api-reference/widgets/st.file_uploader
 
 #This is boilerplate for pypdf2 at https://pypi.org/project/PyPDF2/
 if uploaded_file is not None: #if i didn't add this, it's not stopping to consider whether I've uploaded the file or not, so added. 
-    reader=PdfReader(uploaded_file) #https://pypdf2.readthedocs.io/en/3.0.0/modules/PdfReader.html#PyPDF2.PdfReader
-    totalpages=len(reader.pages)
-    fulltext=[]
-    for i in range(0,2): # further, we can increase this by replacing 2 with totalpages
-        fulltext.append(reader.pages[i].extract_text())
-    fulltext=" ".join(fulltext)
-    st.write("Pages =",totalpages)
-    st.write("Given text is : \n",fulltext)
+    # the index keeps the embeddings of every document embedded before, by the hash of the file, so uploading it again skips reading and training (see vector_index.py)
+    index=get_index()
+    document=hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+    if not (index.has_document(document) and os.path.exists(model_path(document))):
+        reader=PdfReader(uploaded_file) #https://pypdf2.readthedocs.io/en/3.0.0/modules/PdfReader.html#PyPDF2.PdfReader
+        totalpages=len(reader.pages)
+        fulltext=[]
+        for i in range(0,2): # further, we can increase this by replacing 2 with totalpages
+            fulltext.append(reader.pages[i].extract_text())
+        fulltext=" ".join(fulltext)
+        st.write("Pages =",totalpages)
+        st.write("Given text is : \n",fulltext)
 
 
 # now we got the text, we now need to generate embeddings for all of this text
@@ -25,23 +51,36 @@ if uploaded_file is not None: #if i didn't add this, it's not stopping to consid
 
 
 # referenced this boilerplate from here : https://miro.medium.com/v2/resize:fit:1100/format:webp/1*Hu5A2A5Ti4pK8y5biMifEQ.png
-    # in the article, they wrote (sentences=[line.split() for line in fulltext] ) but this is only because the original texts array is divided into \n separated lines. so they're splitting those again.
-    fulltext=fulltext.replace("\n"," ")
-    alltextaslist=fulltext.split(sep=". ") #removing all spaces, part of preprocessing.
-    sentences=[]
-    for line in alltextaslist:
-        initial=line.split()
-        sentences.append(initial)
-    
-    st.write("TEXT AS LIST : ",alltextaslist) 
-    # now using word2vec method in gensim.models sub-section. I saw this documentation : https://radimrehurek.com/gensim/models/word2vec.html#gensim.models.word2vec.Word2Vec
-    # here i had to tinker a little with the hyper parameters
-    w2v=g.Word2Vec(sentences, vector_size=700, window=5, workers=4,epochs=50, min_count=2) # here size is chnged to vector_size and iter is changed to epochs as per latest api reference. I saw changes here : https://github.com/piskvorky/gensim/wiki/Migrating-from-Gensim-3.x-to-4
-    words=list(w2v.wv.key_to_index)
-    st.write("Vocabulary of words which come more than min_count(here, min_count=2) no. of times ",words)
-    st.write("Embedding of represent : ",w2v.wv["represent"])
-    st.write("Embedding of represented : ",w2v.wv["represented"])
-    st.write("Similarity = ", w2v.wv.similarity('represent','represented'))
+        # in the article, they wrote (sentences=[line.split() for line in fulltext] ) but this is only because the original texts array is divided into \n separated lines. so they're splitting those again.
+        fulltext=fulltext.replace("\n"," ")
+        alltextaslist=fulltext.split(sep=". ") #removing all spaces, part of preprocessing.
+        sentences=[]
+        for line in alltextaslist:
+            initial=line.split()
+            sentences.append(initial)
+        
+        st.write("TEXT AS LIST : ",alltextaslist) 
+        # now using word2vec method in gensim.models sub-section. I saw this documentation : https://radimrehurek.com/gensim/models/word2vec.html#gensim.models.word2vec.Word2Vec
+        # here i had to tinker a little with the hyper parameters
+        w2v=g.Word2Vec(sentences, vector_size=700, window=5, workers=4,epochs=50, min_count=2) # here size is chnged to vector_size and iter is changed to epochs as per latest api reference. I saw changes here : https://github.com/piskvorky/gensim/wiki/Migrating-from-Gensim-3.x-to-4
+        words=list(w2v.wv.key_to_index)
+        st.write("Vocabulary of words which come more than min_count(here, min_count=2) no. of times ",words)
+        st.write("Embedding of represent : ",w2v.wv["represent"])
+        st.write("Embedding of represented : ",w2v.wv["represented"])
+        st.write("Similarity = ", w2v.wv.similarity('represent','represented'))
+        # the word vectors are saved under the hash of the file (gensim writes the big arrays next to it first, then this file) and the
+        # embeddings are stored in the index with the word as text. The next upload of the same file skips everything above
+        os.makedirs(MODEL_DIR,exist_ok=True)
+        # retrained (e.g. its index rows were deleted) : the old files are unlinked, not overwritten, since a cached KeyedVectors may still have
+        # them memory mapped. Its mapping keeps the old inode, the next load_word_vectors maps the new files
+        for path in glob.glob(glob.escape(model_path(document))+"*"):
+            os.remove(path)
+        w2v.wv.save(model_path(document))
+        load_word_vectors.clear()
+        index.add([f"{document}:{word}" for word in words],words,w2v.wv[words],document=document)
+    else:
+        st.write("This document was embedded before, its embeddings and model are loaded from disk")
+    words,embeddings=index.get(document)
 
     # so now, the embeddings are coming correctly and they are giving coherent similarity scores also.
 
@@ -60,46 +99,35 @@ if uploaded_file is not None: #if i didn't add this, it's not stopping to consid
    # Supabase did not connect, TCP connection error at 5432 port, most probably access issues due to work laptop.
    # 
    # So, temporary soln: embeddings are stored in csv file.
+   # Now they're in a local file-backed index instead (vector_index.py, in INDEX_DIR) : appended once per document, memory mapped, and searched with numpy.
     import pandas as pd
-    df=pd.DataFrame(columns=['text','embedding'])
-    for i in range(0,len(words)):
-        df.loc[i]=[words[i],list(w2v.wv[words[i]])]
+    df=pd.DataFrame({'text':words,'embedding':list(embeddings)}) # in one go, df.loc[i]= grew the frame one row at a time
     st.dataframe(df)
     # print(list(df.loc[df['text']=='the','embedding']))
 
-    def cosine_distance(a, b):
-        return 1 - sum([a_i * b_i for a_i, b_i in zip(a, b)]) / (
-        sum([a_i ** 2 for a_i in a]) ** 0.5 * sum([b_i ** 2 for b_i in b]) ** 0.5)
+    # the cosine_distance here was python sums over the 700 numbers of every embedding, for every word of the prompt, which took seconds on a big vocabulary.
+    # The index keeps all the embeddings in one matrix with their norms computed once, so comparing a query with all of them is one matrix product (see vector_store.py)
 
     #Since, database setup is done, now take input from user, make embeddings of it and compare them to these and extrat those info
 
     prompt=st.text_input("Ask any question relating to the document you uploaded").split()
     #If we want to give model additional context, this is where we can add, just above prompt and all combined, the embeddings will be generated
-    inputtoword2vec=[]
-    if prompt is not None:
-        for i in prompt:
-            testlist=[]
-            testlist.append(i)
-            inputtoword2vec.append(testlist)
+    if prompt: # split() gives an empty list, not None, when nothing is typed
         st.write("Prompt is ",prompt)
-        st.write("Prompt after converting into the iterables of iterables which is the input form needed for Word2Vec is ", inputtoword2vec)
-        finalembed=g.Word2Vec(inputtoword2vec, vector_size=700, window=5, workers=4,epochs=50, min_count=1)
-        listofembeddings=[]
-        for i in finalembed.wv.key_to_index:
-            st.write(i)
-            listofembeddings.append(finalembed.wv[i])
-        st.write(listofembeddings)
-        maximum=-2
-        neededembed=[]
-        for i in listofembeddings:
-            for j in list(df['embedding']):
-                
-                tocheck=cosine_distance(i,j)
-                if(tocheck>maximum):
-                    maximum=tocheck
-                    neededembed=j
-        st.write(maximum)
-        st.write(neededembed)
+        # the prompt used to train a new Word2Vec of its own words on every keystroke, whose vectors had nothing to do with the document's ones.
+        # Now its words are looked up in the document's model : the prompt is the average of their vectors, and each word is also searched on its own
+        word_vectors=load_word_vectors(document)
+        known=[word for word in prompt if word in word_vectors.key_to_index]
+        unknown=[word for word in prompt if word not in word_vectors.key_to_index]
+        if unknown:
+            st.write("Not in the vocabulary of the document (words seen less than min_count times) : ",unknown)
+        if known:
+            queries=np.vstack([np.mean(word_vectors[known],axis=0),word_vectors[known]])
+            # all at once, the 5 most similar words of the document for each (the old loop kept the largest cosine *distance*, i.e. the least similar one)
+            matches=index.search_batch(queries,k=5,document=document) # only this document : embeddings of different Word2Vec models aren't comparable
+            for label,similar in zip(["the whole prompt"]+known,matches):
+                st.write(f"Most similar to {label} : ")
+                st.dataframe(pd.DataFrame(similar,columns=['id','text','similarity'])[['text','similarity']])
 
 
 
@@ -0,0 +1,337 @@
+import os
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from vector_store import top_k
+# File-backed vector index, the local stand-in for the pgvector/Supabase database app.py couldn't reach.
+# A directory holds :
+#   vectors.f32   the embeddings, float32 rows appended one after the other, read through a memory map (np.memmap) so opening the
+#                 index costs nothing and a search only pages in what it reads
+#   norms.f32     the norm of every row, computed once when it's appended
+#   items.jsonl   one {"id", "text", "document"} line per row, in row order, and a {"deleted": id} line per deletion
+#   index.json    the number of dimensions
+#   ivf.npz       optional approximate index (build_ivf) : k-means centroids of the rows and the list (centroid) of every row
+# Rows are only appended : a deleted row stays in the files, masked, until compact() rewrites them. Appends write the vectors and norms
+# before the items line, and a row only counts once all three are there, so a crash in the middle of an append loses that append only.
+# Every row belongs to a document (e.g. the hash of the uploaded file) : embeddings of different Word2Vec models aren't comparable,
+# so a search is usually restricted to one document.
+#
+# Search is exact (one product with the whole matrix) until build_ivf is called. With an IVF (inverted file) index the query is first
+# compared with the centroids and only the rows of the nprobe closest lists are scored, which for large corpora reads a fraction of
+# the matrix, at the cost of sometimes missing a row of a list that wasn't probed.
+#
+#   python vector_index.py --rows 200000   compares exact and IVF search on random vectors
+
+VECTORS="vectors.f32"
+NORMS="norms.f32"
+ITEMS="items.jsonl"
+INDEX="index.json"
+IVF="ivf.npz"
+
+class VectorIndex:
+    def __init__(self,directory,dimensions=None):
+        """ Opens the index in directory, or creates it (dimensions is then required)."""
+        self.directory=directory
+        self._lock=threading.Lock()
+        os.makedirs(directory,exist_ok=True)
+        index_path=self._path(INDEX)
+        if os.path.exists(index_path):
+            with open(index_path,encoding='utf-8') as f:
+                self.dimensions=json.load(f)["dimensions"]
+            if dimensions is not None and dimensions!=self.dimensions:
+                raise ValueError(f"{directory} holds {self.dimensions} dimension embeddings, not {dimensions}")
+        else:
+            if dimensions is None:
+                raise ValueError(f"No vector index in {directory}, its dimensions are needed to create one")
+            self.dimensions=dimensions
+            with open(index_path,'w',encoding='utf-8') as f:
+                json.dump({"dimensions":dimensions},f)
+        self._load()
+
+    def _path(self,name):
+        return os.path.join(self.directory,name)
+
+    def _file_rows(self,name,row_bytes):
+        path=self._path(name)
+        return os.path.getsize(path)//row_bytes if os.path.exists(path) else 0
+
+    def _load(self):
+        self.ids=[]
+        self.texts=[]
+        self.documents=[]
+        self._row_of={}
+        dead=[]
+        path=self._path(ITEMS)
+        if os.path.exists(path):
+            with open(path,'rb') as f:
+                data=f.read()
+            complete=data[:data.rfind(b'\n')+1]
+            if len(complete)<len(data): # the last line of an interrupted append, cut so the next append starts on its own line
+                with open(path,'r+b') as f:
+                    f.truncate(len(complete))
+            # in order : a deletion applies to the row the id had then, not to a row added later with the same id
+            for line in complete.decode('utf-8').splitlines():
+                item=json.loads(line)
+                if "deleted" in item:
+                    row=self._row_of.pop(item["deleted"],None)
+                    if row is not None:
+                        dead.append(row)
+                else:
+                    self._row_of[item["id"]]=len(self.ids)
+                    self.ids.append(item["id"])
+                    self.texts.append(item["text"])
+                    self.documents.append(item["document"])
+        self.rows=min(len(self.ids),self._file_rows(VECTORS,4*self.dimensions),self._file_rows(NORMS,4))
+        if self.rows<len(self.ids): # items are written last, so this only happens if the vector files were damaged
+            raise ValueError(f"{self.directory} has {len(self.ids)} items but only {self.rows} embeddings")
+        for name,row_bytes in ((VECTORS,4*self.dimensions),(NORMS,4)):
+            path=self._path(name)
+            if os.path.exists(path) and os.path.getsize(path)>self.rows*row_bytes: # rows of an interrupted append
+                with open(path,'r+b') as f:
+                    f.truncate(self.rows*row_bytes)
+        self.live=np.ones(self.rows,dtype=bool)
+        self.live[dead]=False
+        self._document_codes=None
+        self._matrix=None
+        self._norms=None
+        self.ivf=None
+        self._inverted=None
+        if os.path.exists(self._path(IVF)):
+            with np.load(self._path(IVF)) as ivf:
+                if len(ivf["lists"])==self.rows: # built on these rows, otherwise an append was interrupted : rebuild it
+                    self.ivf=(ivf["centroids"],ivf["lists"])
+
+    def __len__(self):
+        """ Rows that aren't deleted."""
+        return int(self.live.sum())
+
+    def __contains__(self,id):
+        return id in self._row_of
+
+    def has_document(self,document):
+        return bool(self._mask(document).any())
+
+    @property
+    def matrix(self):
+        """ (rows, dimensions) memory map of the embeddings, deleted rows included."""
+        if self._matrix is None:
+            self._matrix=np.memmap(self._path(VECTORS),dtype=np.float32,mode='r',shape=(self.rows,self.dimensions)) if self.rows else np.empty((0,self.dimensions),dtype=np.float32)
+            self._norms=np.memmap(self._path(NORMS),dtype=np.float32,mode='r',shape=(self.rows,)) if self.rows else np.empty(0,dtype=np.float32)
+        return self._matrix
+
+    @property
+    def norms(self):
+        self.matrix
+        return self._norms
+
+    def _mask(self,document):
+        """ Rows a search may return : not deleted, and of document if given."""
+        if document is None:
+            return self.live
+        if self._document_codes is None:
+            codes={}
+            self._document_codes=(codes,np.array([codes.setdefault(d,len(codes)) for d in self.documents],dtype=np.int32))
+        codes,per_row=self._document_codes
+        if document not in codes:
+            return np.zeros(self.rows,dtype=bool)
+        return self.live&(per_row==codes[document])
+
+    def add(self,ids,texts,embeddings,document=""):
+        """ Appends embeddings (one row per id). An id that is already in the index is replaced (deleted, then appended)."""
+        ids=list(ids)
+        texts=list(texts)
+        embeddings=np.ascontiguousarray(embeddings,dtype=np.float32).reshape(len(ids),-1) if ids else np.empty((0,self.dimensions),dtype=np.float32)
+        if embeddings.shape[1]!=self.dimensions or len(texts)!=len(ids) or len(set(ids))!=len(ids):
+            raise ValueError(f"Expected distinct ids, as many texts and a ({len(ids)}, {self.dimensions}) matrix of embeddings, got {embeddings.shape}")
+        if not ids:
+            return
+        with self._lock:
+            replaced=[id for id in ids if id in self._row_of]
+            if replaced:
+                self._delete(replaced)
+            with open(self._path(VECTORS),'ab') as f:
+                f.write(embeddings.tobytes())
+            with open(self._path(NORMS),'ab') as f:
+                f.write(np.linalg.norm(embeddings,axis=1).astype(np.float32).tobytes())
+            with open(self._path(ITEMS),'a',encoding='utf-8') as f:
+                f.write(''.join(json.dumps({"id":id,"text":text,"document":document},ensure_ascii=False)+'\n' for id,text in zip(ids,texts)))
+            first=self.rows
+            self.ids+=ids
+            self.texts+=texts
+            self.documents+=[document]*len(ids)
+            for offset,id in enumerate(ids):
+                self._row_of[id]=first+offset
+            self.rows+=len(ids)
+            self.live=np.concatenate([self.live,np.ones(len(ids),dtype=bool)])
+            self._document_codes=None
+            self._matrix=None
+            if self.ivf is not None: # new rows go to the list of their closest centroid, the centroids stay as they are
+                centroids,lists=self.ivf
+                self._save_ivf(centroids,np.concatenate([lists,_closest(centroids,embeddings)]))
+
+    def _delete(self,ids):
+        rows=[self._row_of.pop(id) for id in ids if id in self._row_of]
+        if rows:
+            with open(self._path(ITEMS),'a',encoding='utf-8') as f:
+                f.write(''.join(json.dumps({"deleted":self.ids[row]},ensure_ascii=False)+'\n' for row in rows))
+            self.live[rows]=False
+        return len(rows)
+
+    def delete(self,ids):
+        """ Deletes the rows of ids (the ones that exist). Returns how many were deleted."""
+        with self._lock:
+            return self._delete(list(ids))
+
+    def delete_document(self,document):
+        with self._lock:
+            return self._delete([self.ids[row] for row,d in enumerate(self.documents) if d==document and self.live[row]])
+
+    def get(self,document):
+        """ (texts, embeddings) of the rows of document, in the order they were added."""
+        rows=np.flatnonzero(self._mask(document))
+        return [self.texts[row] for row in rows],np.asarray(self.matrix[rows])
+
+    def compact(self):
+        """ Rewrites the files without the deleted rows."""
+        with self._lock:
+            keep=np.flatnonzero(self.live)
+            matrix=np.asarray(self.matrix[keep])
+            norms=np.asarray(self.norms[keep])
+            lists=self.ivf[1][keep] if self.ivf is not None else None
+            self._matrix=self._norms=None # the memory maps have to be closed before their files are replaced (Windows)
+            for name,data in ((VECTORS,matrix.tobytes()),(NORMS,norms.tobytes()),(ITEMS,''.join(json.dumps({"id":self.ids[row],"text":self.texts[row],"document":self.documents[row]},ensure_ascii=False)+'\n' for row in keep).encode('utf-8'))):
+                with open(self._path(name+".tmp"),'wb') as f:
+                    f.write(data)
+                os.replace(self._path(name+".tmp"),self._path(name))
+            if lists is not None:
+                self._save_ivf(self.ivf[0],lists)
+            self._load()
+
+    def _save_ivf(self,centroids,lists):
+        with open(self._path(IVF+".tmp"),'wb') as f:
+            np.savez(f,centroids=centroids,lists=lists)
+        os.replace(self._path(IVF+".tmp"),self._path(IVF))
+        self.ivf=(centroids,lists)
+
+    def build_ivf(self,lists=None,iterations=10,sample=50000,seed=0):
+        """ Builds the approximate index : spherical k-means of the rows into lists clusters (default about sqrt(rows)), trained on
+        at most sample rows, then every row is assigned to its closest centroid."""
+        with self._lock:
+            live=np.flatnonzero(self.live)
+            if len(live)==0:
+                return
+            lists=max(1,min(lists or int(np.sqrt(len(live))),len(live)))
+            generator=np.random.default_rng(seed)
+            training=_unit(np.asarray(self.matrix[np.sort(generator.choice(live,min(sample,len(live)),replace=False))]))
+            centroids=training[generator.choice(len(training),lists,replace=False)]
+            for _ in range(iterations):
+                assignment=np.argmax(training@centroids.T,axis=1)
+                for c in range(lists):
+                    members=training[assignment==c]
+                    if len(members): # an empty cluster keeps its centroid
+                        centroids[c]=members.sum(axis=0)
+                centroids=_unit(centroids)
+            self._save_ivf(centroids,_closest(centroids,self.matrix))
+
+    def drop_ivf(self):
+        with self._lock:
+            if os.path.exists(self._path(IVF)):
+                os.remove(self._path(IVF))
+            self.ivf=None
+
+    def _inverted_lists(self):
+        """ (rows sorted by list, start of every list in there) : the rows of list c are order[bounds[c]:bounds[c+1]]."""
+        centroids,lists=self.ivf
+        if self._inverted is None or self._inverted[0] is not lists:
+            order=np.argsort(lists,kind='stable')
+            self._inverted=(lists,order,np.searchsorted(lists[order],np.arange(len(centroids)+1)))
+        return self._inverted[1:]
+
+    def search_batch(self,queries,k=5,document=None,nprobe=None):
+        """ For every query, [(id, text, cosine similarity)] of its k most similar rows (of document if given), most similar first.
+        With an IVF index only the rows of the nprobe (default about a tenth of them) closest lists are scored; nprobe=0 is exact."""
+        queries=np.atleast_2d(np.asarray(queries,dtype=np.float32))
+        if queries.shape[1]!=self.dimensions:
+            raise ValueError(f"Queries have {queries.shape[1]} dimensions, the index has {self.dimensions}")
+        mask=self._mask(document)
+        query_norms=np.linalg.norm(queries,axis=1)
+        results=[]
+        for query,query_norm in zip(queries,query_norms):
+            rows=None
+            if self.ivf is not None and nprobe!=0:
+                centroids,_=self.ivf
+                probe=min(len(centroids),nprobe or max(1,len(centroids)//10))
+                closest=top_k((centroids@query)[None,:],probe)[0]
+                order,bounds=self._inverted_lists()
+                rows=np.sort(np.concatenate([order[bounds[c]:bounds[c+1]] for c in closest]))
+                rows=rows[mask[rows]]
+                if len(rows)<k: # too few rows in those lists (e.g. a small document) : exact
+                    rows=None
+            if rows is None:
+                rows=np.flatnonzero(mask)
+            if len(rows)==0:
+                results.append([])
+                continue
+            matrix=self.matrix if len(rows)==self.rows else self.matrix[rows]
+            norms=np.asarray(self.norms if len(rows)==self.rows else self.norms[rows])*query_norm
+            dots=matrix@query
+            scores=np.divide(dots,norms,out=np.zeros_like(dots),where=norms>0)
+            best=top_k(scores[None,:],k)[0]
+            results.append([(self.ids[rows[i]],self.texts[rows[i]],float(scores[i])) for i in best])
+        return results
+
+    def search(self,query,k=5,document=None,nprobe=None):
+        return self.search_batch([query],k,document,nprobe)[0]
+
+def _unit(matrix):
+    norms=np.linalg.norm(matrix,axis=1,keepdims=True)
+    return matrix/np.where(norms>0,norms,1)
+
+def _closest(centroids,matrix,batch=65536):
+    """ List (closest centroid) of every row of matrix, a batch of rows at a time so a memory map isn't read whole into memory."""
+    lists=np.empty(len(matrix),dtype=np.int32)
+    for start in range(0,len(matrix),batch):
+        lists[start:start+batch]=np.argmax(np.asarray(matrix[start:start+batch])@centroids.T,axis=1)
+    return lists
+
+def main():
+    import tempfile
+    parser=argparse.ArgumentParser(description="Exact against IVF search of a VectorIndex of random vectors")
+    parser.add_argument("--rows",type=int,default=200000)
+    parser.add_argument("--dimensions",type=int,default=700)
+    parser.add_argument("--queries",type=int,default=20)
+    parser.add_argument("--directory",help="where to build the index (default a temporary directory)")
+    args=parser.parse_args()
+    generator=np.random.default_rng(0)
+    # clustered data, like real embeddings : random centers plus noise
+    centers=generator.standard_normal((256,args.dimensions),dtype=np.float32)
+    with tempfile.TemporaryDirectory() as temporary:
+        index=VectorIndex(args.directory or temporary,args.dimensions)
+        start=time.perf_counter()
+        for first in range(0,args.rows,50000):
+            count=min(50000,args.rows-first)
+            rows=centers[generator.integers(0,len(centers),count)]+0.5*generator.standard_normal((count,args.dimensions),dtype=np.float32)
+            index.add([f"row{i}" for i in range(first,first+count)],[f"text {i}" for i in range(first,first+count)],rows)
+        print(f"Appended {args.rows} rows of {args.dimensions} dimensions in {time.perf_counter()-start:.1f} s")
+        start=time.perf_counter()
+        index=VectorIndex(index.directory)
+        print(f"Opened in {(time.perf_counter()-start)*1000:.0f} ms")
+        queries=centers[generator.integers(0,len(centers),args.queries)]+0.5*generator.standard_normal((args.queries,args.dimensions),dtype=np.float32)
+        start=time.perf_counter()
+        exact=index.search_batch(queries,10)
+        exact_seconds=(time.perf_counter()-start)/args.queries
+        start=time.perf_counter()
+        index.build_ivf()
+        print(f"IVF of {len(index.ivf[0])} lists built in {time.perf_counter()-start:.1f} s")
+        start=time.perf_counter()
+        approximate=index.search_batch(queries,10)
+        ivf_seconds=(time.perf_counter()-start)/args.queries
+        recall=np.mean([len({r[0] for r in a}&{r[0] for r in e})/len(e) for a,e in zip(approximate,exact)])
+        print(f"  exact {exact_seconds*1000:8.1f} ms per query")
+        print(f"  IVF   {ivf_seconds*1000:8.1f} ms per query, recall@10 {recall:.2f}")
+        del index
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,98 @@
+import time
+import argparse
+import numpy as np
+# In-memory vector store for the word embeddings of app.py.
+# Before this, every query embedding was compared with every row of df['embedding'] by a cosine_distance written with Python sums over
+# the 700 numbers of each vector, i.e. a few million Python operations per query word on a vocabulary of a few thousand words.
+# Here all the embeddings are one contiguous float32 matrix (one row per word) and the norm of every row is computed once, when the
+# store is built. The cosine similarity of a query with every row is then one matrix-vector product divided by the norms, and the top k
+# rows are picked with argpartition instead of sorting everything. Several queries at once are one matrix-matrix product.
+#
+#   python vector_store.py --rows 50000   compares it with the pure Python loop on random vectors
+
+def top_k(scores,k):
+    """ Column indices of the k largest scores of every row of a 2d array, largest first : the k best of each row in any order
+    (argpartition, linear time), then only those k sorted."""
+    k=min(k,scores.shape[1])
+    if k<=0:
+        return np.empty((scores.shape[0],0),dtype=np.intp)
+    top=np.argpartition(-scores,k-1,axis=1)[:,:k]
+    order=np.argsort(-np.take_along_axis(scores,top,axis=1),axis=1,kind='stable')
+    return np.take_along_axis(top,order,axis=1)
+
+class VectorStore:
+    def __init__(self,texts,embeddings):
+        """ texts[i] is the text (word, sentence, ...) of the i-th embedding. embeddings is anything numpy can turn into a
+        (len(texts), dimensions) matrix : a list of lists, a 2d array, w2v.wv.vectors, ..."""
+        self.texts=list(texts)
+        self.matrix=np.ascontiguousarray(embeddings,dtype=np.float32)
+        if self.matrix.ndim!=2 or self.matrix.shape[0]!=len(self.texts):
+            raise ValueError(f"Expected {len(self.texts)} embeddings as a 2d matrix, got shape {self.matrix.shape}")
+        self.norms=np.linalg.norm(self.matrix,axis=1)
+
+    def __len__(self):
+        return len(self.texts)
+
+    @property
+    def dimensions(self):
+        return self.matrix.shape[1]
+
+    def similarities(self,queries):
+        """ Cosine similarity of every query (rows of a 2d array) with every embedding, as a (queries, embeddings) matrix.
+        A zero vector, on either side, has a similarity of 0 with everything."""
+        queries=np.atleast_2d(np.asarray(queries,dtype=np.float32))
+        if queries.shape[1]!=self.dimensions:
+            raise ValueError(f"Queries have {queries.shape[1]} dimensions, the store has {self.dimensions}")
+        dots=queries@self.matrix.T
+        norms=np.linalg.norm(queries,axis=1)[:,None]*self.norms[None,:]
+        return np.divide(dots,norms,out=np.zeros_like(dots),where=norms>0)
+
+    def search_batch(self,queries,k=5):
+        """ For every query, [(text, cosine similarity)] of its k most similar embeddings, most similar first."""
+        if len(self)==0:
+            return [[] for _ in np.atleast_2d(queries)]
+        scores=self.similarities(queries)
+        return [[(self.texts[i],float(row[i])) for i in best] for row,best in zip(scores,top_k(scores,k))]
+
+    def search(self,query,k=5):
+        """ [(text, cosine similarity)] of the k embeddings most similar to query, most similar first."""
+        return self.search_batch([query],k)[0]
+
+def _python_cosine_similarity(a,b):
+    """ The loop app.py used (as a similarity, it computed 1 - this), kept for the comparison."""
+    return sum([a_i*b_i for a_i,b_i in zip(a,b)])/(sum([a_i**2 for a_i in a])**0.5*sum([b_i**2 for b_i in b])**0.5)
+
+def main():
+    parser=argparse.ArgumentParser(description="Top-k cosine search : VectorStore against the pure Python loop, on random vectors")
+    parser.add_argument("--rows",type=int,default=50000,help="vocabulary size")
+    parser.add_argument("--dimensions",type=int,default=700)
+    parser.add_argument("--queries",type=int,default=10)
+    parser.add_argument("--python-rows",type=int,default=2000,help="rows the Python loop is timed on, its time is scaled up to --rows")
+    args=parser.parse_args()
+    generator=np.random.default_rng(0)
+    embeddings=generator.standard_normal((args.rows,args.dimensions),dtype=np.float32)
+    queries=generator.standard_normal((args.queries,args.dimensions),dtype=np.float32)
+    store=VectorStore([f"word{i}" for i in range(args.rows)],embeddings)
+
+    rows=[list(map(float,row)) for row in embeddings[:args.python_rows]]
+    query=list(map(float,queries[0]))
+    start=time.perf_counter()
+    best=max(range(len(rows)),key=lambda i:_python_cosine_similarity(query,rows[i]))
+    python_seconds=(time.perf_counter()-start)*args.rows/len(rows)
+    python_best=(f"word{best}",_python_cosine_similarity(query,rows[best]))
+
+    in_python_rows=VectorStore(store.texts[:len(rows)],embeddings[:len(rows)]).search(queries[0],1)[0]
+    start=time.perf_counter()
+    for q in queries:
+        store.search(q,5)
+    single=(time.perf_counter()-start)/len(queries)
+    start=time.perf_counter()
+    store.search_batch(queries,5)
+    batch=(time.perf_counter()-start)/len(queries)
+    print(f"{args.rows} embeddings of {args.dimensions} dimensions")
+    print(f"  pure Python loop   {python_seconds*1000:10.1f} ms per query (timed on {len(rows)} rows, best {python_best[0]} {python_best[1]:.4f})")
+    print(f"  VectorStore.search {single*1000:10.2f} ms per query (best of the same {len(rows)} rows {in_python_rows[0]} {in_python_rows[1]:.4f})")
+    print(f"  search_batch       {batch*1000:10.2f} ms per query ({len(queries)} at once)")
+
+if __name__=="__main__":
+    main()
@@ -1,17 +1,31 @@
 from abc import ABC,abstractmethod
-import zipfile
 import streamlit as st
 import os
 from dotenv import load_dotenv
-import requests
-import time 
-import json
+from completion_client import get_completion_client,CompletionRequestError
+from response_cache import get_response_cache
+from sse import DONE,iter_sse_data,chat_delta,throttle_stream
 import sys
-from tmdl_to_er import ERDiagramFromTMDL
-from markdown_to_docx import markdown_to_docx
+from tmdl_to_er import layout_with_preview,PREVIEW_DPI
+from markdown_to_docx import DocxBuilder
+from exports import ExportDocument,available_exports,is_rendered,render_export,file_name
+from pbip_ingestion import ingest_powerbi_zip,ingest_powerbi_folder,PowerBIFileContents
+from tmdl_parser import parse_tmdl
+from report_layout import ReportLayout
+from prompt_compaction import compact_context,count_tokens,DEFAULT_TOKEN_BUDGET,digest_report,describe_report,describe_data_flow,fit_to_budget,PAGE_NAMES,PAGE_FIELDS,VISUALS
+from tmdl_parser import describe_semantic_model,FULL,NO_SOURCES,SHORT_EXPRESSIONS,NO_EXPRESSIONS,NAMES_ONLY
+from section_engine import Section,SectionEngine,StreamingAssembly,assemble
+from upload_cache import ProcessedUploadCache
+from background_render import BackgroundRenderer
+from map_reduce import chunk_tables,table_schema,collect_map_results,assemble_map_reduce,MAP_MAX_TOKENS,SUMMARY_MARKER
+from incremental import get_document_store,document_id,report_name,tmdl_hashes,text_hash,diff_hashes,usable_state,plan_sections,assemble_incremental,document_state,TABLE_PREFIX
+from instrumentation import configure_logging,span,count,instrument_stream,profiled,start_metrics_server
 import logging
-logging.basicConfig(level=logging.DEBUG,stream=sys.stdout,format='%(asctime)s %(message)s',filemode='w')
+# INFO unless REPORTIQ_LOG_LEVEL says otherwise. Stage timings, token rates and counters are recorded by instrumentation.py
+configure_logging()
 logger=logging.getLogger(__name__)
+# Optional render-side pacing of the documentation stream, in seconds between UI updates. 0 renders every delta as it arrives. See sse.throttle_stream
+STREAM_RENDER_INTERVAL=float(os.getenv('REPORTIQ_STREAM_RENDER_INTERVAL','0'))
 # Refer to the Low-Level diagram in the README.md file for more clarity on this code.
 
 #To add support for another file type : 
@@ -26,40 +40,60 @@ class FileProcessor(ABC):
     def process(self):
         pass
 class PowerBIProcessor(FileProcessor):
-    def __init__(self,zip_file):
+    def __init__(self,zip_file,submit_er_diagram=None):
         self.zip_file=zip_file
+        self.submit_er_diagram=submit_er_diagram # submit_er_diagram(fn,model) runs the ER layout in the background, otherwise it's done here
+    def ingest(self):
+        """ Only report.json, relationships.tmdl and the table .tmdl files are decompressed, everything else is skipped using the zip's central directory. See pbip_ingestion.py"""
+        return ingest_powerbi_zip(self.zip_file)
     def process(self):
         """For PowerBI, this processes info by takign in a zip file of the .Report and .SemanticModel folders and extracts report.json and all .tmdl files from them respectively."""
         logger.debug("Called process method in the processor")
         report=""
         semantic_model=[]
         try:
-            with zipfile.ZipFile(self.zip_file,'r') as zip_ref:
-                for file_info in zip_ref.infolist():
-                    logger.debug(f"File name : {str(file_info.filename)}")
-                    if file_info.filename.endswith('report.json'):
-                        with zip_ref.open(file_info) as report_file:
-                            report=report_file.read().decode('utf-8')
-                            logger.debug("report.json extracted!")
-                            logger.debug(f"Tokens of report.json = {len(report)}")
-                    elif "/LocalDate" not in file_info.filename and "/DateTableTemplate" not in file_info.filename and (file_info.filename.endswith('relationships.tmdl') or "/tables/" in file_info.filename): # /cultures/ has a .tmdl file which is language specific and lists out all the nouns and verbs in the whole report, which is very long and not useful to the model. So excluding it to decrease token count.
-                        with zip_ref.open(file_info) as semantic_model_file:
-                            semantic_model.append(semantic_model_file.read().decode('utf-8'))
-                            logger.debug(f"Tokens in semantic model after adding {file_info.filename} : {len(semantic_model)}")
+            with span("ingestion") as attributes:
+                project=self.ingest()
+                attributes.update(bytes_read=project.bytes_read,tables=len(project.tables))
+            count("reportiq_bytes_read_total",project.bytes_read,help="Bytes of report.json and .tmdl files read from uploads and project folders")
+            report=project.report
+            semantic_model=project.semantic_model
             if(len(report)==0 or len(semantic_model)==0):
                 st.warning("Please upload valid Power BI zip file.")
         except Exception as e:
-            st.warning(f"Error in handling zip file : {e}")
-        #logger.debug("Report = \n ----------------- \n",report,"\n -------------------------- \n")
-        #logger.debug("Semantic model = \n ----------------- \n",semantic_model,"\n -------------------------- \n")
-        #timestamp=datetime.now().strftime("%Y%m%d_%H%M%S")
-        image_bytes=""
+            st.warning(f"Error in handling the Power BI project : {e}")
+        # Parsed once here, both the ER diagram and the prompt are built from this model. See tmdl_parser.py
+        with span("tmdl_parse"):
+            model=parse_tmdl(semantic_model)
+        # Read once here too, the nested visual configs are only decoded when the prompts need them. See report_layout.py
+        layout=ReportLayout({})
         try:
-            image_bytes=ERDiagramFromTMDL(semantic_model).generate_er_diagram()
+            with span("report_layout",report_bytes=len(report)):
+                layout=ReportLayout.from_json(report)
+            if logger.isEnabledFor(logging.DEBUG): # the inventory walks every visual, only build it when it's logged
+                logger.debug(f"Visual inventory :\n{layout.describe_inventory()}")
+        except ValueError as e:
+            st.warning(f"Error reading report.json : {e}")
+        er_diagram=None
+        try:
+            # Only the layout and a low dpi preview are made here, the full resolution PNG is drawn from the same layout when it's downloaded. See tmdl_to_er.py
+            if self.submit_er_diagram is not None:
+                self.submit_er_diagram(layout_with_preview,model) # see background_render.py, er_diagram is filled in the upload cache once done
+            else:
+                er_diagram=layout_with_preview(model)
         except Exception as e:
+            er_diagram=None
             st.warning(f"ER diagram was not able to generate at the moment. Please try again after sometime. Error : {e}")
         logger.debug(f"Report = {len(report)} and Sem_model = {len(semantic_model)}")
-        return [report,semantic_model,image_bytes]
+        return PowerBIFileContents(report,semantic_model,model,er_diagram,layout)
+class PowerBIFolderProcessor(PowerBIProcessor):
+    def __init__(self,path,submit_er_diagram=None):
+        """ path is a .pbip file, a folder holding one, or a .Report folder (batch mode and servers, the app itself takes zip uploads)."""
+        super().__init__(None,submit_er_diagram)
+        self.path=path
+    def ingest(self):
+        """ Reads the project in place, memory-mapping report.json, with no zip round trip. See pbip_ingestion.py"""
+        return ingest_powerbi_folder(self.path)
 class FileProcessorFactory(ABC):
     @staticmethod
     def get_file_processor(file_type,*args)->FileProcessor:
@@ -67,6 +101,9 @@ class FileProcessorFactory(ABC):
         if file_type == "Power BI":
             logger.debug("Returned PowerBIProcessor from factory")
             return PowerBIProcessor(*args)
+        elif file_type == "Power BI folder":
+            logger.debug("Returned PowerBIFolderProcessor from factory")
+            return PowerBIFolderProcessor(*args)
         #elif file_type == "pdf":
         #    return PDFProcessor(*args)
         #elif file_type == "csv":
@@ -77,18 +114,49 @@ class SetContext(ABC):
     @abstractmethod
     def set_context(self):
         pass
+    def set_section_contexts(self):
+        """ Prompts for generating the documentation section by section (see section_engine.py). File types that don't split their documentation get one section."""
+        return [Section("documentation","Documentation",self.set_context())]
+    def needs_map_reduce(self):
+        """ Whether the file is too large to be documented well from one prompt (see map_reduce.py)."""
+        return False
+    def set_map_contexts(self):
+        """ (map sections, other sections) of the map-reduce generation. File types that don't map-reduce have no map sections."""
+        return [],[]
+    def set_reduce_context(self,summaries):
+        """ Prompt of the reduce request, from the summaries of the map sections."""
+        return self.set_context()
+    def set_incremental_contexts(self):
+        """ Sections of the incremental mode (see incremental.py), as fine grained as the file type allows."""
+        return self.set_section_contexts()
+    def source_hashes(self):
+        """ {source file: hash} diffed against the previous generation in the incremental mode."""
+        return {}
 class PowerBIContext(SetContext):
-    def __init__(self,file_contents,user_context):
-        self.report=file_contents[0]
-        self.semantic_model=file_contents[1]
+    def __init__(self,file_contents,user_context,token_budget=DEFAULT_TOKEN_BUDGET):
+        self.report=file_contents.report
+        self.layout=file_contents.layout
+        self.semantic_model=file_contents.model
+        self.tmdl_texts=file_contents.semantic_model
         self.user_context=user_context
+        self.token_budget=token_budget
+        self._digest=None
+    @property
+    def digest(self):
+        """ Digest of the report, made once per context and shared by all the prompts."""
+        if self._digest is None:
+            self._digest=digest_report(self.layout)
+        return self._digest
     def set_context(self):
         """ File-type specific prompts are set here along with the file contents"""
         logger.debug("Set system prompt and user prompt")
+        # Raw report.json is mostly formatting, so a digest of it and a schema of the semantic model are sent instead, within token_budget tokens. See prompt_compaction.py
+        compacted=compact_context(self.digest,self.semantic_model,self.token_budget)
+        logger.debug(f"Tokens of report digest = {compacted.report_tokens}, tokens of semantic model = {compacted.semantic_model_tokens}")
         system_prompt=f"""
             You are a PowerBI report specialist working on converting a report to documentation.
-            Attached is the data from which you have to extract and make documentation for : {self.report}
-            Extract as much data as possible and ive comprehensive info and overview of the report. All of the corresponding files are in .tmdl format. Data attached : {self.semantic_model}
+            Attached is the data from which you have to extract and make documentation for. These are the pages, visuals, fields, filters and bookmarks of the report : {compacted.report}
+            Extract as much data as possible and ive comprehensive info and overview of the report. The semantic model (tables, columns, measures, sources and relationships) parsed from its .tmdl files is : {compacted.semantic_model}
             Make everything comprehensive, clear, avoid redundancy and finish everything under 1000 tokens. Give data dictionary in the form of a formatted table in markdown
             """
         if self.user_context != "":
@@ -100,6 +168,102 @@ class PowerBIContext(SetContext):
             Make it comprehensive and give more information about the report. 
         """
         return [system_prompt,user_prompt]
+    def set_section_contexts(self):
+        """ One prompt per documentation section, each with only the slice of the report/semantic model that section needs, within token_budget tokens."""
+        logger.debug("Set section prompts")
+        digest=self.digest
+        model=self.semantic_model
+        budget=self.token_budget
+        report_overview=fit_to_budget([lambda:describe_report(digest,PAGE_FIELDS),lambda:describe_report(digest,PAGE_NAMES)],budget//2)
+        tables_overview=fit_to_budget([lambda:describe_semantic_model(model,NO_EXPRESSIONS),lambda:describe_semantic_model(model,NAMES_ONLY)],budget//2)
+        slices={
+            "overview":("Overview",
+                "Give a comprehensive overview of the report : its purpose, audience, the pages and what they show, and the main metrics.",
+                f"Report pages and fields : {report_overview}\nSemantic model tables : {tables_overview}"),
+            "key_contacts":("Key Contacts",
+                "List the key contacts (owners, developers, data stewards) as a markdown table with Role, Name and Contact. Use the user's context if it has any, otherwise leave placeholders to be filled in.",
+                f"Report pages : {describe_report(digest,PAGE_NAMES)}"),
+            "data_flow":("Data Flow",
+                "Describe how data flows from the sources (databases, queries, parameters) through the semantic model tables and relationships into the report.",
+                fit_to_budget([lambda:describe_data_flow(model,FULL),lambda:describe_data_flow(model,NO_SOURCES)],budget)),
+            "data_explorer":("Data Explorer",
+                "Describe every page of the report : its visuals, what each shows, the slicers and filters available, and the bookmarks.",
+                fit_to_budget([lambda:describe_report(digest,VISUALS),lambda:describe_report(digest,PAGE_FIELDS),lambda:describe_report(digest,PAGE_NAMES)],budget)),
+            "data_dictionary":("Data Dictionary",
+                "Give the data dictionary as a formatted markdown table with Table, Column/Measure, Data Type and Description. Explain measures from their DAX.",
+                fit_to_budget([lambda:describe_semantic_model(model,NO_SOURCES),lambda:describe_semantic_model(model,SHORT_EXPRESSIONS),lambda:describe_semantic_model(model,NO_EXPRESSIONS),lambda:describe_semantic_model(model,NAMES_ONLY)],budget)),
+        }
+        sections=[]
+        for key,(title,instructions,data) in slices.items():
+            system_prompt=f"""
+            You are a PowerBI report specialist writing one section of the documentation of a Power BI report.
+            Write only the content of the "{title}" section in markdown, without the section heading. {instructions}
+            Data attached : {data}
+            Make it clear and avoid redundancy."""
+            if self.user_context != "":
+                system_prompt+=f"""
+                    Also make sure you take into account the attached information which the user has given as context : {self.user_context}"""
+            user_prompt=f"""
+            Generate the {title} section of the documentation of this Power BI report.
+        """
+            sections.append(Section(key,title,[system_prompt,user_prompt]))
+        return sections
+    def needs_map_reduce(self):
+        """ The schema alone, without sources, doesn't fit token_budget."""
+        return count_tokens(describe_semantic_model(self.semantic_model,NO_SOURCES))>self.token_budget
+    def set_map_contexts(self):
+        """ One data dictionary prompt per chunk of tables, plus the key contacts and data explorer sections which don't need the semantic model."""
+        logger.debug("Set map prompts")
+        sections=[self._dictionary_section(f"map_{i}",tables,schema) for i,(tables,schema) in enumerate(chunk_tables(self.semantic_model))]
+        others=[section for section in self.set_section_contexts() if section.key in ("key_contacts","data_explorer")]
+        return sections,others
+    def _dictionary_section(self,key,tables,schema,summary=True):
+        """ Data dictionary rows of some tables, followed by a summary of them for the reduce prompt if summary."""
+        system_prompt=f"""
+            You are a PowerBI report specialist writing part of the data dictionary of a Power BI report. These are some of the tables of its semantic model : {schema}
+            Write one markdown table row per column and measure of these tables, in the form | Table | Column/Measure | Data Type | Description |, without a header row. Explain measures from their DAX."""
+        if summary:
+            system_prompt+=f"""
+            After the rows, write a line with only {SUMMARY_MARKER} and then 2 or 3 sentences summarizing what these tables hold, their grain, their sources and their key measures."""
+        if self.user_context != "":
+            system_prompt+=f"""
+                    Also make sure you take into account the attached information which the user has given as context : {self.user_context}"""
+        user_prompt=f"""
+            Generate the data dictionary rows of the tables {', '.join(tables)}.
+        """
+        return Section(key,f"Data Dictionary ({', '.join(tables)})",[system_prompt,user_prompt],MAP_MAX_TOKENS)
+    def set_incremental_contexts(self):
+        """ The sections other than the data dictionary, then one data dictionary section per table, so a changed table only regenerates its own rows."""
+        sections=[section for section in self.set_section_contexts() if section.key!="data_dictionary"]
+        for table in self.semantic_model.tables:
+            sections.append(self._dictionary_section(TABLE_PREFIX+table.name,[table.name],table_schema(table),summary=False))
+        return sections
+    def source_hashes(self):
+        """ report.json and every .tmdl file (by table name)."""
+        return {"report.json":text_hash(self.report),**tmdl_hashes(self.tmdl_texts)}
+    def set_reduce_context(self,summaries):
+        """ Overview and data flow from the per-chunk summaries instead of the whole schema."""
+        logger.debug(f"Set reduce prompt from {len(summaries)} chunk summaries")
+        digest=self.digest
+        model=self.semantic_model
+        budget=self.token_budget
+        report_overview=fit_to_budget([lambda:describe_report(digest,PAGE_FIELDS),lambda:describe_report(digest,PAGE_NAMES)],budget//4)
+        data_flow=fit_to_budget([lambda:describe_data_flow(model,FULL),lambda:describe_data_flow(model,NO_SOURCES)],budget//2)
+        tables_summary='\n'.join(f"- {summary}" for summary in summaries)
+        system_prompt=f"""
+            You are a PowerBI report specialist writing the documentation of a Power BI report.
+            Write two markdown sections, "## Overview" and "## Data Flow". The overview gives the purpose, audience, pages and main metrics of the report. The data flow describes how data flows from the sources through the semantic model tables and relationships into the report.
+            Report pages and fields : {report_overview}
+            Summaries of the semantic model tables : {tables_summary}
+            Sources and relationships : {data_flow}
+            Make it clear and avoid redundancy."""
+        if self.user_context != "":
+            system_prompt+=f"""
+                    Also make sure you take into account the attached information which the user has given as context : {self.user_context}"""
+        user_prompt="""
+            Generate the overview and data flow sections of the documentation of this Power BI report.
+        """
+        return [system_prompt,user_prompt]
 class SetContextFactory(ABC):
     @staticmethod
     def get_context(file_type,*args)->SetContext:
@@ -114,14 +278,18 @@ class SetContextFactory(ABC):
         else:
             raise ValueError("We don't support this file type yet.")
 class CompletionModel:
-    def __init__(self,prompt):
+    def __init__(self,prompt,max_tokens=2000,warn=st.warning,use_cache=True):
         self.system_prompt=prompt[0]
         self.user_prompt=prompt[1]
+        self.max_tokens=max_tokens
+        self.warn=warn # how errors are reported, st.warning unless generation runs off the script thread (section_engine)
+        self.use_cache=use_cache # False asks the model again even if the same request was answered before
     def generate_documentation(self):
         """ Responsible for sending request api with the given system prompt and receiving response in chunks and sending it as a stream"""
-        logger.debug(f"System prompt length = {len(self.system_prompt)}")
-        logger.debug(f"User prompt length = {len(self.user_prompt)}")
-        logger.debug(f"Total length = {len(self.system_prompt)+len(self.user_prompt)}")
+        system_tokens=count_tokens(self.system_prompt)
+        user_tokens=count_tokens(self.user_prompt)
+        logger.debug(f"Prompt tokens = {system_tokens+user_tokens} (system {system_tokens}, user {user_tokens})")
+        count("reportiq_prompt_tokens_total",system_tokens+user_tokens,help="Prompt tokens sent to the completion model")
         messages =[
             {
                 "role": "system",
@@ -132,14 +300,9 @@ class CompletionModel:
                 "content": self.user_prompt
             }
         ]
-        headers = {
-            "Content-Type": "application/json",
-            "api-key": os.getenv('COMPLETION_MODEL_API_KEY'),
-            "User-agent":"Your agent v2.0"
-        }
         data = {
             "messages": messages,
-            "max_tokens": 2000,# Increased for more detailed answers
+            "max_tokens": self.max_tokens,# Increased for more detailed answers
             "temperature": 0.2,  # Lower for more focused answers
             "top_p": 0.9,
             "frequency_penalty": 0.1,  # Reduce repetition
@@ -149,18 +312,33 @@ class CompletionModel:
                 "include_usage" : True
             }
         }
+        client=get_completion_client()
+        # Same endpoint, parameters and prompts as an answer in the response cache : replay it instead of asking the model again. See response_cache.py
+        cache=get_response_cache()
+        cache_key=cache.key(client.endpoint,data) if cache is not None else None
+        if cache is not None and self.use_cache:
+            cached=cache.get(cache_key)
+            if cached is not None:
+                logger.debug(f"Replaying cached answer {cache_key}")
+                count("reportiq_response_cache_hits_total",help="Answers replayed from the response cache")
+                yield from cached
+                return
+        # Time to first token, duration and tokens/sec of the live stream. See instrumentation.py
+        yield from instrument_stream(self._stream(client,data,cache,cache_key),"generation",count_tokens)
+    def _stream(self,client,data,cache,cache_key):
+        """ Deltas of the model's answer to data, stored in the response cache if the stream completes."""
+        deltas=[] # what was streamed, stored in the cache if the stream completes
+        complete=False # only once the model said it's done ([DONE] or a finish_reason) : a connection dropped mid-answer also just ends the byte stream
         try:
-            response = requests.post(os.getenv('COMPLETION_MODEL_ENDPOINT'), headers=headers, json=data, stream=True)
-            response.raise_for_status()
-        except Exception as e:
-            st.warning(f"Error in response from model : {e}")
-            if(str(e)[0:3]=="400"):
-                st.warning(f" {response.json()['error']['message']}") 
-        for chunk in response.iter_content(chunk_size=None): # read from here(https://requests.readthedocs.io/en/latest/_modules/requests/models/#Response.iter_content) that iter_content iterates over the response received till now in the chunk size given in the parameter. since moel is set in stream mode,we set chunk size to none (https://requests.readthedocs.io/en/latest/api/#requests.Response:~:text=When%20stream%3DTrue%20is%20set%20on%20the%20request%2C%20this%20avoids%20reading%20the%20content%20at%20once%20into%20memory%20for%20large%20responses.%20The%20chunk%20size%20is%20the%20number%20of%20bytes%20it%20should%20read%20into%20memory.%20This%20is%20not%20necessarily%20the%20length%20of%20each%20item%20returned%20as%20decoding%20can%20take%20place.) 
-            if chunk:
-                try:
-                    chunk_str = chunk.decode('utf-8') 
-                    #logger.debug("Chunk string = \n---------------------------------\n",chunk_str,"\n--------------------------\n")
+            # Shared client : keep-alive connection pool, connect/read timeouts and retries with backoff on 429/5xx. See completion_client.py
+            response = client.post_stream(data)
+        except CompletionRequestError as e:
+            self.warn(f"Error in response from model : {e.message}")
+            return
+        with response: # returns the connection to the pool once the stream is read (or the generator is closed)
+            try:
+                # Events are decoded incrementally, so an SSE line or a multi-byte character split across two chunks is handled, and every delta is yielded as soon as its event is complete. See sse.py
+                for data in iter_sse_data(response.iter_content(chunk_size=None),include_done=True): # read from here(https://requests.readthedocs.io/en/latest/_modules/requests/models/#Response.iter_content) that iter_content iterates over the response received till now in the chunk size given in the parameter. since moel is set in stream mode,we set chunk size to none (https://requests.readthedocs.io/en/latest/api/#requests.Response:~:text=When%20stream%3DTrue%20is%20set%20on%20the%20request%2C%20this%20avoids%20reading%20the%20content%20at%20once%20into%20memory%20for%20large%20responses.%20The%20chunk%20size%20is%20the%20number%20of%20bytes%20it%20should%20read%20into%20memory.%20This%20is%20not%20necessarily%20the%20length%20of%20each%20item%20returned%20as%20decoding%20can%20take%20place.)
                     # this is example of a chunk string:
                     # {
                     #     "data": {
@@ -200,21 +378,25 @@ class CompletionModel:
                     #         "usage": null
                     #     }
                     #     }
-                    for line in chunk_str.split('\n'):
-                            if line.startswith('data: '):
-                                json_data = line[len('data: '):]
-                                if json_data.strip() == '[DONE]': # tHIS IS LIKE EOF FOR STREAM
-                                    break
-                                parsed_data = json.loads(json_data) 
-                                if 'choices' in parsed_data and len(parsed_data['choices']) > 0:
-                                    delta = parsed_data['choices'][0].get('delta', {}) 
-                                    if 'content' in delta:
-                                        yield delta['content'] # Yield the streamed content
-                                        time.sleep(0.02)
-                except json.JSONDecodeError:
-                    st.warning(f"Error decoding JSON from chunk: {chunk_str}") 
-                except Exception as e:
-                    st.warning(f"Error occure while streaming response from model : {e}") 
+                    if data==DONE:
+                        complete=True
+                        break
+                    try:
+                        content,finish_reason=chat_delta(data)
+                    except ValueError: # invalid JSON, whatever the JSON backend
+                        self.warn(f"Error decoding JSON from chunk: {data}")
+                        deltas=None # don't cache an answer with missing parts
+                        continue
+                    if finish_reason is not None:
+                        complete=True
+                    if content:
+                        if deltas is not None:
+                            deltas.append(content)
+                        yield content # Yield the streamed content
+            except Exception as e:
+                self.warn(f"Error occure while streaming response from model : {e}")
+        if complete and deltas and cache is not None:
+            cache.put(cache_key,deltas)
 def info_and_uploader(option):
     """ Sets uploading instructions and uploader info based on file type."""
     #info=""
@@ -236,8 +418,183 @@ def info_and_uploader(option):
         uploader_text="""Upload the selected file"""
     return [info,uploader_text]
 
+def generate_by_section(sections,use_cache=True,docx=None):
+    """ Streams every section into its own placeholder while they are generated concurrently, and returns the assembled markdown.
+    The assembled markdown is also fed to docx (a DocxBuilder) as it streams."""
+    assembly=StreamingAssembly(sections,docx.feed) if docx is not None else None
+    placeholders={}
+    texts={}
+    for section in sections:
+        placeholders[section.key]=st.empty()
+        texts[section.key]=""
+    warnings=[] # sections stream on worker threads, so their errors are shown from here once they're done
+    def on_delta(section,delta):
+        texts[section.key]+=delta
+        placeholders[section.key].markdown(f"## {section.title}\n\n{texts[section.key]}")
+        if assembly is not None:
+            assembly.on_delta(section,delta)
+    engine=SectionEngine(lambda section:CompletionModel(section.prompt,section.max_tokens,warn=warnings.append,use_cache=use_cache).generate_documentation(),render_interval=STREAM_RENDER_INTERVAL)
+    results=engine.generate(sections,on_delta,on_done=assembly.on_done if assembly is not None else None)
+    for warning in warnings:
+        st.warning(warning)
+    return assemble(sections,results)
+
+def generate_map_reduce(context,use_cache=True,docx=None):
+    """ Map : data dictionary rows of every chunk of tables (and the sections that don't need the semantic model) concurrently, with a progress bar.
+    Reduce : streams the overview and data flow written from the chunk summaries (into docx too). Returns the assembled markdown."""
+    map_sections,other_sections=context.set_map_contexts()
+    sections=map_sections+other_sections
+    progress=st.progress(0.0,text=f"Documenting {len(map_sections)} chunks of tables")
+    finished=[]
+    def on_done(section,text):
+        finished.append(section.key)
+        progress.progress(len(finished)/len(sections),text=f"{len(finished)}/{len(sections)} done : {section.title}")
+    warnings=[]
+    engine=SectionEngine(lambda section:CompletionModel(section.prompt,section.max_tokens,warn=warnings.append,use_cache=use_cache).generate_documentation())
+    results=engine.generate(sections,on_done=on_done)
+    progress.empty()
+    for warning in warnings:
+        st.warning(warning)
+    rows,summaries=collect_map_results(map_sections,results)
+    reduce_stream=CompletionModel(context.set_reduce_context(summaries),use_cache=use_cache).generate_documentation()
+    reduce_text=st.write_stream(throttle_stream(docx.stream(reduce_stream) if docx is not None else reduce_stream,STREAM_RENDER_INTERVAL))
+    rest=assemble_map_reduce("",rows,other_sections,results)
+    st.markdown(rest)
+    if docx is not None and rest:
+        docx.feed("\n\n"+rest)
+    return assemble_map_reduce(reduce_text,rows,other_sections,results)
+
+def generate_incremental(context,doc_id,use_cache=True,docx=None):
+    """ Generates only the sections whose prompt changed since the last generation of doc_id, with a progress bar, and splices them
+    with the unchanged ones kept from then. Returns the assembled markdown."""
+    store=get_document_store()
+    previous=store.get(doc_id) if store is not None else None
+    sections=context.set_incremental_contexts()
+    sources=context.source_hashes()
+    other_report=previous is not None and usable_state(previous,sources) is None
+    previous=usable_state(previous,sources)
+    reused,regenerate=plan_sections(sections,previous)
+    if other_report:
+        st.info(f"The earlier documentation under this name is of a different semantic model, generating all {len(sections)} sections.")
+    elif previous is None:
+        st.info(f"No earlier documentation of this report, generating all {len(sections)} sections.")
+    else:
+        st.info(f"Since the last documentation of this report : {diff_hashes(previous.get('sources',{}),sources).describe()}. Regenerating {len(regenerate)} of {len(sections)} sections.")
+    results=dict(reused)
+    if regenerate:
+        progress=st.progress(0.0,text=f"Documenting {len(regenerate)} sections")
+        finished=[]
+        def on_done(section,text):
+            finished.append(section.key)
+            progress.progress(len(finished)/len(regenerate),text=f"{len(finished)}/{len(regenerate)} done : {section.title}")
+        warnings=[]
+        engine=SectionEngine(lambda section:CompletionModel(section.prompt,section.max_tokens,warn=warnings.append,use_cache=use_cache).generate_documentation())
+        results.update(engine.generate(regenerate,on_done=on_done))
+        progress.empty()
+        for warning in warnings:
+            st.warning(warning)
+    if store is not None:
+        store.put(doc_id,document_state(sources,sections,results))
+    documentation=assemble_incremental(sections,results)
+    st.markdown(documentation)
+    if docx is not None: # the reused sections only exist once everything is done
+        docx.feed(documentation)
+    return documentation
+
+@st.cache_resource
+def get_background_renderer():
+    """ One bounded pool per server process for ER diagram layouts. Set REPORTIQ_RENDER_WORKERS to change its size."""
+    return BackgroundRenderer()
+
+def submit_er_layout(cache_key):
+    """ submit_er_diagram(fn,*args) of the upload cache_key : runs fn on the background renderer and stores the ER diagram it returns in the upload cache."""
+    def store_er_diagram(er_diagram):
+        cached=get_upload_cache().get(cache_key)
+        if cached is not None:
+            get_upload_cache().put(cache_key,cached._replace(er_diagram=er_diagram))
+    return lambda fn,*args:get_background_renderer().submit(cache_key,fn,*args,on_done=store_er_diagram)
+
+def relayout_er_diagram(file_contents,cache_key):
+    """ Lays the ER diagram of an upload from the upload cache out again if it has none and none is pending : its layout failed, its future
+    was trimmed from the renderer, or the entry came from the disk tier after a restart. Without this such an upload never gets an ER diagram."""
+    if file_contents.er_diagram is not None or not file_contents.semantic_model:
+        return
+    cached=get_upload_cache().get(cache_key)
+    if cached is not None and cached.er_diagram is not None:
+        return
+    future=get_background_renderer().get(cache_key)
+    if future is None or (future.done() and future.exception() is not None):
+        logger.debug(f"Laying the ER diagram of {cache_key} out again")
+        submit_er_layout(cache_key)(layout_with_preview,file_contents.model)
+
+def resolve_er_diagram(file_contents,cache_key,wait=False):
+    """ ER diagram of the upload : from its contents, from the upload cache once the background layout stored it there,
+    or from the background layout (waiting for it if wait). None if it's not ready or failed."""
+    if file_contents.er_diagram is not None:
+        return file_contents.er_diagram
+    cached=get_upload_cache().get(cache_key)
+    if cached is not None and cached.er_diagram is not None:
+        return cached.er_diagram
+    future=get_background_renderer().get(cache_key)
+    if future is None and wait: # e.g. trimmed from the renderer since this rerun started
+        relayout_er_diagram(file_contents,cache_key)
+        future=get_background_renderer().get(cache_key)
+    if future is None or (not wait and not future.done()):
+        return None
+    try:
+        er_diagram=future.result()
+    except Exception as e:
+        st.warning(f"ER diagram was not able to generate at the moment. Please try again after sometime. Error : {e}")
+        return None
+    if cached is not None: # the layout finished before the upload was cached, so on_done had nothing to update
+        get_upload_cache().put(cache_key,cached._replace(er_diagram=er_diagram))
+    return er_diagram
+
+def er_diagram_preview(file_contents,cache_key):
+    """ Preview of the ER diagram, or a progress message while it's laid out in the background."""
+    er_diagram=resolve_er_diagram(file_contents,cache_key)
+    if er_diagram is not None:
+        with st.expander("ER diagram preview"):
+            st.image(er_diagram.png(PREVIEW_DPI))
+        return
+    future=get_background_renderer().get(cache_key)
+    if future is not None and not future.done():
+        st.caption("Laying out the ER diagram in the background...")
+
+@st.cache_resource
+def get_upload_cache():
+    """ One cache per server process, shared by all sessions. Set REPORTIQ_CACHE_DIR to also keep processed uploads on disk."""
+    return ProcessedUploadCache(disk_dir=os.getenv('REPORTIQ_CACHE_DIR'))
+
+@st.fragment
+def export_downloads(document):
+    """ A download button per export format (see exports.py). Formats that cost something to render (HTML, PDF, ER diagram, bundle)
+    are only rendered once asked for : their "Prepare" button reruns this fragment alone, not the app, so the documentation stays."""
+    columns=st.columns(4)
+    for i,export in enumerate(available_exports(document)):
+        with columns[i%4]:
+            if not (export.eager or is_rendered(document,export.key)) and not st.button(f"Prepare {export.label}",key=f"prepare_{export.key}",icon=export.icon,use_container_width=True):
+                continue
+            try:
+                with st.spinner(f"Rendering {export.label}..",show_time=True),span("export",format=export.key):
+                    data=render_export(document,export.key)
+            except Exception as e:
+                st.warning(f"Error generating {export.label} file : {e}")
+                continue
+            st.download_button(
+                label=f"Download {export.label}",
+                data=data,
+                file_name=file_name(document,export.key),
+                mime=export.mime,
+                icon=export.icon,
+                use_container_width=True,
+                key=f"download_{export.key}",
+                on_click="ignore" # This is so the whole page doesn't refresh when clicked on the download button, i.e to prevent rerunning the app. See here : https://docs.streamlit.io/develop/api-reference/widgets/st.download_button#:~:text=%22ignore%22%3A%20The%20user%20downloads%20the%20file%20and%20the%20app%20doesn%27t%20rerun.%20No%20callback%20function%20is%20called.
+            )
+
 def main():
     load_dotenv()
+    start_metrics_server() # only if REPORTIQ_METRICS_PORT is set, once per process
     st.title("Scriptex - Documentation Generator")
     st.info("""This tool can be used to generate documentation for any kind of document/report/pdf,etc.
             Just select the input file type, upload the files in the specified way, and 
@@ -254,8 +611,25 @@ def main():
     if file is not None:
         logger.debug(f"Sent to FileProcessor factory and process method")
         #First send the file to factory to get the processor and then process it to get the contents. Abstraction implemented.
-        file_contents=FileProcessorFactory.get_file_processor(option,file).process()
+        # Streamlit reruns main() on every widget interaction, so processed uploads are cached by the hash of their bytes. See upload_cache.py
+        upload_cache=get_upload_cache()
+        cache_key=upload_cache.key(option,file.getvalue())
+        file_contents=upload_cache.get(cache_key)
+        if file_contents is None:
+            # The ER diagram is laid out on a worker pool while the user sets the context and generates. Once done it is stored in the upload cache. See background_render.py
+            # Sampled when REPORTIQ_PROFILE is set. See instrumentation.py
+            with profiled("upload"):
+                file_contents=FileProcessorFactory.get_file_processor(option,file,submit_er_layout(cache_key)).process()
+            if file_contents.report and file_contents.semantic_model: # don't keep failed uploads around
+                upload_cache.put(cache_key,file_contents)
+        else:
+            # a cached upload without an ER diagram (failed, trimmed or restarted) is laid out again
+            relayout_er_diagram(file_contents,cache_key)
         logger.debug(f"Received from FileProcessor factory and process method")
+        # Polls every 2 seconds (only this fragment reruns) until the background layout is done, then shows the preview
+        future=get_background_renderer().get(cache_key)
+        pending=future is not None and not future.done()
+        st.fragment(er_diagram_preview,run_every=2 if pending else None)(file_contents,cache_key)
         user_context=""
         documentation=""
 
@@ -268,62 +642,53 @@ def main():
             logger.debug("Custom context given by user !")
         logger.debug(f"Sending to context factory")
         # Sending these file contents along with the optional user added context to factory gives the context getter which then sets context and returns set of prompts according to file type. Also abstraction implemented.
-        prompt=SetContextFactory.get_context(option,file_contents,user_context).set_context()
+        context=SetContextFactory.get_context(option,file_contents,user_context)
         logger.debug(f"Received from context factory")
 
+        # Section by section runs one request per documentation section concurrently, which is much faster on large reports. See section_engine.py
+        # Map-reduce splits the data dictionary into chunks of tables for models too large for one prompt, and is preselected for them. See map_reduce.py
+        # Incremental only regenerates the sections affected by what changed since the report was last documented. See incremental.py
+        modes=("Section by section","Map-reduce (very large models)","Single request","Incremental (only what changed)")
+        # Counting the tokens of the schema takes a while on large models, so it's done once per upload and context, not on every rerun
+        map_reduce_key=(cache_key,user_context)
+        if st.session_state.get("needs_map_reduce",(None,))[0]!=map_reduce_key:
+            st.session_state["needs_map_reduce"]=(map_reduce_key,context.needs_map_reduce())
+        mode=st.radio("Generation mode",modes,index=1 if st.session_state["needs_map_reduce"][1] else 0,horizontal=True)
+        # Identical requests (same report, context and mode) are answered from the response cache unless this is off. See response_cache.py
+        use_cache=st.toggle("Reuse previous answers for identical requests",value=True)
+
         if st.button("Generate Documentation"):
             with st.spinner("Generating...",show_time=True):
                 # This final set of prompts is sent to completion model which then gives a model object, further to be used to generate documentation 
+                # The prompt is only built here, not on every rerun (widget interaction) of the page
+                with span("prompt"):
+                    prompt=context.set_context()
                 logger.debug(f"Sending to completion model")
-                model=CompletionModel(prompt)
+                model=CompletionModel(prompt,use_cache=use_cache)
                 logger.debug(f"Initialized completionModel object ")
                 # Kept on joining to enable download functionality as markdown, at the end
                 if documentation=="":
                     logger.debug(f"Documentation starts generating ")
-                documentation=documentation.join(st.write_stream(model.generate_documentation))
+                # The DOCX is built from the deltas while they stream, so it's ready with the last one instead of converted afterwards. See markdown_to_docx.DocxBuilder
+                docx_builder=DocxBuilder()
+                # name of the download files and of the report in the incremental store (the same as batch.py gives it)
+                filename=report_name(file.name)
+                with profiled("generation"),span("documentation",mode=mode):
+                    if mode=="Section by section":
+                        documentation=generate_by_section(context.set_section_contexts(),use_cache,docx_builder)
+                    elif mode=="Map-reduce (very large models)":
+                        documentation=generate_map_reduce(context,use_cache,docx_builder)
+                    elif mode=="Incremental (only what changed)":
+                        documentation=generate_incremental(context,document_id(option,filename),use_cache,docx_builder)
+                    else:
+                        documentation=documentation.join(st.write_stream(throttle_stream(docx_builder.stream(model.generate_documentation()),STREAM_RENDER_INTERVAL)))
                 if documentation!="":
                     st.success("Documentation generated successfully!!")
                     logger.debug("Documentation generated successfully")
-                    col1,col2,col3=st.columns(3)
-                    filename=file.name.split(".Report.zip")[0].split(".SemanticModel.zip")[0].split(".zip")[0]
-                    try:
-                        with col1:
-                            st.download_button(
-                        label=f" Download as Markdown",
-                        data=documentation,
-                        file_name=f"{filename}_Documentation.md",
-                        icon=":material/markdown:",
-                        use_container_width=True,
-                        on_click="ignore" # This is so the whole page doesn't refresh when clicked on the download button, i.e to prevent rerunning the app. See here : https://docs.streamlit.io/develop/api-reference/widgets/st.download_button#:~:text=%22ignore%22%3A%20The%20user%20downloads%20the%20file%20and%20the%20app%20doesn%27t%20rerun.%20No%20callback%20function%20is%20called.
-                        )
-                    except Exception as e:
-                        st.warning(f"Error generating markdown text file : {e}")
-                    try:
-                        with st.spinner("Generating docx..", show_time=True): 
-                            docx_documentation=markdown_to_docx(documentation)
-                            with col2:
-                                st.download_button(
-                        label=f"Download as DOCX",
-                        data=docx_documentation,
-                        file_name=f"{filename}_Documentation.docx",
-                        icon=":material/docs:",
-                        use_container_width=True,
-                        on_click="ignore" # This is so the whole page doesn't refresh when clicked on the download button, i.e to prevent rerunning the app. See here : https://docs.streamlit.io/develop/api-reference/widgets/st.download_button#:~:text=%22ignore%22%3A%20The%20user%20downloads%20the%20file%20and%20the%20app%20doesn%27t%20rerun.%20No%20callback%20function%20is%20called.
-                        ) 
-                    except Exception as e:
-                        st.warning(f"Error generating docx file : {e}")
-                    try:
-                        with col3:
-                            st.download_button(
-                                label=f"Download ER Diagram",
-                                data=file_contents[2],
-                                file_name=f"{filename}_ERDiagram.png",
-                                icon=":material/account_tree:",
-                                use_container_width=True,
-                                on_click="ignore",
-                                mime="image/png"
-                            )
-                    except Exception as e:
-                        st.warning(f"Error generating ER diagram : {e}")
+                    with span("docx",markdown_bytes=len(documentation)): # only the last block and the save are left
+                        docx_documentation=docx_builder.close()
+                    with st.spinner("Waiting for the ER diagram..", show_time=True):
+                        er_diagram=resolve_er_diagram(file_contents,cache_key,wait=True)
+                    export_downloads(ExportDocument(documentation,filename,docx_documentation.getvalue() if docx_documentation is not None else None,er_diagram))
 if __name__=="__main__":
     main()
@@ -0,0 +1,51 @@
+import os
+import threading
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+logger=logging.getLogger(__name__)
+# Renders (ER diagram layouts) off the Streamlit script thread, so an upload is usable as soon as it's parsed and prompts can be built and
+# documentation generated while Graphviz is still laying the diagram out. Graphviz runs as a subprocess, so threads are enough and the
+# pool is bounded so a burst of uploads can't start an unbounded number of layouts.
+# Futures are kept by key (the upload cache key) because Streamlit reruns the script : later reruns find the pending future instead of
+# submitting again. Finished results go to on_done (which stores them in the upload cache), so only plain results ever end up in the cache.
+# The last max_finished finished futures are kept too, for a rerun that read the cache just before on_done stored the result.
+
+DEFAULT_WORKERS=int(os.getenv('REPORTIQ_RENDER_WORKERS','2'))
+
+class BackgroundRenderer:
+    def __init__(self,max_workers=DEFAULT_WORKERS,max_finished=16):
+        self._executor=ThreadPoolExecutor(max_workers=max(1,max_workers),thread_name_prefix="render")
+        self.max_finished=max_finished
+        self._futures=OrderedDict() # key -> future, oldest first
+        self._lock=threading.Lock()
+
+    def submit(self,key,fn,*args,on_done=None):
+        """ Runs fn(*args) in the pool unless key is already pending, and returns its future. on_done(result) is called on success."""
+        with self._lock:
+            future=self._futures.get(key)
+            if future is not None and not (future.done() and future.exception() is not None):
+                return future
+            future=self._executor.submit(self._run,key,fn,args,on_done)
+            self._futures[key]=future
+            self._futures.move_to_end(key)
+            self._trim()
+            logger.debug(f"Submitted background render {key}")
+            return future
+
+    def _run(self,key,fn,args,on_done):
+        result=fn(*args)
+        if on_done is not None:
+            on_done(result)
+        logger.debug(f"Background render {key} done")
+        return result
+
+    def _trim(self):
+        finished=[key for key,future in self._futures.items() if future.done()]
+        for key in finished[:max(0,len(finished)-self.max_finished)]:
+            del self._futures[key]
+
+    def get(self,key):
+        """ Future of key if it's pending or among the last finished ones, or None."""
+        with self._lock:
+            return self._futures.get(key)
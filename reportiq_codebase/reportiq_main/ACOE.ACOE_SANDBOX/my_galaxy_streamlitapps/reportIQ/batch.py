@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from app import FileProcessorFactory,SetContextFactory,CompletionModel # also configures logging, see instrumentation.py
+from section_engine import Section,SectionEngine,assemble
+from map_reduce import collect_map_results,assemble_map_reduce
+from tmdl_to_er import ERDiagramFromTMDL,FULL_DPI
+from markdown_to_docx import markdown_to_docx
+from pbip_ingestion import resolve_pbip_project,plan_project_files
+from incremental import get_document_store,document_id,report_name,usable_state,plan_sections,assemble_incremental,document_state
+logger=logging.getLogger(__name__)
+# Headless batch mode : documents every Power BI project of a directory without the Streamlit UI, e.g. a whole workspace overnight.
+# Inputs are the zips users upload (.zip with the .Report and .SemanticModel folders, or a .Report.zip) and .pbip projects : a
+# <name>.Report folder (its .SemanticModel found from definition.pbir) or a folder holding a .pbip file. Projects are read in place
+# by PowerBIFolderProcessor, without zipping them first.
+# The app's own pieces do the work : FileProcessorFactory, SetContextFactory, CompletionModel, SectionEngine, ERDiagramFromTMDL
+# and markdown_to_docx.
+#   CPU stages (ingestion, parsing, prompts, ER layout and PNG, DOCX) run on a process pool of --workers processes
+#   LLM calls run on the asyncio loop through SectionEngine, at most --llm-concurrency requests at a time over all the reports
+# Every report gets <output>/<name>/ with <name>_Documentation.md, .docx and _ERDiagram.png, and batch.json written last with the
+# hash of its input and settings. Reruns skip the reports whose batch.json has the same hash, so an interrupted batch resumes where
+# it stopped, and a changed report (or --context/--mode) is documented again. Completed answers also stay in the response cache.
+#
+#   COMPLETION_MODEL_ENDPOINT=... python batch.py <input directory> --output docs [--workers 4] [--llm-concurrency 8] [--mode auto]
+
+FILE_TYPE="Power BI"
+MODES=("auto","sections","map-reduce","single","incremental")
+MANIFEST="batch.json"
+
+def find_inputs(directory):
+    """ (name, path) of every zip and .pbip project in directory, sorted by name."""
+    inputs=[]
+    for entry in sorted(os.listdir(directory)):
+        path=os.path.join(directory,entry)
+        if os.path.isfile(path) and entry.lower().endswith(".zip"):
+            # same name as the app gives the upload, so both share the incremental state of the report
+            inputs.append((report_name(entry),path))
+        elif os.path.isdir(path) and entry.endswith(".Report"):
+            inputs.append((entry[:-len(".Report")],path))
+        elif os.path.isdir(path) and any(name.endswith(".pbip") for name in os.listdir(path)):
+            inputs.append((entry,path))
+    return inputs
+
+def _input_files(path):
+    """ (name, file path) of the files an input is documented from : the zip, or the files of the project the folder processor reads."""
+    if os.path.isfile(path):
+        return [(os.path.basename(path),path)]
+    planned,_=plan_project_files(*resolve_pbip_project(path))
+    return [(os.path.relpath(file_path,path).replace(os.sep,'/'),file_path) for _,file_path,_ in planned]
+
+def input_hash(path,settings):
+    """ sha256 of the input's contents (file names and bytes, not timestamps) and of the settings that change the documentation."""
+    digest=hashlib.sha256(json.dumps(settings,sort_keys=True).encode('utf-8'))
+    for name,file_path in _input_files(path):
+        digest.update(name.encode('utf-8')+b'\0')
+        with open(file_path,'rb') as f:
+            for block in iter(lambda:f.read(1<<20),b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def is_done(output_dir,key):
+    """ Whether output_dir already has the outputs of the input with hash key."""
+    try:
+        with open(os.path.join(output_dir,MANIFEST),encoding='utf-8') as f:
+            manifest=json.load(f)
+    except (OSError,ValueError):
+        return False
+    return manifest.get("input_hash")==key and all(os.path.exists(os.path.join(output_dir,name)) for name in manifest.get("outputs",[]))
+
+class PreparedReport:
+    """ What the CPU stages hand to the generation : the context (with its report digest already made), the prompts and the ER diagram PNG."""
+    __slots__=('context','mode','sections','other_sections','er_diagram','er_error')
+    def __init__(self,context,mode,sections,other_sections,er_diagram,er_error):
+        self.context=context
+        self.mode=mode
+        self.sections=sections # map sections in map-reduce mode
+        self.other_sections=other_sections
+        self.er_diagram=er_diagram
+        self.er_error=er_error
+
+def prepare(path,user_context,mode,render_er):
+    """ Runs on the process pool : ingestion, parsing, prompts and the ER diagram of one input."""
+    # no submitter that runs the ER layout in the background : it's done below, at full resolution only
+    skip_er=lambda fn,*args:None
+    if os.path.isdir(path):
+        processor=FileProcessorFactory.get_file_processor("Power BI folder",path,skip_er)
+    else:
+        processor=FileProcessorFactory.get_file_processor(FILE_TYPE,path,skip_er) # ingest_powerbi_zip takes a path too
+    file_contents=processor.process()
+    if not file_contents.report or not file_contents.semantic_model:
+        raise ValueError("not a Power BI project with a report.json and .tmdl files")
+    context=SetContextFactory.get_context(FILE_TYPE,file_contents,user_context)
+    if mode=="auto":
+        mode="map-reduce" if context.needs_map_reduce() else "sections"
+    other_sections=[]
+    if mode=="sections":
+        sections=context.set_section_contexts()
+    elif mode=="map-reduce":
+        sections,other_sections=context.set_map_contexts()
+    elif mode=="incremental":
+        sections=context.set_incremental_contexts()
+    else:
+        sections=[Section("documentation","Documentation",context.set_context())]
+    er_diagram=er_error=None
+    if render_er:
+        try:
+            er_diagram=ERDiagramFromTMDL(file_contents.model).layout_diagram().png(FULL_DPI)
+        except Exception as e:
+            er_error=str(e)
+    return PreparedReport(context,mode,sections,other_sections,er_diagram,er_error)
+
+def docx_bytes(markdown):
+    """ Runs on the process pool."""
+    docx=markdown_to_docx(markdown)
+    return docx.getvalue() if docx is not None else None
+
+class BatchRunner:
+    def __init__(self,output,workers,llm_concurrency,mode,user_context,render_er,write_docx,use_cache):
+        self.output=output
+        self.workers=workers
+        self.mode=mode
+        self.user_context=user_context
+        self.render_er=render_er
+        self.write_docx=write_docx
+        self.use_cache=use_cache
+        # shared by the SectionEngines of all the reports, so the endpoint never sees more than llm_concurrency requests at a time
+        self.llm_slots=threading.BoundedSemaphore(max(1,llm_concurrency))
+        self.llm_concurrency=max(1,llm_concurrency)
+
+    def settings(self):
+        return {"mode":self.mode,"context":self.user_context,"er":self.render_er,"docx":self.write_docx}
+
+    def _stream(self,section,warnings):
+        """ Deltas of one section, holding one of the llm_slots while it streams."""
+        with self.llm_slots:
+            yield from CompletionModel(section.prompt,section.max_tokens,warn=warnings.append,use_cache=self.use_cache).generate_documentation()
+
+    async def _generate(self,name,prepared,warnings):
+        engine=SectionEngine(lambda section:self._stream(section,warnings),concurrency=self.llm_concurrency)
+        if prepared.mode=="incremental":
+            # only the sections whose prompt changed since the last run of this report, see incremental.py
+            store=get_document_store()
+            doc_id=document_id(FILE_TYPE,name)
+            sources=prepared.context.source_hashes()
+            reused,regenerate=plan_sections(prepared.sections,usable_state(store.get(doc_id) if store is not None else None,sources))
+            logger.info(f"{name} : regenerating {len(regenerate)} of {len(prepared.sections)} sections")
+            results={**reused,**await engine.generate_async(regenerate)}
+            if store is not None:
+                store.put(doc_id,document_state(sources,prepared.sections,results))
+            return assemble_incremental(prepared.sections,results)
+        if prepared.mode=="sections":
+            return assemble(prepared.sections,await engine.generate_async(prepared.sections))
+        if prepared.mode=="single":
+            return (await engine.generate_async(prepared.sections))["documentation"]
+        results=await engine.generate_async(prepared.sections+prepared.other_sections)
+        rows,summaries=collect_map_results(prepared.sections,results)
+        reduce=Section("reduce","Overview and Data Flow",prepared.context.set_reduce_context(summaries))
+        reduce_text=(await engine.generate_async([reduce]))["reduce"]
+        return assemble_map_reduce(reduce_text,rows,prepared.other_sections,results)
+
+    async def document(self,name,path,pool):
+        """ Documents one input unless its outputs are already there. Returns "done", "skipped" or "failed"."""
+        loop=asyncio.get_running_loop()
+        output_dir=os.path.join(self.output,name)
+        try:
+            key=await loop.run_in_executor(None,input_hash,path,self.settings())
+        except (OSError,ValueError) as e:
+            logger.error(f"{name} : failed, {e}")
+            return "failed"
+        if is_done(output_dir,key):
+            logger.info(f"{name} : up to date, skipped")
+            return "skipped"
+        start=time.perf_counter()
+        try:
+            prepared=await loop.run_in_executor(pool,prepare,path,self.user_context,self.mode,self.render_er)
+            warnings=[]
+            documentation=await self._generate(name,prepared,warnings)
+            for warning in warnings:
+                logger.warning(f"{name} : {warning}")
+            if not documentation.strip():
+                raise ValueError("the model returned no documentation")
+            docx=await loop.run_in_executor(pool,docx_bytes,documentation) if self.write_docx else None
+        except Exception as e:
+            logger.error(f"{name} : failed, {e}")
+            return "failed"
+        os.makedirs(output_dir,exist_ok=True)
+        outputs={f"{name}_Documentation.md":documentation.encode('utf-8')}
+        if docx is not None:
+            outputs[f"{name}_Documentation.docx"]=docx
+        elif self.write_docx:
+            logger.warning(f"{name} : DOCX conversion failed")
+        if prepared.er_diagram is not None:
+            outputs[f"{name}_ERDiagram.png"]=prepared.er_diagram
+        elif self.render_er:
+            logger.warning(f"{name} : ER diagram not rendered, {prepared.er_error}")
+        for file_name,data in outputs.items():
+            with open(os.path.join(output_dir,file_name),'wb') as f:
+                f.write(data)
+        seconds=time.perf_counter()-start
+        # written last : a report interrupted before this point is documented again on the next run
+        with open(os.path.join(output_dir,MANIFEST),'w',encoding='utf-8') as f:
+            json.dump({"input":os.path.abspath(path),"input_hash":key,"mode":prepared.mode,"outputs":sorted(outputs),"seconds":round(seconds,3),"warnings":warnings},f,indent=2)
+        logger.info(f"{name} : documented in {seconds:.1f}s ({prepared.mode})")
+        return "done"
+
+    async def run(self,inputs):
+        """ Documents inputs [(name, path)] and returns {"done": n, "skipped": n, "failed": n}."""
+        # reports in flight at a time : enough to keep the pool and the LLM slots busy without holding every prepared report in memory
+        in_flight=asyncio.Semaphore(self.workers+self.llm_concurrency)
+        async def document(name,path):
+            async with in_flight:
+                return await self.document(name,path,pool)
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            statuses=await asyncio.gather(*(document(name,path) for name,path in inputs))
+        return {status:statuses.count(status) for status in ("done","skipped","failed")}
+
+def main(argv=None):
+    parser=argparse.ArgumentParser(description="Document every Power BI project of a directory without the UI")
+    parser.add_argument("input",help="directory of .zip files and/or .pbip project folders")
+    parser.add_argument("--output",default="documentation",help="output directory, one sub directory per report")
+    parser.add_argument("--workers",type=int,default=os.cpu_count() or 1,help="processes for the CPU stages")
+    parser.add_argument("--llm-concurrency",type=int,default=8,help="completion requests at a time, over all reports")
+    parser.add_argument("--mode",choices=MODES,default="auto",help="auto picks map-reduce for semantic models too large for one prompt, sections otherwise")
+    parser.add_argument("--context",default="",help="additional context added to every prompt, like the context box of the app")
+    parser.add_argument("--no-er",action="store_true",help="don't render the ER diagrams")
+    parser.add_argument("--no-docx",action="store_true",help="only write the markdown")
+    parser.add_argument("--no-cache",action="store_true",help="ask the model again even for requests in the response cache")
+    args=parser.parse_args(argv)
+    load_dotenv()
+
+    inputs=find_inputs(args.input)
+    if not inputs:
+        sys.exit(f"No .zip file or .Report folder found in {args.input}")
+    logger.info(f"{len(inputs)} reports to document into {args.output}")
+    runner=BatchRunner(args.output,max(1,args.workers),args.llm_concurrency,args.mode,args.context,not args.no_er,not args.no_docx,not args.no_cache)
+    start=time.perf_counter()
+    counts=asyncio.run(runner.run(inputs))
+    logger.info(f"{counts['done']} documented, {counts['skipped']} up to date, {counts['failed']} failed in {time.perf_counter()-start:.1f}s")
+    return 1 if counts["failed"] else 0
+
+if __name__=="__main__":
+    sys.exit(main())
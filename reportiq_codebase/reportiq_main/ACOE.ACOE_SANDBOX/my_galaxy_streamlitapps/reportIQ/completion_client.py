@@ -0,0 +1,123 @@
+import os
+import time
+import random
+import threading
+import logging
+from email.utils import parsedate_to_datetime
+from datetime import datetime,timezone
+import requests
+from requests.adapters import HTTPAdapter
+logger=logging.getLogger(__name__)
+# Shared HTTP client for the completion model endpoint.
+# A bare requests.post opens a new TCP+TLS connection for every generation. A Session keeps a urllib3 connection pool, so
+# every generation in this process after the first reuses an open keep-alive connection. Requests also get connect/read timeouts
+# and are retried on connection errors, 429 and 5xx with jittered exponential backoff that respects Retry-After.
+# Retries only happen before the stream starts : once the endpoint answered 200 the stream is handed to the caller as is.
+#
+# Settings (environment variables, all optional) :
+#   COMPLETION_MODEL_CONNECT_TIMEOUT  seconds to open the connection (default 5)
+#   COMPLETION_MODEL_READ_TIMEOUT     seconds to wait for the next bytes of the response (default 120)
+#   COMPLETION_MODEL_MAX_RETRIES      retries after the first attempt (default 4)
+#   COMPLETION_MODEL_POOL_SIZE        keep-alive connections kept per host (default 10)
+
+RETRY_STATUS_CODES={429,500,502,503,504}
+
+class CompletionRequestError(Exception):
+    """ Raised when the endpoint answers with an error that isn't retried, or retries are exhausted. status_code is None for connection errors."""
+    def __init__(self,message,status_code=None):
+        super().__init__(message)
+        self.message=message
+        self.status_code=status_code
+
+def _retry_after_seconds(value):
+    """ Retry-After is either a number of seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0,float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0,(parsedate_to_datetime(value)-datetime.now(timezone.utc)).total_seconds())
+    except (TypeError,ValueError):
+        return None
+
+def _error_message(response):
+    """ Azure OpenAI style {"error":{"message":..}} body, or the raw text."""
+    try:
+        return response.json()['error']['message']
+    except Exception:
+        return response.text[:500] or response.reason
+
+class CompletionClient:
+    def __init__(self,endpoint,api_key,connect_timeout=5.0,read_timeout=120.0,max_retries=4,backoff_base=0.5,backoff_max=30.0,pool_size=10):
+        self.endpoint=endpoint
+        self.api_key=api_key
+        self.timeout=(connect_timeout,read_timeout)
+        self.max_retries=max_retries
+        self.backoff_base=backoff_base
+        self.backoff_max=backoff_max
+        self.session=requests.Session()
+        # Retries are done below (they need to look at Retry-After and at the body of 400s), so urllib3's own retries are off.
+        adapter=HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size,max_retries=0)
+        self.session.mount("https://",adapter)
+        self.session.mount("http://",adapter)
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "api-key": api_key or "",
+            "User-agent":"Your agent v2.0"
+        })
+
+    def _backoff(self,attempt,retry_after=None):
+        """ Full jitter exponential backoff, or what the server asked for in Retry-After if that is longer."""
+        delay=random.uniform(0,min(self.backoff_max,self.backoff_base*(2**attempt)))
+        if retry_after is not None:
+            delay=max(delay,min(retry_after,self.backoff_max))
+        return delay
+
+    def post_stream(self,data):
+        """ POSTs the chat-completions request with stream=True and returns the open response once the endpoint answered 200.
+        The caller must iterate/close the response so the connection goes back to the pool."""
+        attempt=0
+        while True:
+            try:
+                response=self.session.post(self.endpoint,json=data,stream=True,timeout=self.timeout)
+            except (requests.ConnectionError,requests.Timeout) as e:
+                if attempt>=self.max_retries:
+                    raise CompletionRequestError(f"Could not reach the completion model : {e}") from e
+                delay=self._backoff(attempt)
+                logger.debug(f"Completion request failed ({e}), retrying in {delay:.2f}s")
+            except requests.RequestException as e: # MissingSchema, InvalidURL, ... : retrying won't help
+                raise CompletionRequestError(f"Could not send the request to the completion model : {e}") from e
+            else:
+                if response.status_code==200:
+                    return response
+                retryable=response.status_code in RETRY_STATUS_CODES
+                message=_error_message(response)
+                retry_after=_retry_after_seconds(response.headers.get("Retry-After"))
+                response.close()
+                if not retryable or attempt>=self.max_retries:
+                    raise CompletionRequestError(f"{response.status_code} {message}",response.status_code)
+                delay=self._backoff(attempt,retry_after)
+                logger.debug(f"Completion model answered {response.status_code}, retrying in {delay:.2f}s")
+            time.sleep(delay)
+            attempt+=1
+
+_client=None
+_client_lock=threading.Lock()
+def get_completion_client():
+    """ Process wide client, so every generation (all Streamlit sessions) shares the same connection pool."""
+    global _client
+    with _client_lock:
+        endpoint=os.getenv('COMPLETION_MODEL_ENDPOINT')
+        api_key=os.getenv('COMPLETION_MODEL_API_KEY')
+        if _client is None or _client.endpoint!=endpoint or _client.api_key!=api_key:
+            _client=CompletionClient(
+                endpoint,
+                api_key,
+                connect_timeout=float(os.getenv('COMPLETION_MODEL_CONNECT_TIMEOUT','5')),
+                read_timeout=float(os.getenv('COMPLETION_MODEL_READ_TIMEOUT','120')),
+                max_retries=int(os.getenv('COMPLETION_MODEL_MAX_RETRIES','4')),
+                pool_size=int(os.getenv('COMPLETION_MODEL_POOL_SIZE','10')),
+            )
+        return _client
@@ -0,0 +1,226 @@
+import io
+import os
+import html
+import hashlib
+import zipfile
+import logging
+import threading
+from collections import OrderedDict
+from typing import NamedTuple,Callable
+from markdown_to_docx import markdown_to_docx,tokenize,inline_runs
+from tmdl_to_er import FULL_DPI
+logger=logging.getLogger(__name__)
+# Downloads of a generated documentation : a registry of exporters (markdown, DOCX, HTML, PDF, ER diagram, and a zip bundle of them)
+# rendered only when asked for, each kept per document hash and name, so a format is rendered at most once per documentation however many
+# times it's downloaded. Everything is rendered in memory, nothing is written to the working directory (the pypandoc version wrote
+# temp.md there, which concurrent sessions overwrote).
+# The PDF is printed from the HTML export with WeasyPrint (in requirements.txt, its Pango libraries in the Dockerfile). Without it,
+# e.g. in a local environment missing Pango, the PDF export is just not offered.
+# To add a format : decorate its render(document) -> bytes with @exporter(...).
+#
+# Settings (environment variables, all optional) :
+#   REPORTIQ_EXPORT_CACHE_SIZE  rendered exports kept in memory, least recently used first out (default 64)
+
+try:
+    import weasyprint
+except (ImportError,OSError): # OSError : installed, but its Pango libraries aren't
+    weasyprint=None
+
+EXPORT_CACHE_SIZE=int(os.getenv('REPORTIQ_EXPORT_CACHE_SIZE','64'))
+
+class ExportError(Exception):
+    pass
+
+class ExportDocument:
+    """ What gets exported : the markdown, the DOCX built while it streamed (if any) and the ER diagram (if any)."""
+    __slots__=('markdown','name','docx','er_diagram','hash')
+    def __init__(self,markdown,name,docx=None,er_diagram=None):
+        self.markdown=markdown
+        self.name=name # file names are <name>_Documentation.<extension>, <name>_ERDiagram.<extension>
+        self.docx=docx
+        self.er_diagram=er_diagram
+        digest=hashlib.sha256(markdown.encode('utf-8'))
+        if er_diagram is not None:
+            digest.update(b'\0'+er_diagram.layout.encode('utf-8'))
+        self.hash=digest.hexdigest()
+
+class Exporter(NamedTuple):
+    key: str
+    label: str
+    file_suffix: str
+    mime: str
+    icon: str
+    render: Callable # render(document) -> bytes
+    available: Callable # available(document) -> bool, e.g. no ER diagram or no PDF engine
+    eager: bool # cheap enough to render with the page instead of on request
+
+EXPORTERS=OrderedDict()
+
+def exporter(key,label,file_suffix,mime,icon,available=lambda document:True,eager=False):
+    """ Registers render(document) -> bytes as the exporter of key."""
+    def register(render):
+        EXPORTERS[key]=Exporter(key,label,file_suffix,mime,icon,render,available,eager)
+        return render
+    return register
+
+def file_name(document,key):
+    return f"{document.name}{EXPORTERS[key].file_suffix}"
+
+class ExportCache:
+    """ LRU of rendered exports by (document hash, document name, exporter key). Thread safe, shared by all sessions of the process."""
+    def __init__(self,size=EXPORT_CACHE_SIZE):
+        self.size=size
+        self._items=OrderedDict()
+        self._lock=threading.Lock()
+
+    def get(self,key):
+        with self._lock:
+            data=self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self,key,data):
+        with self._lock:
+            self._items[key]=data
+            self._items.move_to_end(key)
+            while len(self._items)>self.size:
+                self._items.popitem(last=False)
+
+_cache=ExportCache()
+
+def _cache_key(document,key):
+    # the name is part of the exports (file names in the bundle, HTML title), so the same text uploaded as another report is rendered again
+    return (document.hash,document.name,key)
+
+def is_rendered(document,key):
+    return _cache.get(_cache_key(document,key)) is not None
+
+def render_export(document,key):
+    """ Bytes of document in the format of exporter key, rendered on the first call for this document hash and name. Raises ExportError."""
+    cache_key=_cache_key(document,key)
+    data=_cache.get(cache_key)
+    if data is None:
+        export=EXPORTERS[key]
+        if not export.available(document):
+            raise ExportError(f"{export.label} isn't available for this documentation")
+        data=export.render(document)
+        _cache.put(cache_key,data)
+        logger.debug(f"Rendered {key} export of {document.name} : {len(data)} bytes")
+    return data
+
+def available_exports(document):
+    return [export for export in EXPORTERS.values() if export.available(document)]
+
+def _inline_html(text):
+    parts=[]
+    for run_text,bold,italic,code,strike in inline_runs(text):
+        run=html.escape(run_text)
+        if code:
+            run=f"<code>{run}</code>"
+        if strike:
+            run=f"<s>{run}</s>"
+        if italic:
+            run=f"<em>{run}</em>"
+        if bold:
+            run=f"<strong>{run}</strong>"
+        parts.append(run)
+    return ''.join(parts)
+
+_HTML_STYLE="""body{font-family:Calibri,Arial,sans-serif;font-size:11pt;line-height:1.4;max-width:60em;margin:2em auto;padding:0 1em}
+table{border-collapse:collapse;margin:1em 0}th,td{border:1px solid #999;padding:4px 6px;text-align:left;vertical-align:top}
+th{background:#eee}code,pre{font-family:Consolas,monospace;font-size:9pt}pre{background:#f6f6f6;padding:8px;white-space:pre-wrap}"""
+
+def markdown_to_html(markdown_text,title=""):
+    """ Standalone HTML page of the markdown, from the same block tokens as the DOCX (markdown_to_docx.tokenize)."""
+    out=[]
+    lists=[] # tags of the open lists, each with an open <li>
+    table=None # number of columns of the open table
+    def close_lists(depth=0):
+        while len(lists)>depth:
+            out.append(f"</li></{lists.pop()}>")
+    def close_table():
+        nonlocal table
+        if table is not None:
+            out.append("</tbody></table>")
+            table=None
+    for token in tokenize(markdown_text):
+        kind=token[0]
+        if kind=="table_row":
+            out.append("<tr>"+''.join(f"<td>{_inline_html(cell)}</td>" for cell in token[1])+"<td></td>"*(table-len(token[1]))+"</tr>")
+            continue
+        close_table()
+        if kind=="list_item":
+            _,depth,ordered,text=token
+            tag="ol" if ordered else "ul"
+            close_lists(depth+1)
+            if len(lists)==depth+1:
+                if lists[-1]==tag:
+                    out.append("</li>")
+                else:
+                    close_lists(depth)
+            while len(lists)<depth+1:
+                out.append(f"<{tag}>")
+                lists.append(tag)
+            out.append(f"<li>{_inline_html(text)}")
+            continue
+        close_lists()
+        if kind=="heading":
+            out.append(f"<h{token[1]}>{_inline_html(token[2])}</h{token[1]}>")
+        elif kind=="paragraph":
+            out.append(f"<p>{_inline_html(token[1])}</p>")
+        elif kind=="table":
+            table=len(token[1])
+            out.append("<table><thead><tr>"+''.join(f"<th>{_inline_html(cell)}</th>" for cell in token[1])+"</tr></thead><tbody>")
+        elif kind=="code":
+            out.append(f"<pre><code>{html.escape(token[1])}</code></pre>")
+    close_table()
+    close_lists()
+    body='\n'.join(out)
+    return f'<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{html.escape(title)}</title><style>{_HTML_STYLE}</style></head>\n<body>\n{body}\n</body></html>\n'
+
+def _has_er_diagram(document):
+    return document.er_diagram is not None
+
+@exporter("md","Markdown","_Documentation.md","text/markdown",":material/markdown:",eager=True)
+def render_markdown(document):
+    return document.markdown.encode('utf-8')
+
+@exporter("docx","DOCX","_Documentation.docx","application/vnd.openxmlformats-officedocument.wordprocessingml.document",":material/docs:",eager=True)
+def render_docx(document):
+    if document.docx is not None: # built while the documentation streamed, see markdown_to_docx.DocxBuilder
+        return document.docx
+    docx=markdown_to_docx(document.markdown)
+    if docx is None:
+        raise ExportError("The documentation couldn't be converted to DOCX")
+    return docx.getvalue()
+
+@exporter("html","HTML","_Documentation.html","text/html",":material/html:")
+def render_html(document):
+    return markdown_to_html(document.markdown,f"{document.name} Documentation").encode('utf-8')
+
+@exporter("pdf","PDF","_Documentation.pdf","application/pdf",":material/picture_as_pdf:",available=lambda document:weasyprint is not None)
+def render_pdf(document):
+    return weasyprint.HTML(string=render_export(document,"html").decode('utf-8')).write_pdf()
+
+@exporter("er_png","ER Diagram","_ERDiagram.png","image/png",":material/account_tree:",available=_has_er_diagram)
+def render_er_png(document):
+    return document.er_diagram.png(FULL_DPI)
+
+@exporter("er_svg","ER Diagram (SVG)","_ERDiagram.svg","image/svg+xml",":material/account_tree:",available=_has_er_diagram)
+def render_er_svg(document):
+    return document.er_diagram.svg()
+
+@exporter("bundle","All (zip)","_Documentation.zip","application/zip",":material/folder_zip:")
+def render_bundle(document):
+    """ Every other available format in one zip. A format that fails (e.g. no Graphviz binaries for the ER diagram) is left out."""
+    buffer=io.BytesIO()
+    with zipfile.ZipFile(buffer,'w',zipfile.ZIP_DEFLATED) as bundle:
+        for export in available_exports(document):
+            if export.key=="bundle":
+                continue
+            try:
+                bundle.writestr(file_name(document,export.key),render_export(document,export.key))
+            except Exception as e:
+                logger.warning(f"{export.label} left out of the bundle of {document.name} : {e}")
+    return buffer.getvalue()
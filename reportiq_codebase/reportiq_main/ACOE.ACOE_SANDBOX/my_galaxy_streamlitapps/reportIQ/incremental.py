@@ -0,0 +1,170 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import logging
+from typing import NamedTuple
+from contextlib import contextmanager
+from tmdl_parser import _read_name
+from section_engine import assemble
+from map_reduce import collect_map_results,DICTIONARY_HEADER
+logger=logging.getLogger(__name__)
+# Incremental re-documentation of a report documented before.
+# The documentation is made of sections whose prompts are derived from the files : the overview, key contacts, data flow and data
+# explorer sections, and one data dictionary section per table (see PowerBIContext.set_incremental_contexts). After a generation the
+# store keeps, per document, the SHA-256 of every source file (each .tmdl, report.json) and of every section prompt with its text.
+# On the next upload the file hashes are diffed to tell what changed, and only the sections whose prompt changed are generated again :
+# editing one measure regenerates the rows of its table (and the sections that show it), everything else is spliced back from the
+# previous documentation. Prompt hashes also catch changes that aren't in the files, like a different user context.
+#
+# Settings (environment variables, all optional) :
+#   REPORTIQ_DOCUMENT_STORE  path of the SQLite file (default reportiq_documents.sqlite in REPORTIQ_CACHE_DIR, or in the temp directory)
+
+TABLE_PREFIX="table:"
+# The id of a document is only its file name, so an unrelated report uploaded under the same name (e.g. "Report.zip") finds the state
+# of another one : the state is only used if the two semantic models share at least this fraction of their tables (of all the tables
+# of either), which an edit of the same report does (a table added or removed) and two different reports don't.
+MIN_SHARED_TABLES=0.5
+_TABLE=re.compile(r'^table\s+',re.MULTILINE)
+
+class DocumentStore:
+    def __init__(self,path):
+        self.path=path
+        self._lock=threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)),exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        """ Connection committed on success and always closed."""
+        connection=sqlite3.connect(self.path,timeout=10)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self,document_id):
+        """ State saved by the last generation of the document, or None."""
+        try:
+            with self._lock,self._connect() as connection:
+                row=connection.execute("SELECT state FROM documents WHERE id=?",(document_id,)).fetchone()
+            return json.loads(row[0]) if row is not None else None
+        except (sqlite3.Error,ValueError) as e:
+            # like the response cache : a broken store means a full generation, never a failed one
+            logger.debug(f"Document store read failed for {document_id} : {e}")
+            return None
+
+    def put(self,document_id,state):
+        try:
+            with self._lock,self._connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO documents (id,state,updated) VALUES (?,?,?)",(document_id,json.dumps(state,ensure_ascii=False),time.time()))
+        except sqlite3.Error as e:
+            logger.debug(f"Document store write failed for {document_id} : {e}")
+
+_store=None
+_store_lock=threading.Lock()
+def get_document_store():
+    """ Process wide store configured from the environment, or None if it can't be opened."""
+    global _store
+    default_dir=os.getenv('REPORTIQ_CACHE_DIR') or tempfile.gettempdir()
+    path=os.getenv('REPORTIQ_DOCUMENT_STORE') or os.path.join(default_dir,"reportiq_documents.sqlite")
+    with _store_lock:
+        if _store is None or _store.path!=path:
+            try:
+                _store=DocumentStore(path)
+            except (OSError,sqlite3.Error) as e:
+                logger.debug(f"Document store disabled, could not open {path} : {e}")
+                return None
+        return _store
+
+def report_name(file_name):
+    """ Name of a report from the name of its upload : "Sales.zip", "Sales.Report.zip" and "Sales.SemanticModel.zip" are all "Sales"."""
+    return file_name.split(".Report.zip")[0].split(".SemanticModel.zip")[0].split(".zip")[0]
+
+def document_id(file_type,name):
+    """ Identity of a document across uploads : the same report uploaded again, changed or not, from the app or batch.py."""
+    return f"{file_type}:{report_name(name)}"
+
+def _sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def tmdl_hashes(texts):
+    """ {table name, or "relationships" for relationships.tmdl: SHA-256} of raw .tmdl texts."""
+    hashes={}
+    for text in texts:
+        match=_TABLE.search(text)
+        hashes[_read_name(text,match.end())[0] if match else "relationships"]=_sha256(text)
+    return hashes
+
+def text_hash(text):
+    return _sha256(text)
+
+class SourceDiff(NamedTuple):
+    added: list
+    changed: list
+    removed: list
+
+    def describe(self):
+        parts=[f"{label} : {', '.join(names)}" for label,names in (("changed",self.changed),("added",self.added),("removed",self.removed)) if names]
+        return "; ".join(parts) if parts else "no source file changed"
+
+def diff_hashes(previous,current):
+    """ What changed between two {file: hash}."""
+    return SourceDiff(
+        sorted(name for name in current if name not in previous),
+        sorted(name for name in current if name in previous and previous[name]!=current[name]),
+        sorted(name for name in previous if name not in current))
+
+def same_model(previous_sources,sources):
+    """ Whether two {file: hash} (source_hashes) are of the same semantic model, see MIN_SHARED_TABLES."""
+    previous_tables={name for name in previous_sources if name not in ("report.json","relationships")}
+    tables={name for name in sources if name not in ("report.json","relationships")}
+    if not previous_tables and not tables:
+        return True
+    return len(previous_tables&tables)>=MIN_SHARED_TABLES*len(previous_tables|tables)
+
+def usable_state(previous,sources):
+    """ previous, or None if it's the state of another report saved under the same id."""
+    if previous is not None and not same_model(previous.get("sources",{}),sources):
+        return None
+    return previous
+
+def section_hash(section):
+    return _sha256(json.dumps([section.prompt,section.max_tokens],ensure_ascii=False))
+
+def plan_sections(sections,previous):
+    """ ({section key: text} reused from the previous state, [sections to generate]). Everything is generated without a previous state."""
+    stored=(previous or {}).get("sections",{})
+    reused={}
+    regenerate=[]
+    for section in sections:
+        entry=stored.get(section.key)
+        if entry is not None and entry["hash"]==section_hash(section):
+            reused[section.key]=entry["text"]
+        else:
+            regenerate.append(section)
+    return reused,regenerate
+
+def assemble_incremental(sections,results):
+    """ The sections in order, with the per-table sections merged into one data dictionary table at the end."""
+    tables=[section for section in sections if section.key.startswith(TABLE_PREFIX)]
+    others=[section for section in sections if not section.key.startswith(TABLE_PREFIX)]
+    rows,_=collect_map_results(tables,results)
+    parts=[assemble(others,results)]
+    if rows:
+        parts.append("## Data Dictionary\n\n"+DICTIONARY_HEADER+"\n"+'\n'.join(rows))
+    return '\n\n'.join(part for part in parts if part)
+
+def document_state(sources,sections,results):
+    """ What the store keeps for the next run. Sections that came back empty (a failed request) aren't kept, so they're generated again."""
+    return {
+        "sources":sources,
+        "sections":{section.key:{"hash":section_hash(section),"text":results[section.key]} for section in sections if results.get(section.key,"").strip()},
+    }
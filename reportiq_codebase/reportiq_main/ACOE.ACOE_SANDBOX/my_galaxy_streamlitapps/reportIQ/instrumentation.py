@@ -0,0 +1,278 @@
+import os
+import sys
+import json
+import time
+import bisect
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+logger=logging.getLogger(__name__)
+# Timings and counters of the pipeline, instead of DEBUG logging of every step.
+#   span(stage)              times a stage (ingestion, tmdl_parse, er_layout, prompt, generation, docx, ...) into reportiq_stage_seconds
+#   instrument_stream(...)   time to first token, duration and tokens/sec of a completion stream
+#   count(name, value)       counters : bytes read from uploads, prompt and completion tokens, response cache hits
+#   profiled(name)           sampling profiler around a request, when REPORTIQ_PROFILE is set in the environment the app was started with
+# Exporters : a Prometheus text endpoint and/or a JSON line per span/stream.
+#
+# Settings (environment variables, all optional) :
+#   REPORTIQ_LOG_LEVEL         logging level of the app (default INFO, DEBUG shows every step)
+#   REPORTIQ_METRICS_PORT      serve the metrics in Prometheus text format on http://0.0.0.0:<port>/metrics
+#   REPORTIQ_METRICS_LOG       append a JSON line per span and completion stream to this file ("-" for stdout)
+#   REPORTIQ_PROFILE           1 to sample the stacks of every profiled request. The top functions are logged at INFO and,
+#   REPORTIQ_PROFILE_DIR       if set, the collapsed stacks are written there (flamegraph.pl / speedscope input)
+#   REPORTIQ_PROFILE_INTERVAL  seconds between samples (default 0.005)
+
+DURATION_BUCKETS=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10,30,60,120,300)
+RATE_BUCKETS=(1,5,10,20,40,80,160,320)
+
+def configure_logging():
+    """ Logging of the app, from REPORTIQ_LOG_LEVEL."""
+    level=os.getenv('REPORTIQ_LOG_LEVEL','INFO').upper()
+    logging.basicConfig(level=getattr(logging,level,logging.INFO),stream=sys.stdout,format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+def _labels_text(labels):
+    return '{'+','.join(f'{k}="{v}"' for k,v in labels)+'}' if labels else ''
+
+class _Histogram:
+    __slots__=('buckets','counts','sum','count')
+    def __init__(self,buckets):
+        self.buckets=buckets
+        self.counts=[0]*len(buckets)
+        self.sum=0.0
+        self.count=0
+
+    def observe(self,value):
+        index=bisect.bisect_left(self.buckets,value)
+        if index<len(self.counts):
+            self.counts[index]+=1
+        self.sum+=value
+        self.count+=1
+
+class MetricsRegistry:
+    """ Counters and histograms by (name, labels). Thread safe : Streamlit sessions, section workers and background renders all record here."""
+    def __init__(self):
+        self._lock=threading.Lock()
+        self._counters=Counter()
+        self._histograms={}
+        self._help={}
+
+    def count(self,name,value=1,help="",**labels):
+        key=(name,tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key]+=value
+            self._help.setdefault(name,help)
+
+    def observe(self,name,value,buckets=DURATION_BUCKETS,help="",**labels):
+        key=(name,tuple(sorted(labels.items())))
+        with self._lock:
+            histogram=self._histograms.get(key)
+            if histogram is None:
+                histogram=self._histograms[key]=_Histogram(buckets)
+            histogram.observe(value)
+            self._help.setdefault(name,help)
+
+    def snapshot(self):
+        """ {"counters": {name{labels}: value}, "histograms": {name{labels}: {"count","sum"}}}"""
+        with self._lock:
+            return {
+                "counters":{name+_labels_text(labels):value for (name,labels),value in self._counters.items()},
+                "histograms":{name+_labels_text(labels):{"count":h.count,"sum":h.sum} for (name,labels),h in self._histograms.items()},
+            }
+
+    def render_prometheus(self):
+        """ Prometheus text exposition format."""
+        out=[]
+        with self._lock:
+            typed=set()
+            for (name,labels),value in sorted(self._counters.items()):
+                if name not in typed:
+                    typed.add(name)
+                    out.append(f"# HELP {name} {self._help.get(name) or name}")
+                    out.append(f"# TYPE {name} counter")
+                out.append(f"{name}{_labels_text(labels)} {value}")
+            for (name,labels),h in sorted(self._histograms.items(),key=lambda item:item[0]):
+                if name not in typed:
+                    typed.add(name)
+                    out.append(f"# HELP {name} {self._help.get(name) or name}")
+                    out.append(f"# TYPE {name} histogram")
+                cumulative=0
+                for bound,count in zip(h.buckets,h.counts):
+                    cumulative+=count
+                    out.append(f"{name}_bucket{_labels_text(labels+(('le',bound),))} {cumulative}")
+                out.append(f"{name}_bucket{_labels_text(labels+(('le','+Inf'),))} {h.count}")
+                out.append(f"{name}_sum{_labels_text(labels)} {h.sum}")
+                out.append(f"{name}_count{_labels_text(labels)} {h.count}")
+        return '\n'.join(out)+'\n'
+
+metrics=MetricsRegistry()
+
+_event_lock=threading.Lock()
+def _emit(event):
+    """ JSON line exporter (REPORTIQ_METRICS_LOG)."""
+    path=os.getenv('REPORTIQ_METRICS_LOG')
+    if not path:
+        return
+    event["timestamp"]=time.time()
+    line=json.dumps(event,ensure_ascii=False)
+    with _event_lock:
+        if path=="-":
+            print(line,flush=True)
+        else:
+            try:
+                with open(path,'a',encoding='utf-8') as f:
+                    f.write(line+'\n')
+            except OSError as e: # the metrics are a by-product, never fail the stage over them
+                logger.warning(f"Metrics not written to {path} : {e}")
+
+def count(name,value=1,help="",**labels):
+    metrics.count(name,value,help,**labels)
+
+@contextmanager
+def span(stage,**attributes):
+    """ Times the block into reportiq_stage_seconds{stage=...}. attributes (sizes, counts, ...) only go to the JSON log."""
+    start=time.perf_counter()
+    status="ok"
+    try:
+        yield attributes # the block can add attributes once it knows them
+    except BaseException:
+        status="error"
+        raise
+    finally:
+        seconds=time.perf_counter()-start
+        metrics.observe("reportiq_stage_seconds",seconds,help="Duration of each pipeline stage",stage=stage,status=status)
+        logger.debug(f"{stage} took {seconds*1000:.1f} ms {attributes or ''}")
+        _emit({"type":"span","stage":stage,"status":status,"seconds":seconds,**attributes})
+
+def instrument_stream(deltas,stage="generation",token_counter=None):
+    """ Passes the deltas of a completion stream through, recording time to first token, duration and tokens/sec once it ends.
+    token_counter(text) counts the tokens of the streamed text (prompt_compaction.count_tokens), otherwise deltas are counted."""
+    start=time.perf_counter()
+    first=None
+    parts=[]
+    status="ok"
+    try:
+        for delta in deltas:
+            if first is None:
+                first=time.perf_counter()-start
+                metrics.observe("reportiq_time_to_first_token_seconds",first,help="Time from the completion request to the first streamed token",stage=stage)
+            parts.append(delta)
+            yield delta
+    except GeneratorExit: # the consumer stopped reading (rerun, closed session)
+        status="cancelled"
+        raise
+    except BaseException:
+        status="error"
+        raise
+    finally:
+        seconds=time.perf_counter()-start
+        tokens=token_counter(''.join(parts)) if token_counter is not None else len(parts)
+        rate=tokens/(seconds-(first or 0)) if first is not None and seconds>first else 0.0
+        metrics.observe("reportiq_stage_seconds",seconds,help="Duration of each pipeline stage",stage=stage,status=status)
+        metrics.count("reportiq_completion_tokens_total",tokens,help="Tokens streamed by the completion model",stage=stage)
+        if first is not None:
+            metrics.observe("reportiq_tokens_per_second",rate,buckets=RATE_BUCKETS,help="Streaming rate after the first token",stage=stage)
+        logger.debug(f"{stage} stream ({status}) : first token after {first if first is not None else float('nan'):.2f}s, {tokens} tokens in {seconds:.2f}s ({rate:.1f} tokens/s)")
+        _emit({"type":"stream","stage":stage,"status":status,"seconds":seconds,"time_to_first_token":first,"tokens":tokens,"tokens_per_second":rate})
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self,format,*args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ("/metrics","/"):
+            self.send_error(404)
+            return
+        body=metrics.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type','text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+_server=None
+_server_lock=threading.Lock()
+def start_metrics_server():
+    """ Starts the Prometheus endpoint once per process if REPORTIQ_METRICS_PORT is set. Returns the server or None."""
+    global _server
+    port=os.getenv('REPORTIQ_METRICS_PORT')
+    if not port:
+        return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server=ThreadingHTTPServer(("0.0.0.0",int(port)),_MetricsHandler)
+            except OSError as e:
+                # another process (e.g. a second Streamlit worker) already serves it
+                logger.warning(f"Metrics endpoint not started on port {port} : {e}")
+                return None
+            _server.daemon_threads=True
+            threading.Thread(target=_server.serve_forever,daemon=True,name="metrics").start()
+            logger.info(f"Metrics served on http://0.0.0.0:{_server.server_port}/metrics")
+        return _server
+
+class SamplingProfiler:
+    """ Samples the stack of one thread every interval seconds from a background thread. Unlike cProfile it doesn't slow the profiled code down."""
+    def __init__(self,thread_id,interval=0.005):
+        self.thread_id=thread_id
+        self.interval=interval
+        self.stacks=Counter() # collapsed stack "outer;...;inner" -> samples
+        self._stop=threading.Event()
+        self._thread=threading.Thread(target=self._run,daemon=True,name="profiler")
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame=sys._current_frames().get(self.thread_id)
+            stack=[]
+            while frame is not None:
+                code=frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame=frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))]+=1
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def top(self,limit=20):
+        """ [(function, samples with it on the stack, samples with it on top)], by inclusive samples."""
+        inclusive=Counter()
+        own=Counter()
+        for stack,samples in self.stacks.items():
+            frames=stack.split(';')
+            own[frames[-1]]+=samples
+            for function in set(frames):
+                inclusive[function]+=samples
+        return [(function,samples,own[function]) for function,samples in inclusive.most_common(limit)]
+
+@contextmanager
+def profiled(name):
+    """ Samples the calling thread during the block when REPORTIQ_PROFILE is set."""
+    if os.getenv('REPORTIQ_PROFILE','').lower() not in ("1","true","yes"):
+        yield None
+        return
+    profiler=SamplingProfiler(threading.get_ident(),float(os.getenv('REPORTIQ_PROFILE_INTERVAL','0.005'))).start()
+    try:
+        yield profiler
+    finally:
+        profiler.stop()
+        total=sum(profiler.stacks.values())
+        lines=[f"{samples/total*100:5.1f}% {own/total*100:5.1f}% {function}" for function,samples,own in profiler.top()] if total else []
+        logger.info(f"Profile of {name} ({total} samples, total% self%) :\n"+'\n'.join(lines))
+        directory=os.getenv('REPORTIQ_PROFILE_DIR')
+        if directory and total:
+            path=os.path.join(directory,f"{name}-{int(time.time()*1000)}.collapsed")
+            try:
+                os.makedirs(directory,exist_ok=True)
+                with open(path,'w',encoding='utf-8') as f:
+                    for stack,samples in profiler.stacks.most_common():
+                        f.write(f"{stack} {samples}\n")
+                logger.info(f"Collapsed stacks written to {path}")
+            except OSError as e: # the profile is a by-product, never fail the request over it
+                logger.warning(f"Profile not written to {path} : {e}")
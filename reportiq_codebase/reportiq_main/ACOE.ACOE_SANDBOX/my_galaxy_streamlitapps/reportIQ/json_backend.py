@@ -0,0 +1,102 @@
+import os
+import json
+import logging
+from typing import List,Optional
+logger=logging.getLogger(__name__)
+# JSON decoding for the two JSON heavy paths : report.json (and its nested strings) and the chat.completion.chunk of every streamed delta.
+# orjson or msgspec are used when installed, stdlib json otherwise. Neither is required, requirements.txt only has what the app needs.
+# With msgspec the chunks are decoded into typed structs that only have the fields we read, so the rest of every chunk
+# (content_filter_results, logprobs, ...) is skipped instead of being turned into dicts.
+#
+#   REPORTIQ_JSON_BACKEND  auto (default), orjson, msgspec or json. auto picks the fastest installed one per path : orjson then msgspec
+#                          for documents, msgspec (typed structs) then orjson for chunks. Benchmark : python json_benchmark.py
+#
+# Every backend raises ValueError on invalid JSON.
+
+try:
+    import orjson
+except ImportError:
+    orjson=None
+try:
+    import msgspec
+except ImportError:
+    msgspec=None
+
+if msgspec is not None:
+    class Delta(msgspec.Struct):
+        content: Optional[str]=None
+    class Choice(msgspec.Struct):
+        delta: Optional[Delta]=None
+        finish_reason: Optional[str]=None
+    class ChatCompletionChunk(msgspec.Struct):
+        choices: List[Choice]=[]
+    _chunk_decoder=msgspec.json.Decoder(ChatCompletionChunk)
+    _msgspec_decoder=msgspec.json.Decoder()
+
+BACKENDS=("orjson","msgspec","json")
+CHUNK_BACKENDS=("msgspec","orjson","json")
+
+def _available(name):
+    return name=="json" or (name=="orjson" and orjson is not None) or (name=="msgspec" and msgspec is not None)
+
+def select_backend(name=None,preference=BACKENDS):
+    """ Name of the backend to use : name (or REPORTIQ_JSON_BACKEND) if it's installed, else the first installed one of preference."""
+    name=(name or os.getenv('REPORTIQ_JSON_BACKEND','auto')).lower()
+    if name!="auto":
+        if _available(name):
+            return name
+        logger.debug(f"JSON backend {name} isn't installed, choosing one")
+    return next(backend for backend in preference if _available(backend))
+
+BACKEND=select_backend()
+CHUNK_BACKEND=select_backend(preference=CHUNK_BACKENDS)
+
+def _loads_orjson(text):
+    return orjson.loads(text) # orjson.JSONDecodeError is a ValueError
+
+def _loads_msgspec(text):
+    try:
+        return _msgspec_decoder.decode(text)
+    except msgspec.DecodeError as e:
+        raise ValueError(str(e)) from e
+
+def _chat_delta_dict(parsed_data):
+    choices=parsed_data.get('choices') if isinstance(parsed_data,dict) else None
+    if isinstance(choices,list) and choices and isinstance(choices[0],dict):
+        delta=choices[0].get('delta')
+        return (delta.get('content') if isinstance(delta,dict) else None),choices[0].get('finish_reason')
+    return None,None
+
+def _chat_delta_msgspec(data):
+    try:
+        chunk=_chunk_decoder.decode(data)
+    except msgspec.ValidationError:
+        # valid JSON that doesn't fit the structs (an error event, a provider specific shape) : read it as plain JSON
+        return _chat_delta_dict(_loads_msgspec(data))
+    except msgspec.DecodeError as e:
+        raise ValueError(str(e)) from e
+    if chunk.choices:
+        choice=chunk.choices[0]
+        return (choice.delta.content if choice.delta is not None else None),choice.finish_reason
+    return None,None
+
+def get_loads(backend=None):
+    """ loads(str or bytes) of backend (default BACKEND)."""
+    backend=backend or BACKEND
+    if backend=="orjson":
+        return _loads_orjson
+    if backend=="msgspec":
+        return _loads_msgspec
+    return json.loads
+
+def get_chat_delta(backend=None):
+    """ chat_delta(data) of backend : (content of the first choice's delta, its finish_reason) of one chat.completion.chunk, None for what's missing."""
+    backend=backend or CHUNK_BACKEND
+    if backend=="msgspec":
+        return _chat_delta_msgspec
+    loads=get_loads(backend)
+    return lambda data:_chat_delta_dict(loads(data))
+
+loads=get_loads()
+chat_delta=get_chat_delta()
+logger.debug(f"JSON backend : {BACKEND} for documents, {CHUNK_BACKEND} for chunks")
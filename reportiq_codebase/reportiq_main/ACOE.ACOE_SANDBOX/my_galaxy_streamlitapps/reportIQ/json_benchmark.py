@@ -0,0 +1,92 @@
+import os
+import re
+import sys
+import glob
+import json
+import time
+import argparse
+import json_backend
+from sse import iter_sse_data
+from report_layout import ReportLayout
+from prompt_compaction import digest_report
+# Microbenchmark of the JSON backends (see json_backend.py) on the two JSON heavy paths :
+#   report.json : json_backend.loads of every report.json of testing_zip, and the report digest (which also decodes the nested filters)
+#   SSE stream  : decoding every chat.completion.chunk of a recorded stream. Pass a stream captured from the endpoint with --sse, e.g.
+#                 curl -N $COMPLETION_MODEL_ENDPOINT ... > stream.sse. Without it an Azure OpenAI shaped stream (content_filter_results
+#                 on every chunk) is built from the sample documentation in testing_zip.
+#
+#   python json_benchmark.py [--testing-zip ../../../../../testing_zip] [--sse stream.sse] [--repeat 5] [--json results.json]
+
+DEFAULT_TESTING_ZIP=os.path.join(os.path.dirname(os.path.abspath(__file__)),*[".."]*5,"testing_zip")
+
+def azure_chunk(content):
+    """ One streamed chunk as Azure OpenAI sends it (see the example in CompletionModel.generate_documentation)."""
+    filters={name:{"filtered":False,"severity":"safe"} for name in ("hate","self_harm","sexual","violence")}
+    chunk={
+        "choices":[{"content_filter_results":filters,"delta":{"content":content},"finish_reason":None,"index":0,"logprobs":None}],
+        "created":1752057079,
+        "id":"chatcmpl-BrMN52V9JdezaUMW8RpIHsy6fPQj9",
+        "model":"gpt-4o-2024-11-20",
+        "object":"chat.completion.chunk",
+        "system_fingerprint":"fp_ab9114d383",
+        "usage":None,
+    }
+    return f"data: {json.dumps(chunk,ensure_ascii=False)}\n\n".encode('utf-8')
+
+def synthetic_stream(testing_zip):
+    """ SSE body streaming the sample documentation of testing_zip a few characters per chunk, like the model does."""
+    text=''.join(open(path,encoding='utf-8').read() for path in sorted(glob.glob(os.path.join(testing_zip,"*.md"))))
+    pieces=re.findall(r'\s*\S{1,6}|\s+',text)
+    return b''.join(azure_chunk(piece) for piece in pieces)+b"data: [DONE]\n\n"
+
+def best_of(repeat,function,*args):
+    best=float('inf')
+    for _ in range(repeat):
+        start=time.perf_counter()
+        function(*args)
+        best=min(best,time.perf_counter()-start)
+    return best
+
+def main():
+    parser=argparse.ArgumentParser(description="JSON backend microbenchmark")
+    parser.add_argument("--testing-zip",default=DEFAULT_TESTING_ZIP)
+    parser.add_argument("--sse",help="recorded SSE stream (response body of a streaming chat-completions request)")
+    parser.add_argument("--repeat",type=int,default=5)
+    parser.add_argument("--json",help="also write the results to this file")
+    args=parser.parse_args()
+
+    reports=[open(path,encoding='utf-8-sig').read() for path in sorted(glob.glob(os.path.join(args.testing_zip,"*.Report","report.json")))]
+    if not reports:
+        sys.exit(f"No report.json found under {args.testing_zip}")
+    if args.sse:
+        with open(args.sse,'rb') as f:
+            stream=f.read()
+    else:
+        stream=synthetic_stream(args.testing_zip)
+    # the SSE events are split out once, only the per-chunk JSON decoding is compared
+    events=list(iter_sse_data([stream]))
+
+    results={"reports":len(reports),"report_bytes":sum(len(report.encode('utf-8')) for report in reports),"sse_events":len(events),"backends":{}}
+    print(f"{len(reports)} reports ({results['report_bytes']/1e6:.1f} MB), {len(events)} SSE events, best of {args.repeat}")
+    print(f"{'backend':<10}{'report.json loads':>20}{'report digest':>16}{'SSE chunks':>14}")
+    for backend in json_backend.BACKENDS:
+        if not json_backend._available(backend):
+            print(f"{backend:<10}{'not installed':>20}")
+            continue
+        loads=json_backend.get_loads(backend)
+        chat_delta=json_backend.get_chat_delta(backend) # what CompletionModel._stream decodes every chunk with
+        json_backend.loads=loads # used by report_layout
+        try:
+            load_seconds=best_of(args.repeat,lambda:[loads(report) for report in reports])
+            digest_seconds=best_of(args.repeat,lambda:[digest_report(ReportLayout.from_json(report)) for report in reports])
+            sse_seconds=best_of(args.repeat,lambda:[chat_delta(data) for data in events])
+        finally:
+            json_backend.loads=json_backend.get_loads()
+        results["backends"][backend]={"report_loads_seconds":load_seconds,"report_digest_seconds":digest_seconds,"sse_seconds":sse_seconds}
+        print(f"{backend:<10}{load_seconds*1000:>18.1f}ms{digest_seconds*1000:>14.1f}ms{sse_seconds*1000:>12.1f}ms")
+    if args.json:
+        with open(args.json,'w') as f:
+            json.dump(results,f,indent=2)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,87 @@
+import os
+import logging
+from tmdl_parser import SemanticModel,describe_semantic_model,NO_SOURCES,SHORT_EXPRESSIONS,NO_EXPRESSIONS,NAMES_ONLY
+from prompt_compaction import count_tokens,fit_to_budget
+logger=logging.getLogger(__name__)
+# Map-reduce documentation of semantic models too large for one prompt (dozens of tables, hundreds of columns and measures).
+#   map    : tables are batched into chunks of at most chunk_tokens tokens of schema and max_fields columns+measures, so the rows a chunk
+#            produces fit in MAP_MAX_TOKENS. Every chunk gets its data dictionary rows and a short summary of its tables in one request,
+#            and the chunks run concurrently on the SectionEngine.
+#   reduce : one last request writes the overview and data flow from the per-chunk summaries (a few sentences each instead of the schema).
+# The data dictionary is the concatenation of the map rows, so its length isn't capped by the max_tokens of any single request.
+
+DEFAULT_CHUNK_TOKENS=int(os.getenv('REPORTIQ_MAP_CHUNK_TOKENS','6000'))
+DEFAULT_MAX_FIELDS=int(os.getenv('REPORTIQ_MAP_MAX_FIELDS','60'))
+MAP_MAX_TOKENS=4000
+SUMMARY_MARKER="---SUMMARY---"
+DICTIONARY_HEADER="| Table | Column/Measure | Data Type | Description |\n|---|---|---|---|"
+
+def table_schema(table,chunk_tokens=DEFAULT_CHUNK_TOKENS):
+    """ Schema of one table at the most detailed level that fits chunk_tokens."""
+    model=SemanticModel()
+    model.tables=[table]
+    return fit_to_budget([
+        lambda:describe_semantic_model(model,NO_SOURCES),
+        lambda:describe_semantic_model(model,SHORT_EXPRESSIONS),
+        lambda:describe_semantic_model(model,NO_EXPRESSIONS),
+        lambda:describe_semantic_model(model,NAMES_ONLY)],chunk_tokens)
+
+def chunk_tables(model,chunk_tokens=DEFAULT_CHUNK_TOKENS,max_fields=DEFAULT_MAX_FIELDS):
+    """ Batches the tables of model in their order, returns [(table names, schema text)]. A table bigger than a chunk gets a chunk to itself."""
+    chunks=[]
+    names=[]
+    schemas=[]
+    tokens=0
+    fields=0
+    for table in model.tables:
+        schema=table_schema(table,chunk_tokens)
+        table_tokens=count_tokens(schema)
+        table_fields=len(table.columns)+len(table.measures)
+        if names and (tokens+table_tokens>chunk_tokens or fields+table_fields>max_fields):
+            chunks.append((names,'\n'.join(schemas)))
+            names,schemas,tokens,fields=[],[],0,0
+        names.append(table.name)
+        schemas.append(schema)
+        tokens+=table_tokens
+        fields+=table_fields
+    if names:
+        chunks.append((names,'\n'.join(schemas)))
+    logger.debug(f"{len(model.tables)} tables batched into {len(chunks)} chunks")
+    return chunks
+
+def split_map_output(text):
+    """ A map answer is data dictionary rows, then a SUMMARY_MARKER line, then the summary. Returns (rows, summary)."""
+    rows_part,_,summary=text.partition(SUMMARY_MARKER)
+    rows=[]
+    for line in rows_part.splitlines():
+        line=line.strip()
+        if not line.startswith('|'):
+            continue
+        cells=[cell.strip() for cell in line.strip('|').split('|')]
+        # models sometimes repeat the header and separator rows in every chunk
+        if all(set(cell)<=set('-: ') for cell in cells) or cells[:2]==["Table","Column/Measure"]:
+            continue
+        rows.append(line)
+    return rows,summary.strip()
+
+def collect_map_results(map_sections,results):
+    """ Rows of all chunks in chunk order, and the non-empty chunk summaries for the reduce prompt."""
+    rows=[]
+    summaries=[]
+    for section in map_sections:
+        chunk_rows,summary=split_map_output(results.get(section.key,""))
+        rows.extend(chunk_rows)
+        if summary:
+            summaries.append(summary)
+    return rows,summaries
+
+def assemble_map_reduce(reduce_text,rows,other_sections=(),results=None):
+    """ Reduce output (overview, data flow), the other sections (already generated alongside the map), then the data dictionary."""
+    parts=[reduce_text.strip()]
+    for section in other_sections:
+        text=(results or {}).get(section.key,"").strip()
+        if text:
+            parts.append(f"## {section.title}\n\n{text}")
+    if rows:
+        parts.append("## Data Dictionary\n\n"+DICTIONARY_HEADER+"\n"+'\n'.join(rows))
+    return '\n\n'.join(part for part in parts if part)
@@ -1,82 +1,395 @@
+import re
 from io import BytesIO
 from docx import Document
 from docx.shared import Inches, Pt
-import markdown2
+from docx.oxml.ns import qn
+from lxml import etree
 import streamlit as st
-from bs4 import BeautifulSoup
-# add this to requirements.txt : pip install python-docx markdown2 beautifulsoup4
-def markdown_to_docx(markdown_text):
-    """Convert Markdown to DOCX, preserving headings, paragraphs, lists, and tables with proper nesting and formatting."""
-    try:
-        html = markdown2.markdown(markdown_text, extras=["tables", "fenced-code-blocks", "strike", "underline"])
-        soup = BeautifulSoup(html, 'html.parser')
-        doc = Document()
-        list_number = 1
-
-        def add_list_item(text, style, indent_level):
-            p = doc.add_paragraph(style=style)
-            run = p.add_run(text.lstrip())
-            run.font.size = Pt(11)
-            indent = Inches(0.15 * indent_level)
-            p.paragraph_format.left_indent = indent
-            p.paragraph_format.first_line_indent = indent
-            p.paragraph_format.space_after = Pt(2)
-
-        def process_list(element, indent_level, ordered=False):
-            nonlocal list_number
-            for li in element.find_all('li', recursive=False):
-                text = BeautifulSoup(''.join(str(c) for c in li.contents if c.name not in ['ul', 'ol']), 'html.parser').get_text().strip()
-                if ordered:
-                    add_list_item(f"{list_number}. {text}", style='Normal', indent_level=indent_level)
-                    list_number += 1
-                else:
-                    add_list_item(text, style='List Bullet', indent_level=indent_level)
+# The markdown is walked line by line into block tokens (headings, paragraphs, list items, tables, code blocks) that are written
+# straight into python-docx, instead of rendering it to HTML and parsing that back with BeautifulSoup (which parsed every list item
+# a second time). Inline **bold**, *italic*, `code` and ~~strike~~ become formatted runs instead of being flattened to plain text.
+# Only the markdown the model writes is supported : ATX headings, paragraphs, nested -/*/+ and numbered lists, pipe tables,
+# fenced code blocks, block quotes and horizontal rules (which are skipped).
+# Tables are written as XML, a row at once (see TableWriter) : python-docx's add_row/cells API costs several ms per row on data
+# dictionaries with thousands of rows.
+# DocxBuilder does the conversion while the documentation streams (fed the deltas), so the DOCX is ready when the last token arrives
+# instead of being built from the whole markdown afterwards. markdown_to_docx is the same on a complete text.
+
+_HEADING=re.compile(r'^ {0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+_LIST_ITEM=re.compile(r'^([ \t]*)([-*+]|\d{1,9}[.)])[ \t]+(.*)$')
+_FENCE=re.compile(r'^[ \t]*(`{3,}|~{3,})')
+_RULE=re.compile(r'^ {0,3}([-*_])(?:[ \t]*\1){2,}[ \t]*$')
+_TABLE_SEPARATOR=re.compile(r'^[ \t]*\|?[ \t]*:?-+:?[ \t]*(\|[ \t]*:?-+:?[ \t]*)*\|?[ \t]*$')
+_QUOTE=re.compile(r'^ {0,3}> ?')
+_CELL_SEPARATOR=re.compile(r'(?<!\\)\|')
+_INLINE=re.compile(
+    r'(?P<code>`+)(?P<code_text>.+?)(?P=code)'
+    r'|\*\*(?P<bold>.+?)\*\*|__(?P<bold2>.+?)__'
+    r'|~~(?P<strike>.+?)~~'
+    r'|\*(?P<italic>[^\s*](?:.*?[^\s])?)\*|(?<!\w)_(?P<italic2>[^\s_](?:.*?[^\s])?)_(?!\w)'
+    r'|!?\[(?P<link>[^\]]*)\]\([^)]*\)'
+    r'|\\(?P<escaped>[\\`*_{}\[\]()#+\-.!|~>])')
+
+def _indent_width(indent):
+    return len(indent.expandtabs(4))
+
+def _split_row(line):
+    """ Cells of a pipe table row. Escaped \\| stay in the cell."""
+    line=line.strip()
+    if line.startswith('|'):
+        line=line[1:]
+    if line.endswith('|') and not line.endswith('\\|'):
+        line=line[:-1]
+    return [cell.strip().replace('\\|','|') for cell in _CELL_SEPARATOR.split(line)]
+
+class MarkdownTokenizer:
+    """ Block tokens of markdown fed line by line. A token is out (in tokens) as soon as the block is closed, which for most blocks is
+    only known from the next line : a paragraph at the next blank line, a list item at the next line that doesn't continue it.
+    Tokens, in order :
+    ("heading", level, text), ("paragraph", text), ("list_item", depth, ordered, text), ("code", text),
+    ("table", [header cell texts]) followed by a ("table_row", [cell texts]) per row of the table"""
+    def __init__(self):
+        self.tokens=[]
+        self._paragraph=[]
+        self._list_indents=[] # indentation of the open list levels, the depth of an item is its position in there
+        self._item=None # last list item, continuation lines are appended to it until another block starts
+        self._header=None # (line, line before it) of a line with | that starts a table if the next line is a separator
+        self._in_table=False
+        self._fence=None # fence of the open code block
+        self._code=[]
+        self._previous=""
+
+    def _flush(self):
+        if self._paragraph:
+            self.tokens.append(("paragraph",'\n'.join(self._paragraph)))
+            self._paragraph.clear()
 
-                for nested in li.find_all(['ul', 'ol'], recursive=False):
-                    process_list(nested, indent_level + 1, ordered=(nested.name == 'ol'))
+    def _close_item(self):
+        if self._item is not None:
+            self.tokens.append(self._item)
+            self._item=None
 
-        def add_table(table_element):
-            rows = table_element.find_all('tr')
-            if not rows:
+    def _start_block(self):
+        self._flush()
+        self._close_item()
+        self._list_indents.clear()
+
+    def feed_line(self,line):
+        if self._fence is not None:
+            if line.strip().startswith(self._fence):
+                self.tokens.append(("code",'\n'.join(self._code)))
+                self._fence=None
+                self._code=[]
+            else:
+                self._code.append(line)
+            self._previous=line
+            return
+        if self._in_table:
+            if line.strip() and '|' in line:
+                self.tokens.append(("table_row",_split_row(line)))
+                self._previous=line
+                return
+            self._in_table=False
+        if self._header is not None:
+            header,before=self._header
+            self._header=None
+            if _TABLE_SEPARATOR.match(line):
+                self._start_block()
+                self.tokens.append(("table",_split_row(header)))
+                self._in_table=True
+                self._previous=line
                 return
-            cols = rows[0].find_all(['td', 'th'])
-            table = doc.add_table(rows=1, cols=len(cols))
-            table.style = 'Table Grid'
-            for i, cell in enumerate(cols):
-                table.rows[0].cells[i].text = cell.text.strip()
-            for row in rows[1:]:
-                cells = row.find_all(['td', 'th'])
-                row_cells = table.add_row().cells
-                for i, cell in enumerate(cells):
-                    row_cells[i].text = cell.text.strip()
-            doc.add_paragraph()
-
-        for element in soup.contents:
-            if not hasattr(element, 'name'):
+            self._text(header,before)
+        self._line(line)
+        self._previous=line
+
+    def _line(self,line):
+        if not line.strip():
+            self._flush()
+            return
+        fence=_FENCE.match(line)
+        if fence:
+            self._start_block()
+            self._fence=fence.group(1)
+            return
+        heading=_HEADING.match(line)
+        if heading:
+            self._start_block()
+            self.tokens.append(("heading",len(heading.group(1)),heading.group(2)))
+            return
+        if _RULE.match(line):
+            self._start_block()
+            return
+        if '|' in line:
+            self._header=(line,self._previous) # a table header or not, the next line tells
+            return
+        self._text(line,self._previous)
+
+    def _text(self,line,previous):
+        """ A list item, the continuation of the last one, or a line of paragraph."""
+        item=_LIST_ITEM.match(line)
+        if item:
+            self._flush()
+            self._close_item()
+            indent=_indent_width(item.group(1))
+            while self._list_indents and indent<self._list_indents[-1]:
+                self._list_indents.pop()
+            if not self._list_indents or indent>self._list_indents[-1]:
+                self._list_indents.append(indent)
+            self._item=("list_item",len(self._list_indents)-1,item.group(2)[0].isdigit(),item.group(3).strip())
+            return
+        text=_QUOTE.sub('',line).strip()
+        if not self._paragraph and self._item is not None and (previous.strip() or line[:1] in (' ','\t')):
+            # continuation of the last list item : the next line, or an indented line after a blank one
+            kind,depth,ordered,item_text=self._item
+            self._item=(kind,depth,ordered,f"{item_text} {text}")
+            return
+        self._close_item()
+        self._list_indents.clear()
+        self._paragraph.append(text)
+
+    def close(self):
+        """ Closes whatever block is still open at the end of the markdown."""
+        if self._fence is not None:
+            self.tokens.append(("code",'\n'.join(self._code)))
+            self._fence=None
+        if self._header is not None:
+            header,before=self._header
+            self._header=None
+            self._text(header,before)
+        self._in_table=False
+        self._flush()
+        self._close_item()
+
+    def take(self):
+        """ The tokens out since the last call."""
+        tokens,self.tokens=self.tokens,[]
+        return tokens
+
+def tokenize(markdown_text):
+    """ All the block tokens of markdown_text (see MarkdownTokenizer)."""
+    tokenizer=MarkdownTokenizer()
+    for line in markdown_text.splitlines():
+        tokenizer.feed_line(line)
+    tokenizer.close()
+    return tokenizer.take()
+
+def inline_runs(text,bold=False,italic=False,strike=False):
+    """ [(text, bold, italic, code, strike)] of the inline markdown in text."""
+    runs=[]
+    position=0
+    for match in _INLINE.finditer(text):
+        if match.start()>position:
+            runs.append((text[position:match.start()],bold,italic,False,strike))
+        groups=match.groupdict()
+        if groups["code"]:
+            runs.append((groups["code_text"].strip(),bold,italic,True,strike))
+        elif groups["bold"] is not None or groups["bold2"] is not None:
+            runs.extend(inline_runs(groups["bold"] if groups["bold"] is not None else groups["bold2"],True,italic,strike))
+        elif groups["strike"] is not None:
+            runs.extend(inline_runs(groups["strike"],bold,italic,True))
+        elif groups["italic"] is not None or groups["italic2"] is not None:
+            runs.extend(inline_runs(groups["italic"] if groups["italic"] is not None else groups["italic2"],bold,True,strike))
+        elif groups["link"] is not None:
+            runs.extend(inline_runs(groups["link"],bold,italic,strike))
+        else:
+            runs.append((groups["escaped"],bold,italic,False,strike))
+        position=match.end()
+    if position<len(text):
+        runs.append((text[position:],bold,italic,False,strike))
+    return runs
+
+# characters XML 1.0 doesn't allow, lxml refuses them
+_XML_INVALID=re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_SPACE=qn('xml:space')
+
+def add_runs(paragraph,text,bold=False,size=None):
+    """ Adds the inline markdown of text to a python-docx paragraph as formatted runs."""
+    for run_text,run_bold,run_italic,code,strike in inline_runs(_XML_INVALID.sub('',text),bold):
+        run=paragraph.add_run(run_text)
+        if run_bold:
+            run.bold=True
+        if run_italic:
+            run.italic=True
+        if strike:
+            run.font.strike=True
+        if code:
+            run.font.name='Consolas'
+        if size is not None:
+            run.font.size=size
+
+def _cell_element(text,width):
+    """ <w:tc> of one table cell with the inline markdown of text as runs."""
+    tc=etree.Element(qn('w:tc'))
+    tcW=etree.SubElement(etree.SubElement(tc,qn('w:tcPr')),qn('w:tcW'))
+    tcW.set(qn('w:w'),width)
+    tcW.set(qn('w:type'),'dxa')
+    p=etree.SubElement(tc,qn('w:p'))
+    for run_text,bold,italic,code,strike in inline_runs(_XML_INVALID.sub('',text)):
+        r=etree.SubElement(p,qn('w:r'))
+        if bold or italic or code or strike:
+            rPr=etree.SubElement(r,qn('w:rPr')) # children in the order of the schema
+            if code:
+                fonts=etree.SubElement(rPr,qn('w:rFonts'))
+                fonts.set(qn('w:ascii'),'Consolas')
+                fonts.set(qn('w:hAnsi'),'Consolas')
+            if bold:
+                etree.SubElement(rPr,qn('w:b'))
+            if italic:
+                etree.SubElement(rPr,qn('w:i'))
+            if strike:
+                etree.SubElement(rPr,qn('w:strike'))
+        t=etree.SubElement(r,qn('w:t'))
+        t.text=run_text
+        if run_text!=run_text.strip():
+            t.set(_SPACE,'preserve')
+    return tc
+
+class TableWriter:
+    """ Writes the rows of a table into doc as they come, each as XML at once. A row wider than the table widens it (the earlier rows
+    are padded with empty cells and the columns resized), so no cell of a ragged table is lost."""
+    def __init__(self,doc,columns,style='Table Grid'):
+        self.table=doc.add_table(rows=0,cols=columns) # tblPr and tblGrid with the column widths, the rows are added below
+        self.table.style=style
+        self._tbl=self.table._tbl
+        self._grid=self._tbl.tblGrid
+        self.widths=[grid_col.get(qn('w:w')) for grid_col in self._grid.iterchildren(qn('w:gridCol'))]
+
+    def _widen(self,columns):
+        width=str(sum(int(w) for w in self.widths)//columns)
+        for _ in range(columns-len(self.widths)):
+            etree.SubElement(self._grid,qn('w:gridCol'))
+        for grid_col in self._grid.iterchildren(qn('w:gridCol')):
+            grid_col.set(qn('w:w'),width)
+        for tcW in self._tbl.iter(qn('w:tcW')):
+            tcW.set(qn('w:w'),width)
+        for tr in self._tbl.iterchildren(qn('w:tr')):
+            for _ in range(columns-len(self.widths)):
+                tr.append(_cell_element("",width))
+        self.widths=[width]*columns
+
+    def add_row(self,row):
+        if len(row)>len(self.widths):
+            self._widen(len(row))
+        tr=etree.SubElement(self._tbl,qn('w:tr'))
+        for i,width in enumerate(self.widths):
+            tr.append(_cell_element(row[i] if i<len(row) else "",width))
+
+def add_table(doc,rows,style='Table Grid'):
+    """ Adds a table of rows (lists of cell markdown) to doc."""
+    writer=TableWriter(doc,max(len(row) for row in rows),style)
+    for row in rows:
+        writer.add_row(row)
+    return writer.table
+
+class DocxBuilder:
+    """ Markdown to DOCX while the markdown streams in : feed() every delta and each block is written into the document as soon as it's
+    closed (a table row at the end of its line), so at the last delta only the last block and the save are left for close().
+    feed() never raises, a conversion error is printed by close(), which returns None then, like markdown_to_docx."""
+    def __init__(self):
+        self.doc=Document()
+        self._tokenizer=MarkdownTokenizer()
+        self._partial="" # text after the last complete line
+        self._list_number=1
+        self._table=None
+        self._error=None
+        self._result=None
+        # Style ids are resolved once and set on the paragraph's XML : p.style= scans every style of the document (to find the
+        # default one) on each call, which was most of the time of long lists. Normal is the default style, so it needs no id.
+        self._style_ids={'Normal':None,'List Bullet':self.doc.styles['List Bullet'].style_id}
+
+    def feed(self,delta):
+        if self._error is not None or self._result is not None:
+            return
+        try:
+            self._partial+=delta
+            end=self._partial.rfind('\n')
+            if end<0:
+                return
+            complete,self._partial=self._partial[:end+1],self._partial[end+1:]
+            for line in complete.splitlines():
+                self._tokenizer.feed_line(line)
+            self._write(self._tokenizer.take())
+        except Exception as e:
+            self._error=e
+
+    def stream(self,deltas):
+        """ Passes the deltas through, feeding them on the way (e.g. st.write_stream(builder.stream(deltas)))."""
+        for delta in deltas:
+            self.feed(delta)
+            yield delta
+
+    def close(self):
+        """ The DOCX (BytesIO), or None if the markdown couldn't be converted. Later calls return the same result."""
+        if self._result is None and self._error is None:
+            try:
+                for line in self._partial.splitlines():
+                    self._tokenizer.feed_line(line)
+                self._partial=""
+                self._tokenizer.close()
+                self._write(self._tokenizer.take())
+                buffer=BytesIO()
+                self.doc.save(buffer)
+                self._result=buffer.getvalue()
+            except Exception as e:
+                self._error=e
+            if self._error is not None:
+                print(f"Error converting to DOCX: {self._error}")
+        return BytesIO(self._result) if self._result is not None else None
+
+    def _add_list_item(self,text,style,indent_level,prefix=""):
+        p=self.doc.add_paragraph()
+        if self._style_ids[style] is not None:
+            p._p.get_or_add_pPr().style=self._style_ids[style]
+        if prefix:
+            p.add_run(prefix).font.size=Pt(11)
+        add_runs(p,text,size=Pt(11))
+        indent=Inches(0.15*indent_level)
+        p.paragraph_format.left_indent=indent
+        p.paragraph_format.first_line_indent=indent
+        p.paragraph_format.space_after=Pt(2)
+
+    def _write(self,tokens):
+        doc=self.doc
+        for token in tokens:
+            kind=token[0]
+            if kind=="table_row":
+                self._table.add_row(token[1])
                 continue
-            tag = element.name
-            if tag in ['h1', 'h2', 'h3']:
-                level = int(tag[1])
-                p = doc.add_heading('', level=level)
-                run = p.add_run(element.text.strip())
-                run.bold = True
-                p.paragraph_format.space_after = Pt(6)
-                list_number = 1
-            elif tag == 'p':
-                p = doc.add_paragraph(element.text.strip())
-                p.paragraph_format.space_after = Pt(6)
-            elif tag == 'ul':
-                process_list(element, indent_level=0, ordered=False)
-            elif tag == 'ol':
-                process_list(element, indent_level=0, ordered=True)
-            elif tag == 'table':
-                add_table(element)
-
-        buffer = BytesIO()
-        doc.save(buffer)
-        buffer.seek(0)
-        return buffer
+            self._table=None
+            if kind=="heading":
+                p=doc.add_heading('',level=token[1])
+                add_runs(p,token[2],bold=True)
+                p.paragraph_format.space_after=Pt(6)
+                self._list_number=1
+            elif kind=="paragraph":
+                p=doc.add_paragraph()
+                add_runs(p,token[1])
+                p.paragraph_format.space_after=Pt(6)
+            elif kind=="list_item":
+                _,depth,ordered,text=token
+                if ordered:
+                    self._add_list_item(text,style='Normal',indent_level=depth,prefix=f"{self._list_number}. ")
+                    self._list_number+=1
+                else:
+                    self._add_list_item(text,style='List Bullet',indent_level=depth)
+            elif kind=="table":
+                self._table=TableWriter(doc,len(token[1]))
+                self._table.add_row(token[1])
+                doc.add_paragraph() # after the table, its rows go into the table element
+            elif kind=="code":
+                p=doc.add_paragraph()
+                run=p.add_run(_XML_INVALID.sub('',token[1]))
+                run.font.name='Consolas'
+                run.font.size=Pt(9)
+                p.paragraph_format.space_after=Pt(6)
 
+def markdown_to_docx(markdown_text):
+    """Convert Markdown to DOCX, preserving headings, paragraphs, lists, and tables with proper nesting and formatting."""
+    try:
+        builder=DocxBuilder()
     except Exception as e:
         print(f"Error converting to DOCX: {e}")
-        return None
\ No newline at end of file
+        return None
+    builder.feed(markdown_text)
+    return builder.close()
@@ -0,0 +1,245 @@
+import os
+import json
+import mmap
+import zipfile
+import logging
+from typing import NamedTuple
+logger=logging.getLogger(__name__)
+# Zip ingestion for .pbip projects.
+# A zipped .Report + .SemanticModel carries a lot of members we never send to the model : StaticResources images, base themes,
+# cultures/*.tmdl (1.5 MB in some reports), diagramLayout.json, the auto generated LocalDate/DateTableTemplate tables, etc.
+# Everything here is decided from the zip central directory (names and sizes) alone, so only the wanted members are ever decompressed.
+# .pbip project folders (batch mode, servers reading from a share) are read in place instead, see ingest_powerbi_folder.
+
+REPORT="report"
+RELATIONSHIPS="relationships"
+TABLE="table"
+SKIPPED="skipped"
+
+class IngestionLimits(NamedTuple):
+    """ Caps checked against the central directory before anything is decompressed."""
+    max_member_bytes: int = 64*1024*1024   # a single report.json or .tmdl file
+    max_total_bytes: int = 256*1024*1024   # sum of all the members we decide to read
+    max_members: int = 50000               # entries in the central directory
+    max_compression_ratio: int = 200       # uncompressed/compressed, guards against zip bombs
+
+DEFAULT_LIMITS=IngestionLimits()
+
+class ZipIngestionError(ValueError):
+    """ Raised when the uploaded zip is not a readable/acceptable Power BI project."""
+
+class PowerBIProject(NamedTuple):
+    """ Members extracted from a zipped .pbip project."""
+    report: str
+    relationships: str
+    tables: list
+    table_names: list
+    bytes_read: int
+    skipped_members: int
+
+    @property
+    def semantic_model(self):
+        """ .tmdl texts with relationships.tmdl (if any) always first, which is what ERDiagramFromTMDL expects."""
+        if self.relationships:
+            return [self.relationships]+self.tables
+        return list(self.tables)
+
+def classify_member(filename):
+    """ Decides what a zip member is from its name only."""
+    if filename.endswith('/'):
+        return SKIPPED
+    if filename.endswith('report.json'):
+        return REPORT
+    if not filename.endswith('.tmdl'):
+        return SKIPPED
+    # /cultures/ has a .tmdl file which is language specific and lists out all the nouns and verbs in the whole report, which is very long and not useful to the model.
+    # LocalDate and DateTableTemplate tables are auto generated by Power BI for every date column and only add noise.
+    if "/LocalDate" in filename or "/DateTableTemplate" in filename:
+        return SKIPPED
+    if filename.endswith('relationships.tmdl'):
+        return RELATIONSHIPS
+    if "/tables/" in filename:
+        return TABLE
+    return SKIPPED
+
+def plan_members(infolist,limits=DEFAULT_LIMITS):
+    """ Classifies the central directory entries and enforces the size caps. Returns [(kind, ZipInfo)] of members to read."""
+    if len(infolist)>limits.max_members:
+        raise ZipIngestionError(f"Zip has {len(infolist)} entries, more than the allowed {limits.max_members}")
+    planned=[]
+    total=0
+    for info in infolist:
+        kind=classify_member(info.filename)
+        if kind==SKIPPED:
+            continue
+        if info.file_size>limits.max_member_bytes:
+            raise ZipIngestionError(f"{info.filename} is {info.file_size} bytes, more than the allowed {limits.max_member_bytes}")
+        if info.compress_size>0 and info.file_size/info.compress_size>limits.max_compression_ratio:
+            raise ZipIngestionError(f"{info.filename} has a suspicious compression ratio, refusing to extract it")
+        total+=info.file_size
+        if total>limits.max_total_bytes:
+            raise ZipIngestionError(f"Report and semantic model files exceed {limits.max_total_bytes} bytes uncompressed")
+        planned.append((kind,info))
+    return planned
+
+def _read_member(zip_ref,info,limits):
+    """ Decompresses one member, never reading past the cap even if the header lies about file_size."""
+    with zip_ref.open(info) as member:
+        data=member.read(limits.max_member_bytes+1)
+    if len(data)>limits.max_member_bytes:
+        raise ZipIngestionError(f"{info.filename} is larger than the allowed {limits.max_member_bytes} bytes")
+    return data.decode('utf-8-sig')
+
+def ingest_powerbi_zip(zip_file,limits=DEFAULT_LIMITS):
+    """ Reads report.json, relationships.tmdl and the table .tmdl files out of a zipped .pbip project. zip_file can be a path or any file-like object."""
+    report=""
+    relationships=""
+    tables=[]
+    table_names=[]
+    bytes_read=0
+    try:
+        with zipfile.ZipFile(zip_file,'r') as zip_ref:
+            infolist=zip_ref.infolist()
+            planned=plan_members(infolist,limits)
+            logger.debug(f"Reading {len(planned)} of {len(infolist)} zip members")
+            for kind,info in planned:
+                text=_read_member(zip_ref,info,limits)
+                bytes_read+=info.file_size
+                if kind==REPORT:
+                    # .Report.zip uploads or projects with several reports : keep the first report.json, like before.
+                    if report=="":
+                        report=text
+                elif kind==RELATIONSHIPS:
+                    relationships=text
+                else:
+                    tables.append(text)
+                    table_names.append(info.filename.rsplit('/',1)[-1][:-len('.tmdl')])
+    except zipfile.BadZipFile as e:
+        raise ZipIngestionError(f"Not a valid zip file : {e}") from e
+    logger.debug(f"Read {bytes_read} bytes : report.json = {len(report)} chars, {len(tables)} tables, relationships = {len(relationships)} chars")
+    return PowerBIProject(report,relationships,tables,table_names,bytes_read,len(infolist)-len(planned))
+
+# Folder ingestion for .pbip projects, without zipping them first.
+# The .pbip file points to the .Report folder and its definition.pbir to the .SemanticModel folder (datasetReference.byPath), so only
+# report.json, definition/relationships.tmdl and definition/tables/*.tmdl are ever opened, with the same skips and caps as the zip.
+# Large files (report.json is often over a MB) are memory-mapped and decoded straight from the mapping, without a bytes copy.
+MMAP_MIN_BYTES=64*1024
+
+class FolderIngestionError(ValueError):
+    """ Raised when a folder is not a readable/acceptable .pbip project."""
+
+def _read_json(path):
+    try:
+        with open(path,encoding='utf-8-sig') as f:
+            return json.load(f)
+    except (OSError,ValueError) as e:
+        raise FolderIngestionError(f"Can't read {path} : {e}") from e
+
+def resolve_pbip_project(path):
+    """ (.Report folder, .SemanticModel folder or None) of a .pbip file, a folder holding one, or a .Report folder.
+    A report on a live connection (datasetReference.byConnection) has no semantic model folder."""
+    if os.path.isdir(path) and not path.rstrip('/\\').endswith('.Report'):
+        pbip_files=sorted(entry for entry in os.listdir(path) if entry.endswith('.pbip'))
+        if not pbip_files:
+            raise FolderIngestionError(f"No .pbip file or .Report folder in {path}")
+        path=os.path.join(path,pbip_files[0])
+    if os.path.isfile(path):
+        reports=[artifact["report"]["path"] for artifact in _read_json(path).get("artifacts",[]) if "report" in artifact]
+        if not reports:
+            raise FolderIngestionError(f"{path} has no report artifact")
+        report_dir=os.path.normpath(os.path.join(os.path.dirname(path),reports[0]))
+    else:
+        report_dir=os.path.normpath(path)
+    if not os.path.isdir(report_dir):
+        raise FolderIngestionError(f"Report folder {report_dir} not found")
+    definition=os.path.join(report_dir,"definition.pbir")
+    if os.path.isfile(definition):
+        by_path=_read_json(definition).get("datasetReference",{}).get("byPath")
+        semantic_model_dir=os.path.normpath(os.path.join(report_dir,by_path["path"])) if by_path else None
+    else:
+        # older projects without definition.pbir : the .SemanticModel next to the .Report
+        semantic_model_dir=report_dir[:-len(".Report")]+".SemanticModel"
+    if semantic_model_dir is not None and not os.path.isdir(semantic_model_dir):
+        semantic_model_dir=None
+    return report_dir,semantic_model_dir
+
+def plan_project_files(report_dir,semantic_model_dir,limits=DEFAULT_LIMITS):
+    """ Classifies the files the project would have in a zip, from their names and sizes alone, and enforces the size caps.
+    Returns ([(kind, path, size)] of files to read, number of skipped .tmdl files)."""
+    candidates=[(f"{os.path.basename(report_dir)}/report.json",os.path.join(report_dir,"report.json"))]
+    if semantic_model_dir is not None:
+        prefix=f"{os.path.basename(semantic_model_dir)}/definition"
+        definition=os.path.join(semantic_model_dir,"definition")
+        candidates.append((f"{prefix}/relationships.tmdl",os.path.join(definition,"relationships.tmdl")))
+        try:
+            with os.scandir(os.path.join(definition,"tables")) as entries:
+                candidates+=sorted((f"{prefix}/tables/{entry.name}",entry.path) for entry in entries if entry.is_file())
+        except FileNotFoundError:
+            pass
+    if len(candidates)>limits.max_members:
+        raise FolderIngestionError(f"Project has {len(candidates)} files, more than the allowed {limits.max_members}")
+    planned=[]
+    skipped=0
+    total=0
+    for name,path in candidates:
+        kind=classify_member(name)
+        if kind==SKIPPED:
+            skipped+=1
+            continue
+        try:
+            size=os.stat(path).st_size
+        except FileNotFoundError:
+            continue # no relationships.tmdl, or a report without report.json
+        if size>limits.max_member_bytes:
+            raise FolderIngestionError(f"{name} is {size} bytes, more than the allowed {limits.max_member_bytes}")
+        total+=size
+        if total>limits.max_total_bytes:
+            raise FolderIngestionError(f"Report and semantic model files exceed {limits.max_total_bytes} bytes")
+        planned.append((kind,path,size))
+    return planned,skipped
+
+def _read_file(path,limits):
+    """ Text of a file, memory-mapped from MMAP_MIN_BYTES on, never reading past the cap even if it grew since it was planned."""
+    with open(path,'rb') as f:
+        size=os.fstat(f.fileno()).st_size
+        if size>limits.max_member_bytes:
+            raise FolderIngestionError(f"{path} is larger than the allowed {limits.max_member_bytes} bytes")
+        if size<MMAP_MIN_BYTES:
+            return f.read(size).decode('utf-8-sig')
+        with mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+            return str(view,'utf-8-sig')
+
+def ingest_powerbi_folder(path,limits=DEFAULT_LIMITS):
+    """ Reads report.json, relationships.tmdl and the table .tmdl files of a .pbip project folder (see resolve_pbip_project for path)."""
+    report_dir,semantic_model_dir=resolve_pbip_project(path)
+    planned,skipped=plan_project_files(report_dir,semantic_model_dir,limits)
+    report=""
+    relationships=""
+    tables=[]
+    table_names=[]
+    bytes_read=0
+    for kind,file_path,size in planned:
+        try:
+            text=_read_file(file_path,limits)
+        except (OSError,UnicodeDecodeError) as e:
+            raise FolderIngestionError(f"Can't read {file_path} : {e}") from e
+        bytes_read+=size
+        if kind==REPORT:
+            report=text
+        elif kind==RELATIONSHIPS:
+            relationships=text
+        else:
+            tables.append(text)
+            table_names.append(os.path.basename(file_path)[:-len('.tmdl')])
+    logger.debug(f"Read {bytes_read} bytes from {report_dir} : report.json = {len(report)} chars, {len(tables)} tables, relationships = {len(relationships)} chars")
+    return PowerBIProject(report,relationships,tables,table_names,bytes_read,skipped)
+
+class PowerBIFileContents(NamedTuple):
+    """ What PowerBIProcessor.process returns. semantic_model has the raw .tmdl texts (relationships.tmdl first), model is the SemanticModel parsed from them, er_diagram the laid out tmdl_to_er.ERDiagram (None if Graphviz failed),
+    layout the report_layout.ReportLayout read from report.json.
+    Lives here and not in app.py so it can be pickled by the on-disk upload cache."""
+    report: str
+    semantic_model: list
+    model: object
+    er_diagram: object
+    layout: object
@@ -0,0 +1,197 @@
+import io
+import os
+import sys
+import glob
+import json
+import time
+import zipfile
+import logging
+import platform
+import argparse
+import subprocess
+import tracemalloc
+from datetime import datetime,timezone
+# Benchmark of every stage of the pipeline over the .pbip projects of testing_zip, zipped the way users do (the .Report and
+# .SemanticModel folders in one zip; the .Report.zip files as they are). Each stage is timed (best of --repeat) and run once more
+# under tracemalloc for its peak Python memory, on its own with the outputs of the previous stages as input :
+#   ingestion      pbip_ingestion.ingest_powerbi_zip
+#   ingestion_folder  pbip_ingestion.ingest_powerbi_folder of the same project read in place (.pbip projects only)
+#   tmdl_parse     tmdl_parser.parse_tmdl
+#   relationships  tables and relationships of the ER diagram (ERDiagramFromTMDL.parse_tmdl_files/parse_relationships)
+#   er_render      layout and preview of the ER diagram (skipped without the Graphviz binaries)
+#   report_digest  report_layout.ReportLayout and the report digest
+#   prompt         PowerBIContext.set_context and set_section_contexts, with the prompt sizes in tokens
+#   docx           markdown_to_docx of the sample documentation in testing_zip
+#   docx_dictionary  markdown_to_docx of a synthetic data dictionary of --dictionary-rows rows (the large-model case)
+# Results are written as JSON (--output) with the commit they were measured on, and --compare prints the change against an earlier
+# results file, so a regression shows up from one commit to the next.
+#
+#   python pipeline_benchmark.py --output bench_$(git rev-parse --short HEAD).json --compare bench_previous.json
+
+DEFAULT_TESTING_ZIP=os.path.join(os.path.dirname(os.path.abspath(__file__)),*[".."]*5,"testing_zip")
+
+def zip_project(testing_zip,name):
+    """ Zip bytes of the .Report and .SemanticModel folders of project name, with the folders at the root of the zip."""
+    buffer=io.BytesIO()
+    with zipfile.ZipFile(buffer,'w',zipfile.ZIP_DEFLATED) as zip_file:
+        for folder in (f"{name}.Report",f"{name}.SemanticModel"):
+            for directory,_,files in os.walk(os.path.join(testing_zip,folder)):
+                for file_name in files:
+                    path=os.path.join(directory,file_name)
+                    zip_file.write(path,os.path.relpath(path,testing_zip))
+    return buffer.getvalue()
+
+def projects(testing_zip):
+    """ (name, zip bytes) of every project of testing_zip."""
+    for path in sorted(glob.glob(os.path.join(testing_zip,"*.Report"))):
+        name=os.path.basename(path)[:-len(".Report")]
+        yield name,zip_project(testing_zip,name)
+    for path in sorted(glob.glob(os.path.join(testing_zip,"*.Report.zip"))):
+        with open(path,'rb') as f:
+            yield os.path.basename(path)[:-len(".Report.zip")],f.read()
+
+def synthetic_dictionary(rows):
+    """ Markdown of a data dictionary section with rows rows, shaped like the ones the model writes."""
+    from map_reduce import DICTIONARY_HEADER
+    lines=[f"| Table {i//25} | {'Measure' if i%5==0 else 'Column'} {i} | `Int64` | **Key** of the *fact* table, used by {i%7} visuals |" for i in range(rows)]
+    return "## Data Dictionary\n\n"+DICTIONARY_HEADER+"\n"+'\n'.join(lines)+"\n"
+
+def measure(repeat,function):
+    """ (result, best seconds, peak bytes) of function(), after one warm-up call (imports, tokenizer loading, ...)."""
+    result=function()
+    best=float('inf')
+    for _ in range(repeat):
+        start=time.perf_counter()
+        function()
+        best=min(best,time.perf_counter()-start)
+    tracemalloc.start()
+    try:
+        function()
+        _,peak=tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result,best,peak
+
+def graphviz_available():
+    try:
+        subprocess.run(["dot","-V"],capture_output=True,check=True)
+        return True
+    except (OSError,subprocess.CalledProcessError):
+        return False
+
+def commit():
+    try:
+        return subprocess.run(["git","rev-parse","HEAD"],capture_output=True,text=True,check=True,cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+def benchmark_project(name,data,repeat,render_er,folder=None):
+    # imported here so that importing this module doesn't import Streamlit
+    from pbip_ingestion import ingest_powerbi_zip,ingest_powerbi_folder,PowerBIFileContents
+    from tmdl_parser import parse_tmdl
+    from tmdl_to_er import ERDiagramFromTMDL,layout_with_preview,_layouts
+    from report_layout import ReportLayout
+    from prompt_compaction import digest_report,count_tokens
+    from app import PowerBIContext
+    results=[]
+    def record(stage,function,**extra):
+        result,seconds,peak=measure(repeat,function)
+        results.append({"project":name,"stage":stage,"seconds":seconds,"peak_bytes":peak,**extra})
+        return result
+    project=record("ingestion",lambda:ingest_powerbi_zip(io.BytesIO(data)),zip_bytes=len(data))
+    results[-1].update(bytes_read=project.bytes_read,tables=len(project.tables))
+    if folder is not None:
+        record("ingestion_folder",lambda:ingest_powerbi_folder(folder))
+    model=record("tmdl_parse",lambda:parse_tmdl(project.semantic_model))
+    def relationships():
+        diagram=ERDiagramFromTMDL(model)
+        diagram.parse_tmdl_files()
+        diagram.parse_relationships()
+        return diagram
+    diagram=record("relationships",relationships)
+    results[-1].update(relationships=len(diagram.foreign_keys))
+    def er_render():
+        _layouts.clear() # measure the layout, not the layout cache
+        return layout_with_preview(model)
+    if render_er:
+        record("er_render",er_render)
+    def report_digest():
+        layout=ReportLayout.from_json(project.report)
+        digest_report(layout)
+        return layout
+    layout=record("report_digest",report_digest,report_bytes=len(project.report.encode('utf-8')))
+    file_contents=PowerBIFileContents(project.report,project.semantic_model,model,None,layout)
+    def prompts():
+        context=PowerBIContext(file_contents,"")
+        return context.set_context(),context.set_section_contexts()
+    prompt,sections=record("prompt",prompts)
+    results[-1].update(prompt_tokens=count_tokens(prompt[0])+count_tokens(prompt[1]),section_prompt_tokens=sum(count_tokens(section.prompt[0]) for section in sections))
+    return results
+
+def compare(results,previous_path):
+    """ Prints the change of every (project, stage) against an earlier results file."""
+    with open(previous_path) as f:
+        previous={(r["project"],r["stage"]):r for r in json.load(f)["results"]}
+    print(f"\nChange against {previous_path} :")
+    for r in results:
+        before=previous.get((r["project"],r["stage"]))
+        if before is None or not before["seconds"]:
+            continue
+        time_change=(r["seconds"]/before["seconds"]-1)*100
+        memory_change=(r["peak_bytes"]/before["peak_bytes"]-1)*100 if before["peak_bytes"] else 0.0
+        flag="  <-- slower" if time_change>10 else ""
+        print(f"{r['project'][:40]:<42}{r['stage']:<15}{time_change:>+8.1f}% time {memory_change:>+8.1f}% memory{flag}")
+
+def main():
+    parser=argparse.ArgumentParser(description="Per-stage benchmark of the pipeline over testing_zip")
+    parser.add_argument("--testing-zip",default=DEFAULT_TESTING_ZIP)
+    parser.add_argument("--repeat",type=int,default=3)
+    parser.add_argument("--output",default="pipeline_benchmark.json",help="where to write the results (JSON)")
+    parser.add_argument("--compare",help="earlier results file to compare with")
+    parser.add_argument("--project",action="append",help="only these projects (repeatable)")
+    parser.add_argument("--dictionary-rows",type=int,default=5000,help="rows of the synthetic data dictionary of the docx_dictionary stage (0 to skip)")
+    args=parser.parse_args()
+    sys.path.insert(0,os.path.dirname(os.path.abspath(__file__)))
+    import app # configures logging at import, quieted below
+    logging.getLogger().setLevel(logging.WARNING)
+    from markdown_to_docx import markdown_to_docx
+
+    render_er=graphviz_available()
+    if not render_er:
+        print("Graphviz binaries not found, er_render is skipped")
+    results=[]
+    for name,data in projects(args.testing_zip):
+        if args.project and name not in args.project:
+            continue
+        print(f"{name} ...",flush=True)
+        folder=os.path.join(args.testing_zip,f"{name}.Report")
+        results.extend(benchmark_project(name,data,args.repeat,render_er,folder if os.path.isdir(folder) else None))
+    for path in sorted(glob.glob(os.path.join(args.testing_zip,"*.md"))):
+        with open(path,encoding='utf-8') as f:
+            markdown=f.read()
+        _,seconds,peak=measure(args.repeat,lambda:markdown_to_docx(markdown))
+        results.append({"project":os.path.basename(path),"stage":"docx","seconds":seconds,"peak_bytes":peak,"markdown_bytes":len(markdown.encode('utf-8'))})
+    if args.dictionary_rows:
+        markdown=synthetic_dictionary(args.dictionary_rows)
+        _,seconds,peak=measure(args.repeat,lambda:markdown_to_docx(markdown))
+        results.append({"project":f"synthetic {args.dictionary_rows} rows","stage":"docx_dictionary","seconds":seconds,"peak_bytes":peak,"markdown_bytes":len(markdown.encode('utf-8'))})
+
+    print(f"\n{'project':<42}{'stage':<15}{'ms':>10}{'peak MB':>10}")
+    for r in results:
+        print(f"{r['project'][:40]:<42}{r['stage']:<15}{r['seconds']*1000:>10.1f}{r['peak_bytes']/1e6:>10.2f}")
+    output={
+        "commit":commit(),
+        "timestamp":datetime.now(timezone.utc).isoformat(),
+        "python":platform.python_version(),
+        "platform":platform.platform(),
+        "repeat":args.repeat,
+        "results":results,
+    }
+    with open(args.output,'w') as f:
+        json.dump(output,f,indent=2)
+    print(f"\nResults written to {args.output}")
+    if args.compare:
+        compare(results,args.compare)
+
+if __name__=="__main__":
+    main()
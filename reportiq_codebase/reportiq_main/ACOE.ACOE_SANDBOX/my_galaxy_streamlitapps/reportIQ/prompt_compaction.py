@@ -0,0 +1,229 @@
+import os
+import logging
+from collections import Counter
+from tmdl_parser import describe_semantic_model,FULL,NO_SOURCES,SHORT_EXPRESSIONS,NO_EXPRESSIONS,NAMES_ONLY
+from report_layout import ReportLayout
+logger=logging.getLogger(__name__)
+# Turns the raw report.json (up to 1.4 MB) and the parsed semantic model into a compact text that fits a token budget.
+# report.json is mostly formatting (colors, fonts, positions, themes); what matters for documentation is which pages exist,
+# which visuals are on them, which fields they use, the filters and the bookmarks. That digest is usually 1-5% of the raw size.
+# If digest + schema still don't fit, detail is removed step by step (M sources, long DAX, per-visual lines, ...) before anything is truncated.
+
+DEFAULT_TOKEN_BUDGET=int(os.getenv('REPORTIQ_PROMPT_TOKEN_BUDGET','24000'))
+# gpt-4o family uses o200k_base. Override for other deployments.
+TOKENIZER_ENCODING=os.getenv('REPORTIQ_TOKENIZER_ENCODING','o200k_base')
+# Visuals that only decorate the page, they're counted but not listed.
+DECORATIVE_VISUALS={"shape","basicShape","image","textbox","actionButton","pageNavigator","bookmarkNavigator"}
+
+_encoding=None
+def _get_encoding():
+    """ tiktoken encoding, loaded once. None if tiktoken isn't installed or the encoding file can't be loaded (it is downloaded and cached on first use)."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding=tiktoken.get_encoding(TOKENIZER_ENCODING)
+        except Exception as e:
+            logger.debug(f"tiktoken not available ({e}), estimating tokens as characters/4")
+            _encoding=False
+    return _encoding or None
+
+def count_tokens(text):
+    """ Number of tokens of text for the completion model. Falls back to the usual ~4 characters per token estimate without tiktoken."""
+    encoding=_get_encoding()
+    if encoding is None:
+        return (len(text)+3)//4
+    return len(encoding.encode(text,disallowed_special=()))
+
+def truncate_to_tokens(text,max_tokens):
+    """ Cuts text to at most max_tokens tokens."""
+    encoding=_get_encoding()
+    if encoding is None:
+        return text[:max_tokens*4]
+    tokens=encoding.encode(text,disallowed_special=())
+    if len(tokens)<=max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
+def _field_reference(expression):
+    """ Table.Field of a filter/query expression ({"Column":{"Expression":{"SourceRef":{"Entity":..}},"Property":..}}, Measure, Aggregation, HierarchyLevel)."""
+    if not isinstance(expression,dict):
+        return None
+    for kind in ("Column","Measure"):
+        if kind in expression:
+            entity=expression[kind].get("Expression",{}).get("SourceRef",{}).get("Entity")
+            prop=expression[kind].get("Property")
+            return f"{entity}.{prop}" if entity else prop
+    if "Aggregation" in expression:
+        return _field_reference(expression["Aggregation"].get("Expression"))
+    if "HierarchyLevel" in expression:
+        level=expression["HierarchyLevel"]
+        hierarchy=level.get("Expression",{}).get("Hierarchy",{})
+        source=hierarchy.get("Expression",{})
+        source=source.get("PropertyVariationSource",source)
+        entity=source.get("Expression",{}).get("SourceRef",{}).get("Entity")
+        prop=source.get("Property") or hierarchy.get("Hierarchy")
+        return f"{entity}.{prop}.{level.get('Level')}" if entity else f"{prop}.{level.get('Level')}"
+    return None
+
+def _filters(filters):
+    """ Fields the (decoded) filters of a report/page/visual are on."""
+    fields=[]
+    for f in filters or []:
+        field=_field_reference(f.get("expression"))
+        if field:
+            fields.append(field if not f.get("type") else f"{field} ({f['type']})")
+    return fields
+
+class VisualSummary:
+    __slots__=('visual_type','title','fields','filters')
+    def __init__(self,visual_type,title,fields,filters):
+        self.visual_type=visual_type
+        self.title=title
+        self.fields=fields
+        self.filters=filters
+
+class PageSummary:
+    __slots__=('name','visuals','filters','decorative')
+    def __init__(self,name,filters):
+        self.name=name
+        self.visuals=[]
+        self.filters=filters
+        self.decorative=Counter()
+
+class ReportDigest:
+    __slots__=('pages','filters','bookmarks')
+    def __init__(self):
+        self.pages=[]
+        self.filters=[]
+        self.bookmarks=[]
+
+def digest_report(report):
+    """ Pages, visuals (type, title, fields), filters and bookmarks of a report.json text or report_layout.ReportLayout."""
+    digest=ReportDigest()
+    if not report:
+        return digest
+    layout=report if isinstance(report,ReportLayout) else ReportLayout.from_json(report)
+    digest.filters=_filters(layout.filters)
+    for bookmark in layout.bookmarks:
+        children=[child.get("displayName") for child in bookmark.get("children",[])]
+        digest.bookmarks.append(f"{bookmark.get('displayName')}" + (f" ({', '.join(children)})" if children else ""))
+    for layout_page in layout.pages:
+        page=PageSummary(layout_page.display_name,_filters(layout_page.filters))
+        for container in layout_page.visuals:
+            visual_type=container.visual_type
+            if visual_type is None:
+                continue # visual groups only hold other visuals
+            if visual_type in DECORATIVE_VISUALS:
+                page.decorative[visual_type]+=1 # counted from the type alone, their config is never decoded
+            else:
+                page.visuals.append(VisualSummary(visual_type,container.title,container.fields,_filters(container.filters)))
+        digest.pages.append(page)
+    return digest
+
+# Detail levels of describe_report, from most to least verbose.
+VISUALS=0 # one line per (deduplicated) visual
+PAGE_FIELDS=1 # per page : visual type counts and the distinct fields used
+PAGE_NAMES=2 # page names, and the distinct fields of the whole report
+
+def describe_report(digest,detail=VISUALS):
+    out=[]
+    all_fields=[]
+    for page in digest.pages:
+        types=Counter(visual.visual_type for visual in page.visuals)
+        out.append(f"Page {page.name}: " + ", ".join(f"{t} x{n}" if n>1 else t for t,n in types.items()))
+        fields=[]
+        for visual in page.visuals:
+            for field in visual.fields:
+                if field not in fields:
+                    fields.append(field)
+                if field not in all_fields:
+                    all_fields.append(field)
+        if detail>=PAGE_NAMES:
+            continue
+        if page.filters:
+            out.append(f"  Page filters: {', '.join(page.filters)}")
+        if detail==VISUALS:
+            # Identical visuals (same type, title and fields) are listed once with a count, e.g. repeated cards or slicers.
+            seen=Counter((visual.visual_type,visual.title,tuple(visual.fields),tuple(visual.filters)) for visual in page.visuals)
+            for (visual_type,title,visual_fields,visual_filters),n in seen.items():
+                line=f"  - {visual_type}" + (f" '{title}'" if title else "") + (f" x{n}" if n>1 else "")
+                if visual_fields:
+                    line+=f": {', '.join(visual_fields)}"
+                if visual_filters:
+                    line+=f" | filters: {', '.join(visual_filters)}"
+                out.append(line)
+        else:
+            out.append(f"  Fields: {', '.join(fields)}")
+    if detail>=PAGE_NAMES and all_fields:
+        out.append(f"Fields used: {', '.join(all_fields)}")
+    if digest.filters:
+        out.append(f"Report filters: {', '.join(digest.filters)}")
+    if digest.bookmarks:
+        out.append(f"Bookmarks: {', '.join(digest.bookmarks)}")
+    return '\n'.join(out)
+
+# Order in which detail is removed when over budget : (report detail, semantic model detail)
+_STEPS=[
+    (VISUALS,FULL),
+    (VISUALS,NO_SOURCES),
+    (VISUALS,SHORT_EXPRESSIONS),
+    (PAGE_FIELDS,SHORT_EXPRESSIONS),
+    (PAGE_FIELDS,NO_EXPRESSIONS),
+    (PAGE_NAMES,NO_EXPRESSIONS),
+    (PAGE_NAMES,NAMES_ONLY),
+]
+
+class CompactedContext:
+    __slots__=('report','semantic_model','report_tokens','semantic_model_tokens','report_detail','semantic_model_detail')
+    def __init__(self,report,semantic_model,report_detail,semantic_model_detail):
+        self.report=report
+        self.semantic_model=semantic_model
+        self.report_tokens=count_tokens(report)
+        self.semantic_model_tokens=count_tokens(semantic_model)
+        self.report_detail=report_detail
+        self.semantic_model_detail=semantic_model_detail
+
+    @property
+    def tokens(self):
+        return self.report_tokens+self.semantic_model_tokens
+
+def compact_context(report,model,token_budget=DEFAULT_TOKEN_BUDGET):
+    """ Report digest and semantic model schema that together fit in token_budget tokens, with as much detail as possible."""
+    digest=report if isinstance(report,ReportDigest) else digest_report(report)
+    compacted=None
+    for report_detail,model_detail in _STEPS:
+        compacted=CompactedContext(describe_report(digest,report_detail),describe_semantic_model(model,model_detail),report_detail,model_detail)
+        logger.debug(f"Prompt data at detail ({report_detail},{model_detail}) = {compacted.tokens} tokens (budget {token_budget})")
+        if compacted.tokens<=token_budget:
+            return compacted
+    # Still too big at the lowest detail : split the budget in proportion and cut.
+    share=compacted.report_tokens/max(compacted.tokens,1)
+    report_text=truncate_to_tokens(compacted.report,int(token_budget*share))
+    model_text=truncate_to_tokens(compacted.semantic_model,token_budget-count_tokens(report_text))
+    logger.debug("Prompt data truncated to fit the token budget")
+    return CompactedContext(report_text,model_text,compacted.report_detail,compacted.semantic_model_detail)
+
+def describe_data_flow(model,detail=FULL):
+    """ Where each table's data comes from (partition sources) and how tables are related. NO_SOURCES and lower keep only the kind/mode of each partition."""
+    out=[]
+    for table in model.tables:
+        for partition in table.partitions:
+            if detail==FULL and partition.source:
+                out.append(f"Table {table.name} ({partition.kind}, {partition.mode}): {partition.source}")
+            else:
+                out.append(f"Table {table.name} ({partition.kind}, {partition.mode})")
+    table_names={table.name for table in model.tables}
+    for r in model.relationships:
+        if r.from_table in table_names and r.to_table in table_names:
+            out.append(f"Relationship {r.from_table}.{r.from_column} -> {r.to_table}.{r.to_column}" + ("" if r.is_active else " (inactive)"))
+    return '\n'.join(out)
+
+def fit_to_budget(renderings,token_budget):
+    """ First of renderings (functions returning text, most detailed first) that fits in token_budget tokens, else the last one truncated."""
+    text=""
+    for render in renderings:
+        text=render()
+        if count_tokens(text)<=token_budget:
+            return text
+    return truncate_to_tokens(text,token_budget)
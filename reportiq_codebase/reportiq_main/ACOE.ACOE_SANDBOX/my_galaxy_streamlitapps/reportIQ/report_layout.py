@@ -0,0 +1,215 @@
+import re
+import json
+import logging
+import json_backend
+from collections import Counter
+from itertools import accumulate
+logger=logging.getLogger(__name__)
+# Reader of the legacy report.json layout of a .pbip report.
+# Most of report.json is the config of every visual container, each stored as a JSON string inside the JSON (plus filters and page
+# configs, also strings). Decoding all of them up front (json.loads of the file, then json.loads of every config) allocates a dict
+# tree per visual that is mostly formatting nobody reads. Here the file is decoded once and pages and visual containers are walked lazily.
+# A visual config is never decoded as a whole : each field (prototypeQuery, columnProperties, vcObjects) is decoded from the config
+# string on its own, at most once and only when asked for, and the visual type, which is all a per-page inventory needs, is read
+# straight from the string. None marks what isn't decoded yet (it pickles, unlike a sentinel).
+# Whole documents go through json_backend (orjson/msgspec when installed). Single fields use the stdlib decoder, the only one that can
+# decode a value in the middle of a text (raw_decode).
+
+# "visualType":"..." only appears in singleVisual, visual groups (singleVisualGroup) have none
+_VISUAL_TYPE=re.compile(r'"visualType"\s*:\s*"([^"\\]*)"')
+
+def _decode(text,default):
+    """ A nested JSON string (or an already decoded value), default if it's empty or invalid."""
+    if not text:
+        return default
+    if not isinstance(text,str):
+        return text
+    try:
+        return json_backend.loads(text) or default
+    except ValueError:
+        logger.debug(f"Ignoring invalid nested JSON ({len(text)} characters)")
+        return default
+
+def literal_value(value):
+    """ Value of a {"expr":{"Literal":{"Value":"'text'"}}} property, without the quotes."""
+    try:
+        text=value["expr"]["Literal"]["Value"]
+    except (KeyError,TypeError):
+        return None
+    if len(text)>=2 and text[0]==text[-1]=="'":
+        return text[1:-1].replace("''","'")
+    return text
+
+_decoder=json.JSONDecoder()
+_KEYS={key:re.compile(r'"%s"\s*:\s*'%key) for key in ("prototypeQuery","columnProperties","vcObjects")}
+_SINGLE_VISUAL=re.compile(r'"singleVisual"\s*:\s*\{')
+_STRING=re.compile(r'"(?:[^"\\]|\\.)*"')
+_NOT_BRACKET=re.compile(r'[^\[\]{}]+')
+_DEPTH_STEP={'{':1,'[':1,'}':-1,']':-1}
+
+def _decode_key(config_json,key):
+    """ singleVisual[key] of the JSON text of a visual config, decoding only that value. None if it isn't there.
+    The search starts at singleVisual and a "key": only counts at its top level : the brackets before it are counted with the strings taken out.
+    A quote inside a JSON string is escaped, so the "key": pattern can only match an actual key."""
+    single_visual=_SINGLE_VISUAL.search(config_json)
+    if single_visual is None:
+        return None
+    depth=1
+    position=single_visual.end()
+    for match in _KEYS[key].finditer(config_json,position):
+        brackets=_NOT_BRACKET.sub('',_STRING.sub('',config_json[position:match.start()]))
+        depths=list(accumulate(map(_DEPTH_STEP.__getitem__,brackets),initial=depth))
+        if min(depths)<=0: # singleVisual closed before this match
+            return None
+        depth=depths[-1]
+        if depth==1:
+            return _decoder.raw_decode(config_json,match.end())[0]
+        position=match.start()
+    return None
+
+class VisualContainer:
+    __slots__=('_config_json','_filters_json','_fields','_filters')
+    def __init__(self,container):
+        self._config_json=container.get("config") or ""
+        self._filters_json=container.get("filters")
+        self._fields=None # what was asked for so far (prototypeQuery, fields, title, ...), see _cached
+        self._filters=None
+
+    def _decode_field(self,key):
+        """ singleVisual[key] of the config, decoding just that value and not the whole config. None if it isn't there."""
+        try:
+            return _decode_key(self._config_json,key)
+        except ValueError:
+            # not the compact JSON Power BI writes : decode it all
+            return _decode(self._config_json,{}).get("singleVisual",{}).get(key)
+
+    def _cached(self,name,compute):
+        """ Value of name, computed on first access. Only what's asked for is kept, e.g. the title text and not all of vcObjects."""
+        if self._fields is None:
+            self._fields={}
+        if name not in self._fields:
+            self._fields[name]=compute()
+        return self._fields[name]
+
+    @property
+    def filters(self):
+        """ Decoded filters of the visual (a list)."""
+        if self._filters is None:
+            self._filters=_decode(self._filters_json,[])
+            self._filters_json=None
+        return self._filters
+
+    @property
+    def visual_type(self):
+        """ visualType of a single visual, None for visual groups. Doesn't decode the config."""
+        match=_VISUAL_TYPE.search(self._config_json)
+        return match.group(1) if match else None
+
+    @property
+    def prototype_query(self):
+        return self._cached("prototypeQuery",lambda:self._decode_field("prototypeQuery") or {})
+
+    @property
+    def column_properties(self):
+        return self._cached("columnProperties",lambda:self._decode_field("columnProperties") or {})
+
+    def _select_names(self):
+        query=self._fields.get("prototypeQuery") if self._fields else None
+        if query is None:
+            query=self._decode_field("prototypeQuery") or {}
+        fields=[]
+        for select in query.get("Select",[]):
+            name=select.get("Name")
+            if name and name not in fields:
+                fields.append(name)
+        return fields
+
+    @property
+    def fields(self):
+        """ Distinct query names (Table.Field, Sum(Table.Field), ...) the visual selects, in order."""
+        return self._cached("fields",self._select_names)
+
+    def _title_text(self):
+        titles=(self._decode_field("vcObjects") or {}).get("title",[])
+        return literal_value(titles[0].get("properties",{}).get("text")) if titles else None
+
+    @property
+    def title(self):
+        return self._cached("title",self._title_text)
+
+class Page:
+    __slots__=('name','display_name','ordinal','_section','_filters','_visuals')
+    def __init__(self,section):
+        self.name=section.get("name")
+        self.display_name=section.get("displayName",self.name)
+        self.ordinal=section.get("ordinal",0)
+        self._section=section
+        self._filters=None
+        self._visuals=None
+
+    @property
+    def filters(self):
+        if self._filters is None:
+            self._filters=_decode(self._section.get("filters"),[])
+        return self._filters
+
+    @property
+    def visuals(self):
+        """ VisualContainers of the page, created on first access."""
+        if self._visuals is None:
+            self._visuals=[VisualContainer(container) for container in self._section.get("visualContainers",[])]
+        return self._visuals
+
+    def visual_types(self):
+        """ Counter of the visual types on the page (visual groups excluded), without decoding any config."""
+        return Counter(visual_type for visual_type in (visual.visual_type for visual in self.visuals) if visual_type is not None)
+
+class ReportLayout:
+    __slots__=('_layout','_config','_filters','_pages')
+    def __init__(self,layout):
+        self._layout=layout
+        self._config=None
+        self._filters=None
+        self._pages=None
+
+    @classmethod
+    def from_json(cls,report):
+        """ From the text of report.json. An empty text gives an empty layout."""
+        return cls(json_backend.loads(report) if report else {})
+
+    @property
+    def config(self):
+        if self._config is None:
+            self._config=_decode(self._layout.get("config"),{})
+        return self._config
+
+    @property
+    def filters(self):
+        """ Report level filters (a list)."""
+        if self._filters is None:
+            self._filters=_decode(self._layout.get("filters"),[])
+        return self._filters
+
+    @property
+    def pages(self):
+        """ Pages in the order they appear in the report."""
+        if self._pages is None:
+            self._pages=sorted((Page(section) for section in self._layout.get("sections",[])),key=lambda page:page.ordinal)
+        return self._pages
+
+    @property
+    def bookmarks(self):
+        return self.config.get("bookmarks",[])
+
+    def visuals(self):
+        """ (page, visual container) of the whole report, page by page."""
+        for page in self.pages:
+            for visual in page.visuals:
+                yield page,visual
+
+    def inventory(self):
+        """ Compact per-page visual inventory : [(page display name, Counter of visual types)]."""
+        return [(page.display_name,page.visual_types()) for page in self.pages]
+
+    def describe_inventory(self):
+        return '\n'.join(f"{name}: " + ", ".join(f"{t} x{n}" if n>1 else t for t,n in types.most_common()) for name,types in self.inventory())
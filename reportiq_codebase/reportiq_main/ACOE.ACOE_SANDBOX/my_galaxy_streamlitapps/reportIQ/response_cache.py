@@ -0,0 +1,120 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import tempfile
+import threading
+import logging
+from contextlib import contextmanager
+logger=logging.getLogger(__name__)
+# Disk-backed cache of completed completion-model answers.
+# Documenting an unchanged report with the same user context sends exactly the same request again. Answers are kept in SQLite keyed by
+# the SHA-256 of the endpoint and the request body (model parameters and both prompts), as the list of streamed deltas, so a hit is replayed
+# through the same generator st.write_stream consumes, just without waiting for the model. Only streams that completed are stored.
+# Entries expire after ttl seconds, and the least recently used ones are evicted past max_bytes. The file can live on a shared volume,
+# so analysts documenting the same shared report reuse each other's answers.
+#
+# Settings (environment variables, all optional) :
+#   REPORTIQ_RESPONSE_CACHE          path of the SQLite file (default reportiq_responses.sqlite in REPORTIQ_CACHE_DIR, or in the temp directory)
+#   REPORTIQ_RESPONSE_CACHE_TTL      seconds an answer is reused (default 604800, a week). 0 turns the cache off
+#   REPORTIQ_RESPONSE_CACHE_MAX_MB   size of the stored answers before eviction (default 256)
+
+# stream and stream_options don't change the answer, only how it's delivered
+_TRANSPORT_KEYS=("stream","stream_options")
+
+class ResponseCache:
+    def __init__(self,path,ttl=7*24*3600,max_bytes=256*1024*1024):
+        self.path=path
+        self.ttl=ttl
+        self.max_bytes=max_bytes
+        self._lock=threading.Lock() # sections are generated on worker threads, SQLite connections are opened per call
+        directory=os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory,exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL") # readers in other processes aren't blocked by a write
+            connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, deltas TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @contextmanager
+    def _connect(self):
+        """ Connection committed on success and always closed (sqlite3's own context manager doesn't close)."""
+        connection=sqlite3.connect(self.path,timeout=10)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def key(endpoint,data):
+        """ Hash of the endpoint and the request body without its transport options."""
+        body={k:v for k,v in data.items() if k not in _TRANSPORT_KEYS}
+        payload=json.dumps({"endpoint":endpoint,"data":body},sort_keys=True,ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self,key):
+        """ The stored deltas, or None if there's no entry or it expired."""
+        now=time.time()
+        try:
+            with self._lock,self._connect() as connection:
+                row=connection.execute("SELECT deltas,created FROM responses WHERE key=?",(key,)).fetchone()
+                if row is None:
+                    return None
+                if now-row[1]>self.ttl:
+                    connection.execute("DELETE FROM responses WHERE key=?",(key,))
+                    return None
+                connection.execute("UPDATE responses SET accessed=? WHERE key=?",(now,key))
+            logger.debug(f"Response cache hit for {key}")
+            return json.loads(row[0])
+        except (sqlite3.Error,ValueError) as e:
+            # a corrupt or locked cache must never break generation, it's only a miss
+            logger.debug(f"Response cache read failed for {key} : {e}")
+            return None
+
+    def put(self,key,deltas):
+        payload=json.dumps(deltas,ensure_ascii=False)
+        size=len(payload.encode('utf-8'))
+        if size>self.max_bytes:
+            return
+        now=time.time()
+        try:
+            with self._lock,self._connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO responses (key,deltas,size,created,accessed) VALUES (?,?,?,?,?)",(key,payload,size,now,now))
+                self._evict(connection,now)
+        except sqlite3.Error as e:
+            logger.debug(f"Response cache write failed for {key} : {e}")
+
+    def _evict(self,connection,now):
+        connection.execute("DELETE FROM responses WHERE created<?",(now-self.ttl,))
+        total=connection.execute("SELECT COALESCE(SUM(size),0) FROM responses").fetchone()[0]
+        if total<=self.max_bytes:
+            return
+        evicted=[]
+        for key,size in connection.execute("SELECT key,size FROM responses ORDER BY accessed").fetchall():
+            if total<=self.max_bytes:
+                break
+            evicted.append((key,))
+            total-=size
+        connection.executemany("DELETE FROM responses WHERE key=?",evicted)
+        logger.debug(f"Evicted {len(evicted)} answers from response cache")
+
+_cache=None
+_cache_lock=threading.Lock()
+def get_response_cache():
+    """ Process wide cache configured from the environment, or None if it's turned off or can't be opened."""
+    global _cache
+    ttl=float(os.getenv('REPORTIQ_RESPONSE_CACHE_TTL',str(7*24*3600)))
+    if ttl<=0:
+        return None
+    default_dir=os.getenv('REPORTIQ_CACHE_DIR') or tempfile.gettempdir()
+    path=os.getenv('REPORTIQ_RESPONSE_CACHE') or os.path.join(default_dir,"reportiq_responses.sqlite")
+    max_bytes=int(float(os.getenv('REPORTIQ_RESPONSE_CACHE_MAX_MB','256'))*1024*1024)
+    with _cache_lock:
+        if _cache is None or _cache.path!=path or _cache.ttl!=ttl or _cache.max_bytes!=max_bytes:
+            try:
+                _cache=ResponseCache(path,ttl,max_bytes)
+            except (OSError,sqlite3.Error) as e:
+                logger.debug(f"Response cache disabled, could not open {path} : {e}")
+                return None
+        return _cache
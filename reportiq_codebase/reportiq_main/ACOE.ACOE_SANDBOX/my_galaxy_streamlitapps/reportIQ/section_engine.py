@@ -0,0 +1,117 @@
+import os
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from sse import throttle_stream
+logger=logging.getLogger(__name__)
+# Generates the documentation section by section (overview, key contacts, data flow, data explorer, data dictionary) instead of in one request.
+# Each section is an independent completion request with only the slice of the report/semantic model it needs, and the sections
+# run concurrently (up to `concurrency` at a time), so the wall-clock time is roughly that of the slowest section instead of the sum.
+# The completion streams are blocking iterators (requests), each next() runs on a worker thread while the asyncio loop in the calling
+# thread hands every delta to on_delta. on_delta is always called from the calling thread, so it can update Streamlit placeholders.
+
+DEFAULT_CONCURRENCY=int(os.getenv('REPORTIQ_SECTION_CONCURRENCY','5'))
+_END=object()
+
+class Section:
+    __slots__=('key','title','prompt','max_tokens')
+    def __init__(self,key,title,prompt,max_tokens=2000):
+        self.key=key
+        self.title=title
+        self.prompt=prompt # [system_prompt, user_prompt]
+        self.max_tokens=max_tokens
+
+class SectionEngine:
+    def __init__(self,stream_factory,concurrency=DEFAULT_CONCURRENCY,render_interval=0.0):
+        """ stream_factory(section) returns an iterator of text deltas for that section, e.g. CompletionModel(section.prompt).generate_documentation()"""
+        self.stream_factory=stream_factory
+        self.concurrency=max(1,concurrency)
+        self.render_interval=render_interval
+
+    async def _stream_section(self,section,on_delta,semaphore,executor,results,on_done=None):
+        async with semaphore:
+            loop=asyncio.get_running_loop()
+            iterator=await loop.run_in_executor(executor,lambda:iter(throttle_stream(self.stream_factory(section),self.render_interval)))
+            parts=[]
+            try:
+                while True:
+                    delta=await loop.run_in_executor(executor,next,iterator,_END)
+                    if delta is _END:
+                        break
+                    parts.append(delta)
+                    if on_delta is not None:
+                        on_delta(section,delta)
+            finally:
+                results[section.key]=''.join(parts)
+                close=getattr(iterator,'close',None)
+                if close is not None:
+                    await loop.run_in_executor(executor,close)
+            logger.debug(f"Section {section.key} done, {len(results[section.key])} characters")
+            if on_done is not None:
+                on_done(section,results[section.key])
+
+    async def generate_async(self,sections,on_delta=None,on_done=None):
+        """ Runs all sections concurrently. Returns {section key: generated text}. on_done(section,text) is called as each section finishes."""
+        semaphore=asyncio.Semaphore(self.concurrency)
+        results={}
+        with ThreadPoolExecutor(max_workers=self.concurrency,thread_name_prefix="section") as executor:
+            await asyncio.gather(*(self._stream_section(section,on_delta,semaphore,executor,results,on_done) for section in sections))
+        return results
+
+    def generate(self,sections,on_delta=None,on_done=None):
+        """ Blocking version of generate_async for code that isn't async (Streamlit scripts)."""
+        return asyncio.run(self.generate_async(sections,on_delta,on_done))
+
+def assemble(sections,results):
+    """ Markdown document with the sections in their original order, each under its own heading."""
+    parts=[]
+    for section in sections:
+        text=results.get(section.key,"").strip()
+        if text:
+            parts.append(f"## {section.title}\n\n{text}")
+    return '\n\n'.join(parts)
+
+class StreamingAssembly:
+    """ The document assemble(sections, results) returns, written to write(text) while the sections stream (on_delta, on_done of
+    SectionEngine.generate) : the deltas of the first unfinished section are written as they come, those of the sections after it
+    are held until it's done. Used to build the DOCX during the generation (markdown_to_docx.DocxBuilder.feed)."""
+    def __init__(self,sections,write):
+        self.sections=list(sections)
+        self.write=write
+        self._held={section.key:[] for section in self.sections}
+        self._done=set()
+        self._index=0 # section being written
+        self._started=False # the heading of the current section is written, i.e. it has non blank text
+        self._any=False # a section was written, the next one is separated by a blank line
+        self._space="" # trailing whitespace of the current section, only written if more text follows (assemble strips the sections)
+
+    def _write(self,delta):
+        if not self._started:
+            delta=delta.lstrip()
+            if not delta:
+                return
+            section=self.sections[self._index]
+            self.write(("\n\n" if self._any else "")+f"## {section.title}\n\n")
+            self._started=self._any=True
+        text=delta.rstrip()
+        if text:
+            self.write(self._space+text)
+            self._space=delta[len(text):]
+        else:
+            self._space+=delta
+
+    def on_delta(self,section,delta):
+        if self._index<len(self.sections) and section.key==self.sections[self._index].key:
+            self._write(delta)
+        else:
+            self._held[section.key].append(delta)
+
+    def on_done(self,section,text):
+        self._done.add(section.key)
+        while self._index<len(self.sections) and self.sections[self._index].key in self._done:
+            self._index+=1
+            self._started=False
+            self._space=""
+            if self._index<len(self.sections):
+                for delta in self._held.pop(self.sections[self._index].key):
+                    self._write(delta)
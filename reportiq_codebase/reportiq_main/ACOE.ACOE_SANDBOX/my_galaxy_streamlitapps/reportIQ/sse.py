@@ -0,0 +1,118 @@
+import time
+import codecs
+import logging
+import json_backend
+logger=logging.getLogger(__name__)
+# Incremental decoder for the text/event-stream (Server-Sent Events) body of a streaming chat-completions response.
+# Spec : https://html.spec.whatwg.org/multipage/server-sent-events.html#event-stream-interpretation
+# The network hands us arbitrary byte chunks : one chunk can hold several events, and an event, a line, or even a multi-byte
+# UTF-8 character can be split across two chunks. So bytes go through an incremental UTF-8 decoder, text is buffered until a
+# line is complete, and an event is only emitted at the blank line that ends it. Every event is emitted as soon as it is complete.
+
+DONE="[DONE]"
+
+class SSEDecoder:
+    def __init__(self):
+        self._decoder=codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._buffer=""
+        self._data=[] # data: lines of the event being read
+
+    def feed(self,chunk):
+        """ Feeds bytes, returns the data of every event completed by them (multi-line data joined with \\n)."""
+        self._buffer+=self._decoder.decode(chunk)
+        return self._process(final=False)
+
+    def flush(self):
+        """ End of stream : returns the last event if the stream didn't end with a blank line."""
+        self._buffer+=self._decoder.decode(b"",final=True)
+        events=self._process(final=True)
+        if self._data:
+            events.append('\n'.join(self._data))
+            self._data=[]
+        return events
+
+    def _process(self,final):
+        events=[]
+        buffer=self._buffer
+        start=0
+        n=len(buffer)
+        cr=buffer.find('\r')
+        while start<n:
+            # lines end with \n, \r\n or \r. The position of the next \r is only searched again once it's behind us, so this stays linear.
+            lf=buffer.find('\n',start)
+            if cr!=-1 and cr<start:
+                cr=buffer.find('\r',start)
+            if cr!=-1 and (lf==-1 or cr<lf):
+                if cr==n-1 and not final:
+                    break # could be the \r of a \r\n split across chunks
+                end=cr
+                next_start=cr+2 if buffer.startswith('\r\n',cr) else cr+1
+            elif lf!=-1:
+                end=lf
+                next_start=lf+1
+            else:
+                if not final:
+                    break
+                end=next_start=n
+            line=buffer[start:end]
+            start=next_start
+            if not line:
+                if self._data:
+                    events.append('\n'.join(self._data))
+                    self._data=[]
+                continue
+            if line.startswith(':'):
+                continue # comment / keep-alive
+            field,_,value=line.partition(':')
+            if value.startswith(' '):
+                value=value[1:]
+            if field=="data":
+                self._data.append(value)
+            # event:, id: and retry: aren't used by chat-completions
+        self._buffer=buffer[start:]
+        return events
+
+def iter_sse_data(byte_chunks,include_done=False):
+    """ Yields the data of each event of a stream of byte chunks, stopping at [DONE].
+    With include_done, DONE itself is yielded last when the stream sent it, so the caller can tell a finished stream from one cut short."""
+    decoder=SSEDecoder()
+    for chunk in byte_chunks:
+        if not chunk:
+            continue
+        for data in decoder.feed(chunk):
+            if data.strip()==DONE: # this is like EOF for the stream
+                if include_done:
+                    yield DONE
+                return
+            yield data
+    for data in decoder.flush():
+        if data.strip()==DONE:
+            if include_done:
+                yield DONE
+            return
+        yield data
+
+def chat_delta(data):
+    """ (content, finish_reason) of the first choice of one chat.completion.chunk event, None for what's missing. Raises ValueError on invalid JSON.
+    finish_reason is only set on the last chunk of a finished answer (stop, length, content_filter, ...). Decoded with the fastest installed JSON backend, see json_backend.py"""
+    return json_backend.chat_delta(data)
+
+def throttle_stream(deltas,min_interval):
+    """ Render-side pacing : joins deltas so whoever renders them (st.write_stream) gets at most one update per min_interval seconds.
+    It never sleeps, so it never slows the stream down, it only reduces the number of re-renders. min_interval<=0 passes deltas through.
+    Limitation : there is no timer, buffered text is only flushed when the next delta arrives (or at the end of the stream). If the model
+    pauses mid-answer, the text received since the last update stays unrendered for the whole pause, however long it is."""
+    if min_interval<=0:
+        yield from deltas
+        return
+    pending=[]
+    last=time.monotonic()
+    for delta in deltas:
+        pending.append(delta)
+        now=time.monotonic()
+        if now-last>=min_interval:
+            yield ''.join(pending)
+            pending=[]
+            last=now
+    if pending:
+        yield ''.join(pending)
@@ -0,0 +1,99 @@
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer,BaseHTTPRequestHandler
+# Local stand-in for the completion model endpoint, to run the app or CompletionClient without the real API.
+# It speaks the streaming chat-completions format : a text/event-stream of "data: {chat.completion.chunk}" events ending with "data: [DONE]".
+# It can also fail the first requests with 429/503 (and a Retry-After header) to exercise retries.
+#
+#   python stub_completion_server.py --port 8089 --fail-first 2
+#   COMPLETION_MODEL_ENDPOINT=http://127.0.0.1:8089/chat/completions streamlit run app.py
+#
+# or from Python : server=start_stub_server(0) ; endpoint=f"http://127.0.0.1:{server.server_port}/chat/completions"
+
+DEFAULT_TEXT="# Overview\nThis is a stub documentation generated by the local completion stub.\n\n## Data Dictionary\n| Column | Description |\n|---|---|\n| Région | Non-ASCII text ✓ |\n"
+
+def chunk_event(content=None,finish_reason=None,usage=None):
+    """ One SSE event in the chat.completion.chunk format."""
+    chunk={
+        "id": "chatcmpl-stub",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "stub",
+        "choices": [] if usage else [{"index": 0, "delta": {} if content is None else {"content": content}, "finish_reason": finish_reason, "logprobs": None}],
+        "usage": usage,
+    }
+    return f"data: {json.dumps(chunk,ensure_ascii=False)}\n\n".encode('utf-8')
+
+class StubCompletionHandler(BaseHTTPRequestHandler):
+    protocol_version="HTTP/1.1" # keep-alive, so connection reuse by the client can be observed in server.connections
+
+    def log_message(self,format,*args):
+        pass
+
+    def do_POST(self):
+        server=self.server
+        body=self.rfile.read(int(self.headers.get('Content-Length',0)))
+        with server.lock:
+            server.requests.append(json.loads(body or b'{}'))
+            server.connections.add(self.client_address)
+            fail=server.fail_remaining>0
+            if fail:
+                server.fail_remaining-=1
+        if fail:
+            payload=json.dumps({"error":{"message":"Rate limit is exceeded. Try again later."}}).encode('utf-8')
+            self.send_response(server.fail_status)
+            self.send_header('Content-Type','application/json')
+            self.send_header('Content-Length',str(len(payload)))
+            self.send_header('Retry-After',str(server.retry_after))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type','text/event-stream')
+        self.send_header('Transfer-Encoding','chunked')
+        self.end_headers()
+        words=server.text.split(' ')
+        for i,word in enumerate(words):
+            self._write_chunk(chunk_event(word if i==0 else ' '+word))
+            if server.delay:
+                time.sleep(server.delay)
+        self._write_chunk(chunk_event(finish_reason="stop"))
+        self._write_chunk(chunk_event(usage={"prompt_tokens": 0, "completion_tokens": len(words), "total_tokens": len(words)}))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self,data):
+        self.wfile.write(f"{len(data):X}\r\n".encode('ascii')+data+b"\r\n")
+        self.wfile.flush()
+
+def start_stub_server(port=0,text=DEFAULT_TEXT,delay=0.0,fail_first=0,fail_status=429,retry_after=1):
+    """ Starts the stub in a daemon thread and returns the server. server.requests has the received request bodies."""
+    server=ThreadingHTTPServer(("127.0.0.1",port),StubCompletionHandler)
+    server.daemon_threads=True
+    server.lock=threading.Lock()
+    server.requests=[]
+    server.connections=set()
+    server.text=text
+    server.delay=delay
+    server.fail_remaining=fail_first
+    server.fail_status=fail_status
+    server.retry_after=retry_after
+    threading.Thread(target=server.serve_forever,daemon=True).start()
+    return server
+
+if __name__=="__main__":
+    parser=argparse.ArgumentParser(description="Local streaming chat-completions stub")
+    parser.add_argument("--port",type=int,default=8089)
+    parser.add_argument("--delay",type=float,default=0.0,help="seconds between streamed words")
+    parser.add_argument("--fail-first",type=int,default=0,help="answer the first N requests with an error")
+    parser.add_argument("--fail-status",type=int,default=429)
+    parser.add_argument("--retry-after",type=int,default=1)
+    args=parser.parse_args()
+    server=start_stub_server(args.port,delay=args.delay,fail_first=args.fail_first,fail_status=args.fail_status,retry_after=args.retry_after)
+    print(f"Stub completion endpoint : http://127.0.0.1:{server.server_port}/chat/completions")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,385 @@
+import logging
+logger=logging.getLogger(__name__)
+# One-pass, indentation-aware parser for the TMDL (Tabular Model Definition Language) files of a .SemanticModel folder.
+# Reference : https://learn.microsoft.com/en-us/analysis-services/tmdl/tmdl-overview
+# Every line is one of :
+#   - an object declaration    : <objectType> <name> [= <expression>]     e.g. column 'Service Area', measure X = SUM(...), partition P = m
+#   - a property               : <name>: <value>                          e.g. dataType: string
+#   - an expression property   : <name> = <expression>                    e.g. source = let ..., changedProperty = IsHidden
+#   - a boolean flag           : <name>                                   e.g. isHidden
+#   - a description            : /// text                                 (belongs to the object declared right after it)
+# Children are indented one tab deeper than their parent. Multi-line expressions (DAX, M) start after a trailing "=" and are indented
+# deeper than the properties of their owner, or are fenced with ```.
+# The parser keeps a stack of open objects, so each line is looked at once and the whole model is parsed in linear time.
+
+class Column:
+    __slots__=('name','data_type','source_column','summarize_by','expression','format_string','is_hidden','description','sort_by_column','data_category')
+    def __init__(self,name):
+        self.name=name
+        self.data_type=None
+        self.source_column=None
+        self.summarize_by=None
+        self.expression=None # DAX of calculated columns
+        self.format_string=None
+        self.is_hidden=False
+        self.description=None
+        self.sort_by_column=None
+        self.data_category=None
+
+class Measure:
+    __slots__=('name','expression','format_string','display_folder','is_hidden','description')
+    def __init__(self,name):
+        self.name=name
+        self.expression=None # DAX
+        self.format_string=None
+        self.display_folder=None
+        self.is_hidden=False
+        self.description=None
+
+class Partition:
+    __slots__=('name','kind','mode','source')
+    def __init__(self,name):
+        self.name=name
+        self.kind=None # m, calculated, entity, ...
+        self.mode=None # import, directQuery, ...
+        self.source=None # M query for kind m, DAX for calculated tables
+
+class Level:
+    __slots__=('name','column')
+    def __init__(self,name):
+        self.name=name
+        self.column=None
+
+class Hierarchy:
+    __slots__=('name','levels')
+    def __init__(self,name):
+        self.name=name
+        self.levels=[]
+
+class Table:
+    __slots__=('name','columns','measures','partitions','hierarchies','is_hidden','description')
+    def __init__(self,name):
+        self.name=name
+        self.columns=[]
+        self.measures=[]
+        self.partitions=[]
+        self.hierarchies=[]
+        self.is_hidden=False
+        self.description=None
+
+class Relationship:
+    __slots__=('name','from_table','from_column','to_table','to_column','is_active','cross_filtering_behavior','from_cardinality','to_cardinality')
+    def __init__(self,name):
+        self.name=name
+        self.from_table=None
+        self.from_column=None
+        self.to_table=None
+        self.to_column=None
+        self.is_active=True
+        self.cross_filtering_behavior=None
+        self.from_cardinality=None # defaults to many in TMDL
+        self.to_cardinality=None # defaults to one in TMDL
+
+class SemanticModel:
+    __slots__=('tables','relationships')
+    def __init__(self):
+        self.tables=[]
+        self.relationships=[]
+
+    def table(self,name):
+        for table in self.tables:
+            if table.name==name:
+                return table
+        return None
+
+class _Other:
+    """ Placeholder for objects we don't model (annotation, variation, extendedProperty, ...) so their children aren't attached to the wrong parent."""
+    __slots__=('kind','name','properties')
+    def __init__(self,kind,name):
+        self.kind=kind
+        self.name=name
+        self.properties={}
+
+def _indent(line):
+    """ Indentation level of a line and the line without it. TMDL uses tabs, 4 spaces are accepted as one level for hand written files.
+    Only leading tabs are stripped from tab indented lines, so the spaces M and DAX code use for their own indentation are kept."""
+    stripped=line.lstrip('\t')
+    level=len(line)-len(stripped)
+    if level==0 and stripped.startswith(' '):
+        stripped=line.lstrip(' ')
+        level=(len(line)-len(stripped))//4
+    return level,stripped
+
+def _read_name(text,start=0,stop='='):
+    """ Reads a possibly single-quoted TMDL name starting at start. Returns (name, index after the name). '' inside quotes is an escaped quote."""
+    if start<len(text) and text[start]=="'":
+        i=start+1
+        chars=[]
+        while i<len(text):
+            if text[i]=="'":
+                if text.startswith("''",i):
+                    chars.append("'")
+                    i+=2
+                    continue
+                return ''.join(chars),i+1
+            chars.append(text[i])
+            i+=1
+        return ''.join(chars),i
+    i=start
+    while i<len(text) and not text[i].isspace() and text[i] not in stop:
+        i+=1
+    return text[start:i],i
+
+def split_column_reference(reference):
+    """ Table.'Column name' / 'Table name'.Column -> (table, column)"""
+    table,end=_read_name(reference.strip(),stop='.')
+    rest=reference.strip()[end:]
+    if rest.startswith('.'):
+        column,_=_read_name(rest,1)
+        return table,column
+    return table,None
+
+def _unquote(value):
+    value=value.strip()
+    if len(value)>=2 and value[0]==value[-1]=='"':
+        return value[1:-1]
+    return value
+
+class TMDLParser:
+    """ Parses any number of .tmdl texts (in any order) into one SemanticModel."""
+    def __init__(self):
+        self.model=SemanticModel()
+
+    def feed(self,text):
+        lines=text.split('\n')
+        stack=[] # [(indent, object)]
+        description=[]
+        i=0
+        n=len(lines)
+        while i<n:
+            raw=lines[i].rstrip('\r')
+            i+=1
+            if not raw.strip():
+                continue
+            indent,line=_indent(raw)
+            while stack and stack[-1][0]>=indent:
+                stack.pop()
+            parent=stack[-1][1] if stack else None
+            if line.startswith('///'):
+                description.append(line[3:].strip())
+                continue
+            keyword,end=_read_name(line)
+            rest=line[end:].lstrip()
+            if keyword.endswith(':') or rest.startswith(':'):
+                # name: value
+                key=keyword.rstrip(':')
+                value=rest[1:].strip() if rest.startswith(':') else rest.strip()
+                self._set_property(parent,key,value)
+                continue
+            if rest.startswith('='):
+                # name = expression, the expression lines are indented deeper than this line
+                expression,i=self._read_expression(rest[1:],lines,i,indent+1)
+                self._set_property(parent,keyword,expression)
+                continue
+            if not rest:
+                # bare flag (isHidden, isDefault, ...) or an unnamed object (relatedColumnDetails)
+                self._set_property(parent,keyword,True)
+                stack.append((indent,_Other(keyword,None)))
+                continue
+            name,end=_read_name(rest)
+            rest=rest[end:].lstrip()
+            expression=None
+            if rest.startswith('='):
+                # properties of the object are at indent+1, so its expression lines are deeper than that
+                expression,i=self._read_expression(rest[1:],lines,i,indent+2)
+            obj=self._declare(keyword,name,expression,parent)
+            if description and hasattr(obj,'description'):
+                obj.description=' '.join(description)
+            description=[]
+            stack.append((indent,obj))
+        return self.model
+
+    def _read_expression(self,first,lines,i,min_indent):
+        """ Reads an expression that starts after '=' on the current line and may continue on the next lines. Returns (expression, next line index)."""
+        first=first.strip()
+        parts=[]
+        if first and first!='```':
+            return first,i
+        fenced=first=='```'
+        n=len(lines)
+        while i<n:
+            raw=lines[i].rstrip('\r')
+            indent,line=_indent(raw)
+            if fenced:
+                i+=1
+                if line.rstrip()=='```':
+                    break
+                parts.append(line)
+                continue
+            if line and indent<min_indent:
+                break
+            parts.append(line)
+            i+=1
+        return '\n'.join(parts).strip(),i
+
+    def _declare(self,keyword,name,expression,parent):
+        model=self.model
+        if keyword=='table':
+            table=Table(name)
+            model.tables.append(table)
+            return table
+        if keyword=='relationship':
+            relationship=Relationship(name)
+            model.relationships.append(relationship)
+            return relationship
+        if isinstance(parent,Table):
+            if keyword=='column':
+                column=Column(name)
+                column.expression=expression
+                parent.columns.append(column)
+                return column
+            if keyword=='measure':
+                measure=Measure(name)
+                measure.expression=expression
+                parent.measures.append(measure)
+                return measure
+            if keyword=='partition':
+                partition=Partition(name)
+                partition.kind=expression
+                parent.partitions.append(partition)
+                return partition
+            if keyword=='hierarchy':
+                hierarchy=Hierarchy(name)
+                parent.hierarchies.append(hierarchy)
+                return hierarchy
+        if keyword=='level' and isinstance(parent,Hierarchy):
+            level=Level(name)
+            parent.levels.append(level)
+            return level
+        return _Other(keyword,name)
+
+    def _set_property(self,obj,key,value):
+        if obj is None:
+            return
+        if isinstance(obj,Column):
+            if key=='dataType':
+                obj.data_type=value
+            elif key=='sourceColumn':
+                obj.source_column=value
+            elif key=='summarizeBy':
+                obj.summarize_by=value
+            elif key=='formatString':
+                obj.format_string=value
+            elif key=='isHidden':
+                obj.is_hidden=value is True or value=='true'
+            elif key=='description':
+                obj.description=value
+            elif key=='sortByColumn':
+                obj.sort_by_column=value
+            elif key=='dataCategory':
+                obj.data_category=value
+        elif isinstance(obj,Measure):
+            if key=='formatString':
+                obj.format_string=value
+            elif key=='displayFolder':
+                obj.display_folder=value
+            elif key=='isHidden':
+                obj.is_hidden=value is True or value=='true'
+            elif key=='description':
+                obj.description=value
+        elif isinstance(obj,Partition):
+            if key=='mode':
+                obj.mode=value
+            elif key=='source':
+                obj.source=value
+        elif isinstance(obj,Table):
+            if key=='isHidden':
+                obj.is_hidden=value is True or value=='true'
+            elif key=='description':
+                obj.description=value
+        elif isinstance(obj,Level):
+            if key=='column':
+                obj.column=value
+        elif isinstance(obj,Relationship):
+            if key=='fromColumn':
+                obj.from_table,obj.from_column=split_column_reference(value)
+            elif key=='toColumn':
+                obj.to_table,obj.to_column=split_column_reference(value)
+            elif key=='isActive':
+                obj.is_active=value is True or value=='true'
+            elif key=='crossFilteringBehavior':
+                obj.cross_filtering_behavior=value
+            elif key=='fromCardinality':
+                obj.from_cardinality=value
+            elif key=='toCardinality':
+                obj.to_cardinality=value
+        elif isinstance(obj,_Other):
+            obj.properties[key]=_unquote(value) if isinstance(value,str) else value
+
+def parse_tmdl(texts):
+    """ Parses a list of .tmdl file contents (relationships.tmdl and table files, in any order) into a SemanticModel."""
+    parser=TMDLParser()
+    for text in texts:
+        parser.feed(text)
+    model=parser.model
+    logger.debug(f"Parsed {len(model.tables)} tables and {len(model.relationships)} relationships from {len(texts)} .tmdl files")
+    return model
+
+# Detail levels of describe_semantic_model, from most to least verbose. prompt_compaction steps down through them to fit a token budget.
+FULL=0 # everything, including M sources of partitions
+NO_SOURCES=1 # partitions are left out
+SHORT_EXPRESSIONS=2 # DAX of measures and calculated columns cut to MAX_EXPRESSION_CHARS
+NO_EXPRESSIONS=3 # only names and data types, hidden columns left out
+NAMES_ONLY=4 # table and column/measure names
+MAX_EXPRESSION_CHARS=160
+
+def _expression(expression,detail):
+    expression=' '.join(expression.split())
+    if detail>=SHORT_EXPRESSIONS and len(expression)>MAX_EXPRESSION_CHARS:
+        return expression[:MAX_EXPRESSION_CHARS]+"..."
+    return expression
+
+def describe_semantic_model(model,detail=FULL):
+    """ Compact plain-text rendering of the semantic model, used in the prompt instead of the raw .tmdl files."""
+    out=[]
+    for table in model.tables:
+        if detail>=NAMES_ONLY:
+            names=[column.name for column in table.columns]+[f"[{measure.name}]" for measure in table.measures]
+            out.append(f"Table {table.name}: {', '.join(names)}")
+            continue
+        out.append(f"Table {table.name}" + (" (hidden)" if table.is_hidden else ""))
+        if table.description:
+            out.append(f"  Description: {table.description}")
+        for column in table.columns:
+            if detail>=NO_EXPRESSIONS and column.is_hidden:
+                continue
+            details=[column.data_type or ("calculated" if column.expression else "")]
+            if detail<NO_EXPRESSIONS:
+                if column.source_column and column.source_column!=column.name:
+                    details.append(f"source {column.source_column}")
+                if column.summarize_by and column.summarize_by!='none':
+                    details.append(f"summarize {column.summarize_by}")
+            line=f"  - {column.name} [{', '.join(d for d in details if d)}]"
+            if column.expression and detail<NO_EXPRESSIONS:
+                line+=f" = {_expression(column.expression,detail)}"
+            out.append(line)
+        for measure in table.measures:
+            if detail>=NO_EXPRESSIONS or not measure.expression:
+                out.append(f"  * Measure {measure.name}")
+            else:
+                out.append(f"  * Measure {measure.name} = {_expression(measure.expression,detail)}")
+        if detail<NO_EXPRESSIONS:
+            for hierarchy in table.hierarchies:
+                out.append(f"  Hierarchy {hierarchy.name}: {' > '.join(level.name for level in hierarchy.levels)}")
+        if detail==FULL:
+            for partition in table.partitions:
+                if partition.source:
+                    out.append(f"  Source ({partition.kind}, {partition.mode}): {partition.source}")
+    table_names={table.name for table in model.tables}
+    # Relationships to tables that were never read (LocalDate/DateTableTemplate) are left out, like in the ER diagram.
+    relationships=[r for r in model.relationships if r.from_table in table_names and r.to_table in table_names]
+    if relationships:
+        out.append("Relationships")
+        for r in relationships:
+            out.append(f"  - {r.from_table}.{r.from_column} -> {r.to_table}.{r.to_column}" + ("" if r.is_active else " (inactive)"))
+    return '\n'.join(out)
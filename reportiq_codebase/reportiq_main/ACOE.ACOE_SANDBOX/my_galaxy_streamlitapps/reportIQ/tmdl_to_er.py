@@ -1,8 +1,88 @@
-import streamlit as st
 import os
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+from html import escape
+import graphviz
 from graphviz import Digraph
+from instrumentation import span
+logger=logging.getLogger(__name__)
+# Graphviz spends nearly all of its time on layout, and rasterizing at 600 dpi makes huge images. So the layout is computed once per diagram
+# (layout engine output in DOT, with every position in it) and cached by the hash of the diagram source, then each rendering (SVG, a low dpi
+# PNG preview, the full resolution PNG for the download) reuses it with `neato -n2`, which only draws the given positions.
+# dot gives the most readable layout for small models but gets slow with many tables and ports, sfdp scales to large ones.
+
+PREVIEW_DPI=96
+FULL_DPI=600
+DOT_MAX_TABLES=int(os.getenv('REPORTIQ_ER_DOT_MAX_TABLES','30'))
+_LAYOUT_CACHE_SIZE=32
+_layouts=OrderedDict() # sha256 of engine+source -> laid out DOT, least recently used first
+_layouts_lock=threading.Lock()
+
+def choose_engine(table_count):
+    """ dot up to DOT_MAX_TABLES tables, sfdp above."""
+    return 'dot' if table_count<=DOT_MAX_TABLES else 'sfdp'
+
+def _layout(source,engine):
+    """ Laid out DOT of source, computed once per (engine, source)."""
+    key=hashlib.sha256(f"{engine}\n{source}".encode('utf-8')).hexdigest()
+    with _layouts_lock:
+        if key in _layouts:
+            _layouts.move_to_end(key)
+            logger.debug(f"ER layout cache hit for {key}")
+            return _layouts[key]
+    layout=graphviz.pipe(engine,'dot',source.encode('utf-8')).decode('utf-8')
+    with _layouts_lock:
+        _layouts[key]=layout
+        while len(_layouts)>_LAYOUT_CACHE_SIZE:
+            _layouts.popitem(last=False)
+    return layout
+
+class ERDiagram:
+    """ A laid out ER diagram. Renderings are made on demand from the layout and kept, so each format/dpi is drawn once."""
+    def __init__(self,layout,engine,table_count):
+        self.layout=layout
+        self.engine=engine
+        self.table_count=table_count
+        self._renders={}
+        self._lock=threading.Lock() # the background preview, the page and the exports can render the same diagram at once
+
+    def __getstate__(self): # the upload cache pickles it to disk, without the lock
+        state=self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock=threading.Lock()
+
+    def render(self,format,dpi=FULL_DPI):
+        key=(format,dpi)
+        with self._lock: # held while drawing, so a format/dpi asked for twice at once is still drawn once
+            if key not in self._renders:
+                # the graph attribute statement is added first, so it doesn't override anything the layout set
+                source=self.layout.replace('{',f'{{\n\tgraph [dpi={dpi}];',1)
+                self._renders[key]=graphviz.pipe('neato',format,source.encode('utf-8'),neato_no_op=2)
+                logger.debug(f"Rendered ER diagram as {format} at {dpi} dpi : {len(self._renders[key])} bytes")
+            return self._renders[key]
+
+    def svg(self):
+        return self.render('svg',72) # vector, dpi only scales the pixel size hints
+
+    def png(self,dpi=FULL_DPI):
+        return self.render('png',dpi)
+
+def layout_with_preview(semantic_model):
+    """ Lays the ER diagram of semantic_model out and draws its preview, the job run by background_render."""
+    with span("er_layout",tables=len(semantic_model.tables)):
+        er_diagram=ERDiagramFromTMDL(semantic_model).layout_diagram()
+        er_diagram.png(PREVIEW_DPI)
+    return er_diagram
+
 class ERDiagramFromTMDL:
     def __init__(self, semantic_model):
+        """ semantic_model is the SemanticModel parsed by tmdl_parser.parse_tmdl"""
         self.semantic_model = semantic_model
         self.table_columns = {}
         self.foreign_keys = []
@@ -11,80 +91,63 @@ class ERDiagramFromTMDL:
         #os.environ["PATH"] += os.pathsep + graphviz_bin_path
     
     def parse_tmdl_files(self):
-        for file in self.semantic_model:
-            #st.write(f"Starting = {file[0:12]} \n {file}")
-            if file[0:12]!="relationship" and file!="":
-                #st.write(self.semantic_model)
-                #st.write(file)
-                word=file.split(' ',2)
-                if word[1].startswith("'"):
-                    end=file.find("'",file.find("'")+1)
-                    table_name=file[file.find("'"):end+1]
-                else:
-                    table_name=word[1].split()[0]
-                #st.write(f"Table name = ...{table_name}...")
-                lines = file.split('\n')
-                columns = []
-                for line in lines:
-                    word=line.split(' ')
-                    #for i in word:
-                    #    print(f"--{i}--") 
-                    if word[0].strip()=="column":
-                        column_name=""
-                        if word[1].startswith("'"):
-                            end=line.find("'",line.find("'")+1)
-                            column_name=line[line.find("'"):end+1]
-                        else:
-                            column_name=word[1]
-                        columns.append(column_name)
-                self.table_columns[table_name]=columns
+        for table in self.semantic_model.tables:
+            self.table_columns[table.name] = [column.name for column in table.columns]
 
     def parse_relationships(self):
-        lines = self.semantic_model[0].split('\n')
-        from_col, to_col = None, None
-        for line in lines:
-            line = line.strip()
-            if line.startswith("fromColumn:"):
-                from_col = line.split("fromColumn:")[1].strip()
-            elif line.startswith("toColumn:"):
-                to_col = line.split("toColumn:")[1].strip()
-                if from_col and to_col:
-                    if(from_col.startswith("LocalDate") or to_col.startswith("LocalDate")):
-                        continue
-                    fk_table, fk_column = from_col.split(".")
-                    ref_table, ref_column = to_col.split(".")
-                    self.foreign_keys.append((fk_table, fk_column, ref_table, ref_column))
-                    from_col, to_col = None, None
+        for relationship in self.semantic_model.relationships:
+            # Relationships to the auto generated LocalDate/DateTableTemplate tables (or anything else we didn't read) would only create empty nodes.
+            if relationship.from_table not in self.table_columns or relationship.to_table not in self.table_columns:
+                continue
+            self.foreign_keys.append((relationship.from_table, relationship.from_column, relationship.to_table, relationship.to_column))
 
     def generate_table_node(self, table_name, columns):
+        # Names are escaped for the HTML-like label and ports are positional ids, since column names can contain spaces, quotes, ':' or '&'.
         label = f"""<
     <TABLE BORDER="1" CELLBORDER="1" CELLSPACING="0">
-        <TR><TD BGCOLOR="lightblue"><B>{table_name}</B></TD></TR>"""
-        for col_name in columns:
-            label += f'<TR><TD ALIGN="LEFT" PORT="{col_name}">{col_name}</TD></TR>'
+        <TR><TD BGCOLOR="lightblue"><B>{escape(table_name)}</B></TD></TR>"""
+        for index, col_name in enumerate(columns):
+            label += f'<TR><TD ALIGN="LEFT" PORT="c{index}">{escape(col_name)}</TD></TR>'
         label += """</TABLE>
     >"""
         return label
 
 
-    def generate_er_diagram(self):
-        dot = Digraph(format='png', engine='fdp')
-        dot.attr(rankdir='TB', size='10,10!', concentrate='true', splines='polyline', dpi="600")
-
+    def build_graph(self):
         self.parse_tmdl_files()
         self.parse_relationships()
+        engine = choose_engine(len(self.table_columns))
+        dot = Digraph(engine=engine)
+        # dpi is left to each rendering, see ERDiagram.render
+        dot.attr(rankdir='TB', size='10,10!', concentrate='true', splines='polyline')
+        if engine == 'sfdp':
+            dot.attr(overlap='prism')
 
+        node_ids = {}
         for table_name, columns in self.table_columns.items():
-            print(f"TABLE NAMEE {table_name } AND COLUMNSSS {columns}")
+            node_ids[table_name] = f"t{len(node_ids)}"
             label = self.generate_table_node(table_name, columns)
-            dot.node(table_name, label=label, shape="plaintext")
+            dot.node(node_ids[table_name], label=label, shape="plaintext")
 
         for fk_table, fk_column, ref_table, ref_column in self.foreign_keys:
-            dot.edge(f"{fk_table}:{fk_column}", f"{ref_table}:{ref_column}",
+            dot.edge(self._port(node_ids, fk_table, fk_column), self._port(node_ids, ref_table, ref_column),
                      label=f"{fk_column} → {ref_column}", color="blue", arrowhead="crow", fontsize="10")
+        return dot
+
+    def layout_diagram(self):
+        """ Lays the diagram out (or reuses the cached layout of an identical model) without rendering it."""
+        dot = self.build_graph()
+        return ERDiagram(_layout(dot.source, dot.engine), dot.engine, len(self.table_columns))
+
+    def generate_er_diagram(self):
+        """ Full resolution PNG."""
+        return self.layout_diagram().png(FULL_DPI)
 
-        image_bytes=dot.pipe(format='png')
-        return image_bytes
+    def _port(self, node_ids, table_name, column_name):
+        columns = self.table_columns[table_name]
+        if column_name in columns:
+            return f"{node_ids[table_name]}:c{columns.index(column_name)}"
+        return node_ids[table_name]
 
 # Example usage
 #if __name__ == "__main__":
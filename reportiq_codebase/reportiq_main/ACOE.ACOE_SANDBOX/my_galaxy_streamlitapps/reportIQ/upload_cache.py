@@ -0,0 +1,137 @@
+import os
+import hashlib
+import pickle
+import tempfile
+import threading
+import logging
+from collections import OrderedDict
+logger=logging.getLogger(__name__)
+# Streamlit reruns the whole script on every widget interaction (toggle flip, every keystroke in the context text_input, ...).
+# Without this, every rerun re-unzips the upload and re-renders the ER diagram. Processed uploads are kept here keyed by the
+# SHA-256 of the uploaded bytes, in an in-memory LRU bounded by entries and bytes, with an optional on-disk tier shared by all sessions/pods mounting the same directory.
+
+def _slot_values(value):
+    """ Values of the __slots__ attributes of value, over its whole class hierarchy (SemanticModel, its tables and columns, ReportLayout, ...)."""
+    for cls in type(value).__mro__:
+        slots=cls.__dict__.get('__slots__',())
+        for name in ((slots,) if isinstance(slots,str) else slots):
+            if name not in ('__dict__','__weakref__') and hasattr(value,name):
+                yield getattr(value,name)
+
+def _estimate_size(value,seen=None):
+    """ Rough size in bytes of the processed contents (strings, bytes, containers of them and objects holding them). Every object is counted once."""
+    if isinstance(value,(str,bytes,bytearray)):
+        return len(value)
+    if seen is None:
+        seen=set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if isinstance(value,dict):
+        return sum(_estimate_size(k,seen)+_estimate_size(v,seen) for k,v in value.items())
+    if isinstance(value,(list,tuple,set,frozenset)):
+        return sum(_estimate_size(v,seen) for v in value)
+    size=0
+    if hasattr(value,'__dict__'): # e.g. the ER diagram with its renderings
+        size+=_estimate_size(vars(value),seen)
+    size+=sum(_estimate_size(v,seen) for v in _slot_values(value))
+    return size or 64
+
+class ProcessedUploadCache:
+    def __init__(self,max_entries=16,max_bytes=512*1024*1024,disk_dir=None,max_disk_bytes=2*1024*1024*1024):
+        self.max_entries=max_entries
+        self.max_bytes=max_bytes
+        self.disk_dir=disk_dir
+        self.max_disk_bytes=max_disk_bytes
+        self._entries=OrderedDict() # key -> (value, size), least recently used first
+        self._bytes=0
+        self._lock=threading.Lock() # Streamlit runs each session in its own thread
+        if self.disk_dir:
+            os.makedirs(self.disk_dir,exist_ok=True)
+
+    @staticmethod
+    def key(file_type,data):
+        """ Content address of an upload. The file type is part of the key since the same bytes are processed differently per type."""
+        digest=hashlib.sha256(data).hexdigest()
+        return f"{file_type.replace(' ','_')}-{digest}"
+
+    def get(self,key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                logger.debug(f"Upload cache hit (memory) for {key}")
+                return self._entries[key][0]
+        value=self._load_from_disk(key)
+        if value is not None:
+            logger.debug(f"Upload cache hit (disk) for {key}")
+            self._put_memory(key,value)
+        return value
+
+    def put(self,key,value):
+        self._put_memory(key,value)
+        self._save_to_disk(key,value)
+
+    def _put_memory(self,key,value):
+        size=_estimate_size(value)
+        if size>self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes-=self._entries.pop(key)[1]
+            self._entries[key]=(value,size)
+            self._bytes+=size
+            while len(self._entries)>self.max_entries or self._bytes>self.max_bytes:
+                evicted,(_,evicted_size)=self._entries.popitem(last=False)
+                self._bytes-=evicted_size
+                logger.debug(f"Evicted {evicted} from upload cache")
+
+    def _path(self,key):
+        return os.path.join(self.disk_dir,f"{key}.pkl")
+
+    def _load_from_disk(self,key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._path(key),'rb') as f:
+                value=pickle.load(f)
+            os.utime(self._path(key)) # mtime is used as the LRU clock of the disk tier
+            return value
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # Written by an older version of the app or truncated : treat as a miss, it'll be overwritten.
+            logger.debug(f"Ignoring unreadable cache file for {key} : {e}")
+            return None
+
+    def _save_to_disk(self,key,value):
+        if not self.disk_dir:
+            return
+        try:
+            # Write to a temp file and rename so concurrent readers never see a half written entry.
+            fd,tmp_path=tempfile.mkstemp(dir=self.disk_dir,suffix=".tmp")
+            with os.fdopen(fd,'wb') as f:
+                pickle.dump(value,f,protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path,self._path(key))
+            self._evict_disk()
+        except Exception as e:
+            logger.debug(f"Could not write {key} to disk cache : {e}")
+
+    def _evict_disk(self):
+        files=[]
+        for name in os.listdir(self.disk_dir):
+            if name.endswith(".pkl"):
+                path=os.path.join(self.disk_dir,name)
+                try:
+                    stat=os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime,stat.st_size,path))
+        total=sum(size for _,size,_ in files)
+        for _,size,path in sorted(files):
+            if total<=self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total-=size
+            except FileNotFoundError:
+                pass
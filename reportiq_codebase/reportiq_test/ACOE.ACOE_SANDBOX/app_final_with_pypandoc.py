@@ -243,18 +243,13 @@ def info_and_uploader(option):
 def markdown_to_docx(markdown_text):
     """Converts markdown text to DOCX using pypandoc."""
     try:
-        # Similar to PDF, we write to a temporary file for DOCX conversion.
-        with open("temp.md", "w", encoding="utf-8") as f:
-            f.write(markdown_text)
-            
-        docx_output_path = "output.docx"
-        pypandoc.convert_file("temp.md", 'docx', outputfile=docx_output_path)
-        
-        with open(docx_output_path, "rb") as f:
-            docx_data = f.read()
-        
-        os.remove("temp.md")  # Clean up temporary file
-        os.remove(docx_output_path) # Clean up generated DOCX
+        # pandoc reads the markdown from memory, but writes DOCX only to a file : a directory of its own per call, so concurrent
+        # sessions don't overwrite each other's output (a shared temp.md/output.docx in the working directory did)
+        with tempfile.TemporaryDirectory() as directory:
+            docx_output_path = os.path.join(directory, "output.docx")
+            pypandoc.convert_text(markdown_text, 'docx', format='md', outputfile=docx_output_path)
+            with open(docx_output_path, "rb") as f:
+                docx_data = f.read()
         return docx_data
     except Exception as e:
         st.error(f"Error converting to DOCX: {e}")